@@ -0,0 +1,4 @@
+"""
+Нагрузочное тестирование бота без сети.
+Настоящие обработчики работают с поддельными Telegram, провайдерами моделей и хранилищем.
+"""
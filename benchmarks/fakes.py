@@ -0,0 +1,287 @@
+import asyncio
+import itertools
+import math
+import random
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from telegram import Chat, Message, Update, User
+
+from bot.config import DEFAULT_MODEL
+from bot.metrics import TELEGRAM_SECONDS
+from bot.storage.base import Storage, _merge_batch, _trim_messages
+from services.errors import ProviderError
+from services.tokens import TokenUsage
+
+class Latency:
+    """Логнормальное распределение задержки, заданное медианой и разбросом."""
+    
+    def __init__(self, median: float, sigma: float = 0.5, rng: Optional[random.Random] = None):
+        """
+        Args:
+            median: Медиана задержки в секундах (0 - без задержки)
+            sigma: Разброс логарифма задержки (больше - длиннее хвост)
+            rng: Генератор случайных чисел
+        """
+        self.median = median
+        self.sigma = sigma
+        self.rng = rng or random.Random()
+    
+    def sample(self) -> float:
+        """Случайная задержка в секундах."""
+        if not self.median:
+            return 0.0
+        return self.median * math.exp(self.sigma * self.rng.gauss(0, 1))
+    
+    async def wait(self) -> float:
+        """Выждать случайную задержку и вернуть ее."""
+        delay = self.sample()
+        await asyncio.sleep(delay)
+        return delay
+
+class FakeBot:
+    """
+    Поддельный Bot API: методы, которые вызывают обработчики, с задержкой сети.
+    
+    Время вызовов учитывается в тех же метриках, что и InstrumentedRequest.
+    """
+    
+    def __init__(self, latency: Latency):
+        """
+        Args:
+            latency: Задержка одного запроса к Bot API
+        """
+        self.latency = latency
+        self._message_ids = itertools.count(1)
+        self.calls: Dict[str, int] = {}
+    
+    async def _call(self, method: str) -> None:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        with TELEGRAM_SECONDS.time(method=method):
+            await self.latency.wait()
+    
+    async def send_message(self, chat_id: int, text: str, **kwargs: Any) -> Message:
+        await self._call("sendMessage")
+        return make_message(self, chat_id, text, next(self._message_ids), from_bot=True)
+    
+    async def edit_message_text(self, text: str, chat_id: int = None, message_id: int = None, **kwargs: Any) -> Message:
+        await self._call("editMessageText")
+        return make_message(self, chat_id, text, message_id, from_bot=True)
+    
+    async def delete_message(self, chat_id: int, message_id: int, **kwargs: Any) -> bool:
+        await self._call("deleteMessage")
+        return True
+    
+    async def send_chat_action(self, chat_id: int, action: str, **kwargs: Any) -> bool:
+        await self._call("sendChatAction")
+        return True
+
+def make_message(bot: FakeBot, chat_id: int, text: str, message_id: int, from_bot: bool = False) -> Message:
+    """Сообщение Telegram, привязанное к поддельному боту."""
+    user = User(id=0 if from_bot else chat_id, first_name="Bot" if from_bot else f"User {chat_id}", is_bot=from_bot)
+    message = Message(
+        message_id=message_id,
+        date=datetime.now(timezone.utc),
+        chat=Chat(id=chat_id, type=Chat.PRIVATE),
+        from_user=user,
+        text=text
+    )
+    message.set_bot(bot)
+    return message
+
+_update_ids = itertools.count(1)
+
+def make_update(bot: FakeBot, user_id: int, text: str) -> Update:
+    """
+    Обновление с текстовым сообщением пользователя в личном чате.
+    
+    Args:
+        bot: Поддельный бот, через который отвечают обработчики
+        user_id: ID пользователя (совпадает с ID чата)
+        text: Текст сообщения
+    
+    Returns:
+        Обновление Telegram
+    """
+    update_id = next(_update_ids)
+    update = Update(update_id=update_id, message=make_message(bot, user_id, text, update_id))
+    update.set_bot(bot)
+    return update
+
+class FakeProvider:
+    """
+    Поддельный провайдер модели с тем же интерфейсом, что у openai_service и anthropic_service.
+    
+    Время до первого фрагмента и длительность генерации случайны, часть
+    запросов завершается временной ошибкой, а часть зависает на stall секунд.
+    """
+    
+    def __init__(
+        self,
+        first_token: Latency,
+        duration: Latency,
+        chunks: int = 20,
+        error_rate: float = 0.0,
+        stall_rate: float = 0.0,
+        stall: float = 0.0,
+        rng: Optional[random.Random] = None
+    ):
+        """
+        Args:
+            first_token: Задержка до первого фрагмента ответа
+            duration: Длительность генерации после первого фрагмента
+            chunks: Количество фрагментов в потоковом ответе
+            error_rate: Доля запросов, завершающихся временной ошибкой
+            stall_rate: Доля запросов, которые зависают перед первым фрагментом
+            stall: Время зависания в секундах
+            rng: Генератор случайных чисел
+        """
+        self.first_token = first_token
+        self.duration = duration
+        self.chunks = chunks
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.rng = rng or random.Random()
+        self.requests = 0
+        self.errors = 0
+        self.cancelled = 0
+    
+    def _maybe_fail(self) -> None:
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            raise ProviderError("Сервер перегружен (поддельная ошибка)", retryable=True)
+    
+    async def _wait_first_token(self) -> None:
+        try:
+            await self.first_token.wait()
+            if self.rng.random() < self.stall_rate:
+                await asyncio.sleep(self.stall)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+    
+    def _answer(self, messages: List[Dict[str, str]]) -> List[str]:
+        question = messages[-1]["content"]
+        return [f"часть {i} ответа на «{question[:20]}» " for i in range(self.chunks)]
+    
+    async def get_completion(self, messages: List[Dict[str, str]], model: str, usage: Optional[TokenUsage] = None) -> str:
+        self.requests += 1
+        await self._wait_first_token()
+        self._maybe_fail()
+        await self.duration.wait()
+        return "".join(self._answer(messages))
+    
+    async def stream_completion(self, messages: List[Dict[str, str]], model: str, usage: Optional[TokenUsage] = None) -> AsyncIterator[str]:
+        self.requests += 1
+        await self._wait_first_token()
+        self._maybe_fail()
+        parts = self._answer(messages)
+        pause = self.duration.sample() / len(parts)
+        for part in parts:
+            yield part
+            await asyncio.sleep(pause)
+    
+    async def _close(self) -> None:
+        pass
+
+class MemoryStorage(Storage):
+    """
+    Хранилище в памяти с общей логикой Storage: те же кэш и обрезка истории.
+    
+    Обращения к "базе" выполняются с заданной задержкой и подсчитываются,
+    чтобы оценить число операций с БД на обмен.
+    """
+    
+    backend = "memory"
+    
+    def __init__(self, latency: Latency, write_behind: bool = False):
+        """
+        Args:
+            latency: Задержка одной операции с базой
+            write_behind: Сохранять новые сообщения отложенной пакетной записью
+        """
+        super().__init__(write_behind)
+        self.latency = latency
+        self.documents: Dict[int, Dict[str, Any]] = {}
+        self.quotas: Dict[int, Dict[str, float]] = {}
+        self.usage: Dict[Tuple[int, str, int], Dict[str, float]] = {}
+        self.reads = 0
+        self.writes = 0
+    
+    async def _db(self, write: bool) -> None:
+        if write:
+            self.writes += 1
+        else:
+            self.reads += 1
+        await self.latency.wait()
+    
+    def _document(self, user_id: int) -> Dict[str, Any]:
+        return self.documents.setdefault(user_id, {"_id": user_id, "messages": [], "model": DEFAULT_MODEL})
+    
+    async def _load_user(self, user_id: int) -> Dict[str, Any]:
+        await self._db(write=False)
+        document = self._document(user_id)
+        return {**document, "messages": list(document["messages"])}
+    
+    async def _store_messages(self, user_id: int, messages: List[Dict[str, str]]) -> None:
+        await self._db(write=True)
+        document = self._document(user_id)
+        document["messages"] = _trim_messages(document["messages"] + messages)
+    
+    async def _store_batch(self, batch: List[Tuple[int, List[Dict[str, Any]]]]) -> None:
+        # Пакет сохраняется одной операцией, как bulk_write
+        await self._db(write=True)
+        for user_id, messages in _merge_batch(batch).items():
+            document = self._document(user_id)
+            document["messages"] = _trim_messages(document["messages"] + messages)
+    
+    async def _reset(self, user_id: int, model: Optional[str]) -> None:
+        await self._db(write=True)
+        document = self._document(user_id)
+        if model is not None:
+            document["model"] = model
+        document["messages"] = [self._system_message(document["model"])]
+    
+    async def _replace_with_summary(
+        self,
+        user_id: int,
+        summarized: List[Dict[str, Any]],
+        summary: Dict[str, Any]
+    ) -> bool:
+        await self._db(write=True)
+        document = self._document(user_id)
+        others = [msg for msg in document["messages"] if msg["role"] != "system"]
+        if summarized[0] not in others or summarized[-1] not in others:
+            return False
+        system = [msg for msg in document["messages"] if msg["role"] == "system" and not msg.get("summary")]
+        document["messages"] = system + [summary] + others[len(summarized):]
+        return True
+    
+    async def _store_model(self, user_id: int, model: str) -> None:
+        await self._db(write=True)
+        self._document(user_id)["model"] = model
+    
+    async def _load_quotas(self, since: float) -> Dict[int, Dict[str, float]]:
+        await self._db(write=False)
+        return {user_id: dict(quota) for user_id, quota in self.quotas.items() if quota["start"] >= since}
+    
+    async def _store_quotas(self, quotas: Dict[int, Dict[str, float]]) -> None:
+        await self._db(write=True)
+        self.quotas.update({user_id: dict(quota) for user_id, quota in quotas.items()})
+    
+    async def _load_usage(self, since: int) -> List[Dict[str, Any]]:
+        await self._db(write=False)
+        return [
+            {"user_id": user_id, "model": model, "hour": hour, **totals}
+            for (user_id, model, hour), totals in self.usage.items() if hour >= since
+        ]
+    
+    async def _store_usage(self, usage: Dict[Tuple[int, str, int], Dict[str, float]]) -> None:
+        await self._db(write=True)
+        for key, totals in usage.items():
+            stored = self.usage.setdefault(key, dict.fromkeys(totals, 0))
+            for field, value in totals.items():
+                stored[field] += value
+    
+    async def _close(self) -> None:
+        pass
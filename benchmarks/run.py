@@ -0,0 +1,247 @@
+"""
+Нагрузочный тест: много пользователей пишут боту, ответы дают поддельные модели.
+
+Запуск:
+    python -m benchmarks.run --users 200 --messages 10
+
+Обработчики bot/handlers.py, объединение сообщений, планировщик провайдеров,
+повторы и выключатели работают по-настоящему. Заменены только внешние
+системы: Telegram, провайдеры моделей и база данных.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from typing import Any, Dict, List
+
+# Клиенты создаются при импорте и требуют настроек, но в сеть не обращаются
+os.environ.setdefault("OPENAI_TOKEN", "benchmark")
+os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost")
+
+from bot import handlers, metrics, summarizer as summarizer_module
+from bot.dispatcher import ChatSerializedUpdateProcessor, update_slots
+from services import admission, ai_service, hedging, scheduler, usage
+from benchmarks.fakes import FakeBot, FakeProvider, Latency, MemoryStorage, make_update
+
+# Этапы, для которых считаются перцентили, и их гистограммы
+STAGES = {
+    "db": metrics.STORAGE_SECONDS,
+    "provider_queue": metrics.PROVIDER_QUEUE_SECONDS,
+    "provider_first_token": metrics.PROVIDER_FIRST_TOKEN_SECONDS,
+    "provider": metrics.PROVIDER_SECONDS,
+    "telegram_queue": metrics.TELEGRAM_QUEUE_SECONDS,
+    "telegram": metrics.TELEGRAM_SECONDS,
+    "update": metrics.UPDATE_SECONDS,
+    "turn": metrics.TURN_SECONDS,
+}
+
+class StageRecorder:
+    """Собирает все значения гистограмм этапов, чтобы посчитать точные перцентили."""
+    
+    def __init__(self, stages: Dict[str, metrics.Histogram]):
+        self.samples: Dict[str, List[float]] = {name: [] for name in stages}
+        for name, histogram in stages.items():
+            self._attach(name, histogram)
+    
+    def _attach(self, name: str, histogram: metrics.Histogram) -> None:
+        observe = histogram.observe
+        samples = self.samples[name]
+        
+        def recording_observe(value: float, **labels: str) -> None:
+            samples.append(value)
+            observe(value, **labels)
+        
+        histogram.observe = recording_observe
+    
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """Количество и перцентили p50/p95/p99 каждого этапа в миллисекундах."""
+        return {
+            name: {
+                "count": len(values),
+                "p50": _percentile(values, 50) * 1000,
+                "p95": _percentile(values, 95) * 1000,
+                "p99": _percentile(values, 99) * 1000,
+            }
+            for name, values in self.samples.items()
+        }
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с поддельными Telegram, моделями и базой")
+    parser.add_argument("--users", type=int, default=100, help="Количество пользователей")
+    parser.add_argument("--messages", type=int, default=10, help="Сообщений от каждого пользователя")
+    parser.add_argument("--think", type=float, default=1.0, help="Средняя пауза пользователя между сообщениями, с")
+    parser.add_argument("--burst", type=float, default=0.1, help="Доля сообщений, отправленных очередью из нескольких частей")
+    parser.add_argument("--llm-first-token", type=float, default=0.4, help="Медиана времени до первого фрагмента, с")
+    parser.add_argument("--llm-duration", type=float, default=1.5, help="Медиана длительности генерации, с")
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="Разброс задержек модели")
+    parser.add_argument("--llm-chunks", type=int, default=20, help="Фрагментов в потоковом ответе")
+    parser.add_argument("--llm-error-rate", type=float, default=0.01, help="Доля запросов с временной ошибкой")
+    parser.add_argument("--llm-stall-rate", type=float, default=0.0, help="Доля запросов, зависающих перед первым фрагментом")
+    parser.add_argument("--llm-stall", type=float, default=20.0, help="Время зависания запроса, с")
+    parser.add_argument("--hedge", action="store_true", help="Дублировать медленные запросы ко всем моделям")
+    parser.add_argument("--max-pending", type=int, default=admission.admission.max_pending, help="Лимит запросов к моделям в работе (0 - без ограничения)")
+    parser.add_argument("--db-latency", type=float, default=0.001, help="Медиана задержки операции с базой, с")
+    parser.add_argument("--write-behind", action="store_true", help="Отложенная пакетная запись истории")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="Медиана задержки запроса к Bot API, с")
+    parser.add_argument("--stream", choices=("on", "off"), default="on" if handlers.STREAM_RESPONSES else "off", help="Потоковые ответы")
+    parser.add_argument("--coalesce-ms", type=int, default=round(handlers.coalescer.window * 1000), help="Окно объединения сообщений, мс")
+    parser.add_argument("--unlimited", action="store_true", help="Отключить лимиты запросов к провайдерам")
+    parser.add_argument("--seed", type=int, default=1, help="Начальное значение генератора случайных чисел")
+    parser.add_argument("--json", help="Сохранить результаты в файл JSON для сравнения запусков")
+    return parser.parse_args(argv)
+
+def install_fakes(args: argparse.Namespace, rng: random.Random) -> Dict[str, Any]:
+    """Подменить внешние системы поддельными и вернуть их для подсчета статистики."""
+    provider = FakeProvider(
+        first_token=Latency(args.llm_first_token, args.llm_sigma, rng),
+        duration=Latency(args.llm_duration, args.llm_sigma, rng),
+        chunks=args.llm_chunks,
+        error_rate=args.llm_error_rate,
+        stall_rate=args.llm_stall_rate,
+        stall=args.llm_stall,
+        rng=rng
+    )
+    ai_service.openai_service = provider
+    ai_service.anthropic_service = provider
+    
+    storage = MemoryStorage(Latency(args.db_latency, 0.5, rng), write_behind=args.write_behind)
+    handlers.storage = storage
+    summarizer_module.storage = storage
+    admission.storage = storage
+    usage.storage = storage
+    admission.admission.max_pending = args.max_pending
+    
+    handlers.STREAM_RESPONSES = args.stream == "on"
+    handlers.coalescer.window = args.coalesce_ms / 1000
+    
+    if args.hedge:
+        hedging.policy.models = set(ai_service.MODEL_PROVIDERS)
+    
+    if args.unlimited:
+        for name in ("openai", "anthropic"):
+            scheduler.schedulers[name] = scheduler.ProviderScheduler(name, 0, 0, 10 ** 6)
+    
+    return {"provider": provider, "storage": storage, "bot": FakeBot(Latency(args.telegram_latency, 0.5, rng))}
+
+async def simulate_user(
+    user_id: int,
+    args: argparse.Namespace,
+    rng: random.Random,
+    bot: FakeBot,
+    processor: ChatSerializedUpdateProcessor,
+    tasks: List[asyncio.Task]
+) -> None:
+    """Пользователь отправляет сообщения с паузами, иногда несколькими частями подряд."""
+    context = type("Context", (), {"bot": bot})()
+    for number in range(args.messages):
+        await asyncio.sleep(rng.expovariate(1 / args.think) if args.think else 0)
+        parts = rng.randint(2, 3) if rng.random() < args.burst else 1
+        for part in range(parts):
+            update = make_update(bot, user_id, f"Вопрос {number}.{part} от пользователя {user_id}")
+            # Как Application: каждое обновление обрабатывается отдельной задачей
+            tasks.append(asyncio.create_task(
+                processor.process_update(update, handlers.message_handler(update, context))
+            ))
+            if part + 1 < parts:
+                await asyncio.sleep(rng.uniform(0.05, 0.3))
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    fakes = install_fakes(args, rng)
+    recorder = StageRecorder(STAGES)
+    processor = ChatSerializedUpdateProcessor(slots=update_slots)
+    tasks: List[asyncio.Task] = []
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        simulate_user(user_id, args, rng, fakes["bot"], processor, tasks)
+        for user_id in range(1, args.users + 1)
+    ))
+    await asyncio.gather(*tasks)
+    await handlers.coalescer.drain()
+    await summarizer_module.summarizer.close()
+    await admission.admission.close()
+    usage_report = await usage.tracker.report(1)
+    await usage.tracker.close()
+    await fakes["storage"].close()
+    elapsed = time.perf_counter() - started
+    
+    coalescer_stats = handlers.coalescer.stats()
+    turns = coalescer_stats["turns"] - coalescer_stats["cancelled"]
+    storage = fakes["storage"]
+    rejected: Dict[str, float] = {}
+    for (model, result), count in metrics.ADMISSIONS.values().items():
+        if result != "admitted":
+            rejected[result] = rejected.get(result, 0) + count
+    return {
+        "users": args.users,
+        "updates": len(tasks),
+        "elapsed": elapsed,
+        "updates_per_second": len(tasks) / elapsed,
+        "turns": turns,
+        "cancelled_turns": coalescer_stats["cancelled"],
+        "provider_requests": fakes["provider"].requests,
+        "provider_errors": fakes["provider"].errors,
+        "provider_cancelled": fakes["provider"].cancelled,
+        "hedging": hedging.policy.stats(),
+        "admission": rejected,
+        "usage": dict(usage_report["models"]),
+        "db_reads_per_turn": storage.reads / turns if turns else 0.0,
+        "db_writes_per_turn": storage.writes / turns if turns else 0.0,
+        "telegram_calls": fakes["bot"].calls,
+        "stages": recorder.report(),
+        "errors": {key[0]: value for key, value in metrics.ERRORS.values().items()},
+    }
+
+def print_report(result: Dict[str, Any]) -> None:
+    print(f"Пользователей: {result['users']}, обновлений: {result['updates']}, время: {result['elapsed']:.2f} с")
+    print(f"Обновлений в секунду: {result['updates_per_second']:.1f}")
+    print(f"Обменов: {result['turns']} (отменено и объединено: {result['cancelled_turns']})")
+    print(f"Запросов к модели: {result['provider_requests']}, из них с ошибкой: {result['provider_errors']}")
+    for model, stats in result["hedging"].items():
+        print(
+            f"Дублирование {model}: {stats['hedged']} из {stats['requests']} запросов ({stats['hedge_rate']:.1%}), "
+            f"дубль быстрее в {stats['win_rate']:.0%}, отказано бюджетом: {stats['denied']}"
+        )
+    for model, totals in result["usage"].items():
+        print(
+            f"Модель {model}: {totals['completion_tokens']:.0f} токенов ответа, "
+            f"{totals['tokens_per_second']:.1f} ток/с, стоимость ${totals['cost']:.2f}"
+        )
+    if result["admission"]:
+        print(f"Отклонено контролем допуска: {result['admission']}")
+    print(f"Операций с БД на обмен: чтений {result['db_reads_per_turn']:.2f}, записей {result['db_writes_per_turn']:.2f}")
+    print(f"Запросы к Bot API: {result['telegram_calls']}")
+    print()
+    print(f"{'Этап':<22}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for name, stage in result["stages"].items():
+        print(f"{name:<22}{stage['count']:>8}{stage['p50']:>10.1f}{stage['p95']:>10.1f}{stage['p99']:>10.1f}")
+    if result["errors"]:
+        print()
+        print(f"Ошибки: {result['errors']}")
+
+def main(argv: List[str] = None) -> None:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    # Журнал отдельных запросов и повторов не нужен и искажает замеры
+    logging.basicConfig(level=logging.ERROR)
+    
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import asyncio
+import os
+from typing import Optional
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+
+from bot.startup import startup, warm_up
+from bot.handlers import start_handler, help_handler, reset_handler, model_handler, usage_handler, profile_handler, message_handler, model_callback_handler, coalescer
+from bot.dispatcher import ChatSerializedUpdateProcessor, update_slots
+from bot.profiling import profiler
+from bot.request import InstrumentedRequest
+from bot.server import MetricsServer
+from bot.storage import storage
+from bot.summarizer import summarizer
+from services import ai_service
+from services.admission import admission
+from services.usage import tracker
+from bot.config import METRICS_PORT, WARMUP
+
+# Отдельный сервер метрик для режима polling
+metrics_server = MetricsServer(METRICS_PORT)
+
+# Ссылка на фоновую задачу прогрева, чтобы ее не удалил сборщик мусора
+warmup_task: Optional[asyncio.Task] = None
+
+def start_warm_up() -> None:
+    """Запустить прогрев в фоне: полный, если он включен, иначе только токенизатора."""
+    global warmup_task
+    if warmup_task is None:
+        warmup_task = asyncio.create_task(warm_up(full=WARMUP))
+
+async def post_init(application: Application) -> None:
+    """Запуск сервера метрик и прогрева в режиме polling."""
+    metrics_server.start()
+    startup.mark("initialize")
+    startup.report()
+    start_warm_up()
+
+async def post_stop(application: Application) -> None:
+    """Ответить на накопленные сообщения, пока бот еще может отправлять ответы, и сохранить их."""
+    metrics_server.stop()
+    if warmup_task is not None:
+        warmup_task.cancel()
+    await coalescer.drain()
+    await storage.flush()
+    profiler.stop()
+
+async def post_shutdown(application: Application) -> None:
+    """Освобождение ресурсов после остановки бота."""
+    # Дожидаемся фонового сжатия истории, сохраняем квоты пользователей,
+    # статистику использования и журнал отложенной записи и закрываем пулы соединений
+    await summarizer.close()
+    await admission.close()
+    await tracker.close()
+    await ai_service.close()
+    await storage.close()
+
+def build_application(polling: bool) -> Application:
+    """
+    Собрать приложение бота с обработчиками.
+    
+    Args:
+        polling: Приложение само получает обновления (long polling). Иначе
+            обновления передает вебхук или принимающий процесс
+    
+    Returns:
+        Приложение бота
+    """
+    # Создаем экземпляр приложения бота
+    builder = (
+        Application.builder()
+        .token(os.getenv("BOT_TOKEN"))
+        # Запросы к Bot API учитываются в метриках
+        .request(InstrumentedRequest(connection_pool_size=256))
+        # Обмены с моделью занимают те же слоты параллельной обработки, что и обновления
+        .concurrent_updates(ChatSerializedUpdateProcessor(slots=update_slots))
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if polling:
+        builder = builder.post_init(post_init)
+    else:
+        # Вебхук принимает собственный сервер вместе с метриками
+        builder = builder.updater(None)
+    application = builder.build()
+    
+    # Регистрируем обработчики команд
+    application.add_handler(CommandHandler("start", start_handler))
+    application.add_handler(CommandHandler("help", help_handler))
+    application.add_handler(CommandHandler("reset", reset_handler))
+    application.add_handler(CommandHandler("model", model_handler))
+    application.add_handler(CommandHandler("usage", usage_handler))
+    application.add_handler(CommandHandler("profile", profile_handler))
+    
+    # Обработчик для кнопок выбора модели
+    application.add_handler(CallbackQueryHandler(model_callback_handler, pattern="^model:"))
+    
+    # Регистрируем обработчик текстовых сообщений
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    startup.mark("build")
+    return application
@@ -0,0 +1,144 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+class LRUCache:
+    """Ограниченный по размеру кэш в памяти с вытеснением LRU и временем жизни записей."""
+    
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float,
+        max_bytes: int = 0,
+        sizeof: Optional[Callable[[Any], int]] = None
+    ):
+        """
+        Инициализация кэша.
+        
+        Args:
+            max_entries: Максимальное количество записей
+            ttl: Время жизни записи в секундах (0 - без ограничения)
+            max_bytes: Примерный лимит памяти в байтах (0 - без ограничения)
+            sizeof: Функция оценки размера значения в байтах
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof or (lambda value: 0)
+        # key -> (значение, момент истечения, размер)
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._bytes = 0
+        
+        # Счетчики для мониторинга эффективности кэша
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Получить значение из кэша.
+        
+        Args:
+            key: Ключ записи
+        
+        Returns:
+            Значение или None, если записи нет или она устарела
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        value, expires_at, _ = entry
+        if expires_at and expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        
+        # Помечаем запись как недавно использованную
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """
+        Получить значение без учета в статистике и без изменения порядка вытеснения.
+        
+        Args:
+            key: Ключ записи
+        
+        Returns:
+            Значение или None, если записи нет или она устарела
+        """
+        entry = self._entries.get(key)
+        if entry is None or (entry[1] and entry[1] < time.monotonic()):
+            return None
+        return entry[0]
+    
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Сохранить значение в кэше, вытесняя самые старые записи при переполнении.
+        
+        Args:
+            key: Ключ записи
+            value: Значение
+        """
+        if key in self._entries:
+            self._remove(key)
+        
+        size = self._sizeof(value)
+        # Слишком большие значения не кэшируем, чтобы не вытеснить весь кэш
+        if self.max_bytes and size > self.max_bytes:
+            return
+        
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0
+        self._entries[key] = (value, expires_at, size)
+        self._bytes += size
+        
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or (self.max_bytes and self._bytes > self.max_bytes)
+        ):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+    
+    def pop(self, key: Hashable) -> None:
+        """
+        Удалить запись из кэша.
+        
+        Args:
+            key: Ключ записи
+        """
+        if key in self._entries:
+            self._remove(key)
+    
+    def clear(self) -> None:
+        """Очистить кэш."""
+        self._entries.clear()
+        self._bytes = 0
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Получить статистику использования кэша.
+        
+        Returns:
+            Словарь со счетчиками попаданий, промахов, вытеснений и размером кэша
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+    
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def _remove(self, key: Hashable) -> None:
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
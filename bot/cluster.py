@@ -0,0 +1,414 @@
+"""
+Режим нескольких рабочих процессов.
+
+Принимающий процесс слушает вебхук и передает каждое обновление одному
+из рабочих процессов через Unix-сокет. Процесс выбирается по устойчивому
+хэшу ID пользователя: все обновления пользователя обрабатывает один процесс,
+поэтому сохраняется их порядок, а кэш истории не расходится с базой.
+
+Обновление считается обработанным, когда рабочий процесс подтвердил его
+после ответа пользователю. Неподтвержденные обновления упавшего процесса
+передаются заново перезапущенному процессу, поэтому обновление может быть
+обработано дважды, но не теряется.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import zlib
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+from telegram import Bot, Update
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as WebApplication, HTTPError, RequestHandler
+
+from bot.config import (
+    METRICS_PATH, METRICS_PORT, WORKER_SOCKET_PATH, WORKER_QUEUE_SIZE, WORKER_MAX_INFLIGHT,
+    WORKER_ENQUEUE_TIMEOUT, WORKER_RESTART_DELAY, WORKER_STOP_TIMEOUT
+)
+from bot.metrics import WORKER_EVENTS
+from bot.server import MetricsHandler, MetricsServer
+from bot.startup import startup
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Максимальный размер сообщения между процессами (одно обновление Telegram в JSON)
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+
+def routing_key(data: Dict[str, Any]) -> int:
+    """
+    ID пользователя обновления, а если его нет (посты каналов) - ID чата.
+    
+    Args:
+        data: Обновление Telegram в виде JSON
+    
+    Returns:
+        Ключ для выбора рабочего процесса
+    """
+    for name, payload in data.items():
+        if name == "update_id" or not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return data.get("update_id", 0)
+
+def shard(key: int, workers: int) -> int:
+    """Номер рабочего процесса для ключа; не зависит от запуска, в отличие от hash()."""
+    return zlib.crc32(str(key).encode()) % workers
+
+def _encode(message: Dict[str, Any]) -> bytes:
+    """Сообщение протокола: одна строка JSON."""
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+class WorkerLink:
+    """Очередь и соединение принимающего процесса с одним рабочим процессом."""
+    
+    def __init__(self, index: int, queue_size: int = WORKER_QUEUE_SIZE, max_inflight: int = WORKER_MAX_INFLIGHT):
+        """
+        Args:
+            index: Номер рабочего процесса
+            queue_size: Обновлений, ожидающих передачи процессу
+            max_inflight: Переданных и еще не подтвержденных обновлений
+        """
+        self.index = index
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        # Переданные, но не подтвержденные обновления в порядке передачи
+        self.inflight: Dict[int, Dict[str, Any]] = {}
+        self.window = asyncio.Semaphore(max_inflight)
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.connected = asyncio.Event()
+        self.disconnected = asyncio.Event()
+        self.disconnected.set()
+        self.process: Optional[multiprocessing.Process] = None
+    
+    def attach(self, writer: asyncio.StreamWriter) -> None:
+        """Принять соединение запущенного процесса и передать ему неподтвержденные обновления."""
+        self.writer = writer
+        if self.inflight:
+            WORKER_EVENTS.inc(len(self.inflight), worker=str(self.index), event="redelivered")
+            logger.warning(f"Процессу {self.index} повторно передано обновлений: {len(self.inflight)}")
+        for seq, data in self.inflight.items():
+            writer.write(_encode({"seq": seq, "update": data}))
+        self.disconnected.clear()
+        self.connected.set()
+    
+    def detach(self, writer: asyncio.StreamWriter) -> None:
+        """Отметить, что соединение с процессом закрыто."""
+        if self.writer is writer:
+            self.writer = None
+            self.connected.clear()
+            self.disconnected.set()
+    
+    def ack(self, seq: int) -> None:
+        """Отметить обновление обработанным."""
+        if self.inflight.pop(seq, None) is not None:
+            self.window.release()
+    
+    def idle(self) -> bool:
+        """Все принятые обновления обработаны."""
+        return self.queue.empty() and not self.inflight
+    
+    async def pump(self) -> None:
+        """Передавать обновления из очереди процессу, пока неподтвержденных не больше окна."""
+        while True:
+            await self.window.acquire()
+            seq, data = await self.queue.get()
+            self.inflight[seq] = data
+            # Без соединения обновление будет передано из inflight при подключении процесса
+            writer = self.writer
+            if writer is None:
+                continue
+            writer.write(_encode({"seq": seq, "update": data}))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+class WorkerPool:
+    """
+    Рабочие процессы и распределение обновлений между ними.
+    
+    Если очередь процесса заполнена дольше WORKER_ENQUEUE_TIMEOUT, обновление
+    не принимается, и вебхук отвечает Telegram ошибкой 503: Telegram повторит
+    доставку позже. Упавший процесс перезапускается, а по SIGHUP процессы
+    перезапускаются по одному, пока обновления копятся в их очередях.
+    """
+    
+    def __init__(
+        self,
+        workers: int,
+        socket_path: str = WORKER_SOCKET_PATH,
+        target: Optional[Callable[[int, str], None]] = None
+    ):
+        """
+        Args:
+            workers: Количество рабочих процессов
+            socket_path: Путь Unix-сокета, к которому подключаются процессы
+            target: Точка входа рабочего процесса (по умолчанию worker_main)
+        """
+        self.socket_path = socket_path
+        self.target = target or worker_main
+        self.links = [WorkerLink(index) for index in range(workers)]
+        self._context = multiprocessing.get_context("spawn")
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._seq = 0
+        self._stopping = False
+    
+    async def start(self) -> None:
+        """Открыть сокет и запустить рабочие процессы."""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._serve_connection, path=self.socket_path, limit=MAX_MESSAGE_BYTES)
+        for link in self.links:
+            self._spawn(link.pump())
+            self._spawn(self._supervise(link))
+        await asyncio.gather(*(link.connected.wait() for link in self.links))
+    
+    async def route(self, data: Dict[str, Any]) -> bool:
+        """
+        Поставить обновление в очередь его рабочего процесса.
+        
+        Args:
+            data: Обновление Telegram в виде JSON
+        
+        Returns:
+            False, если очередь процесса не освободилась вовремя
+        """
+        link = self.links[shard(routing_key(data), len(self.links))]
+        self._seq += 1
+        try:
+            await asyncio.wait_for(link.queue.put((self._seq, data)), WORKER_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            WORKER_EVENTS.inc(worker=str(link.index), event="rejected")
+            return False
+        WORKER_EVENTS.inc(worker=str(link.index), event="routed")
+        return True
+    
+    def request_restart(self) -> None:
+        """Начать перезапуск процессов в фоне (обработчик SIGHUP)."""
+        self._spawn(self.restart())
+    
+    async def restart(self) -> None:
+        """Перезапустить процессы по одному, не теряя обновлений."""
+        for link in self.links:
+            if link.writer is None:
+                continue
+            logger.info(f"Перезапуск рабочего процесса {link.index}")
+            link.writer.write(_encode({"stop": True}))
+            # Процесс дообработает принятые обновления и завершится, а _supervise запустит новый
+            await link.disconnected.wait()
+            await link.connected.wait()
+    
+    async def stop(self) -> None:
+        """Дождаться обработки принятых обновлений и остановить процессы."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WORKER_STOP_TIMEOUT
+        while not all(link.idle() for link in self.links) and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        
+        self._stopping = True
+        for link in self.links:
+            if link.writer is not None:
+                link.writer.write(_encode({"stop": True}))
+        await asyncio.gather(*(
+            asyncio.to_thread(link.process.join, WORKER_STOP_TIMEOUT)
+            for link in self.links if link.process is not None
+        ))
+        for link in self.links:
+            if link.process is not None and link.process.is_alive():
+                logger.warning(f"Рабочий процесс {link.index} не завершился вовремя")
+                link.process.terminate()
+            lost = link.queue.qsize() + len(link.inflight)
+            if lost:
+                logger.warning(f"Не обработано обновлений процесса {link.index}: {lost}")
+        
+        for task in self._tasks:
+            task.cancel()
+        if self._server is not None:
+            self._server.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+    
+    def _spawn(self, coroutine: Awaitable[Any]) -> None:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _supervise(self, link: WorkerLink) -> None:
+        """Запускать рабочий процесс заново, пока пул не остановлен."""
+        while not self._stopping:
+            # Номер процесса передается через окружение: настройки читаются при импорте
+            os.environ["WORKER_ID"] = str(link.index)
+            try:
+                link.process = self._context.Process(
+                    target=self.target,
+                    args=(link.index, self.socket_path),
+                    name=f"telegpt-worker-{link.index}"
+                )
+                link.process.start()
+            except Exception as e:
+                logger.error(f"Не удалось запустить рабочий процесс {link.index}: {e}")
+                await asyncio.sleep(WORKER_RESTART_DELAY)
+                continue
+            finally:
+                del os.environ["WORKER_ID"]
+            
+            await asyncio.to_thread(link.process.join)
+            if self._stopping:
+                return
+            if link.process.exitcode:
+                logger.error(f"Рабочий процесс {link.index} завершился с кодом {link.process.exitcode}, перезапускаем")
+            WORKER_EVENTS.inc(worker=str(link.index), event="restart")
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+    
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Соединение рабочего процесса: первое сообщение - его номер, затем подтверждения."""
+        hello = await reader.readline()
+        if not hello:
+            writer.close()
+            return
+        link = self.links[json.loads(hello)["worker"]]
+        link.attach(writer)
+        try:
+            while line := await reader.readline():
+                link.ack(json.loads(line)["ack"])
+        except ConnectionError:
+            pass
+        finally:
+            link.detach(writer)
+            writer.close()
+
+class RoutingWebhookHandler(RequestHandler):
+    """Принимает обновления от Telegram и передает их рабочим процессам."""
+    
+    def initialize(self, pool: WorkerPool) -> None:
+        self.pool = pool
+    
+    async def post(self) -> None:
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise HTTPError(400, reason="Некорректный JSON")
+        
+        if not await self.pool.route(data):
+            # Telegram повторит доставку, когда процессы разберут очередь
+            raise HTTPError(503, reason="Очередь обработки переполнена")
+
+async def run_cluster(port: int, webhook_url: str, workers: int) -> None:
+    """
+    Запустить принимающий процесс и рабочие процессы.
+    
+    Args:
+        port: Порт вебхука и метрик принимающего процесса
+        webhook_url: Публичный адрес вебхука
+        workers: Количество рабочих процессов
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    pool = WorkerPool(workers)
+    await pool.start()
+    startup.mark("workers")
+    loop.add_signal_handler(signal.SIGHUP, pool.request_restart)
+    
+    server = HTTPServer(WebApplication([
+        (METRICS_PATH, MetricsHandler),
+        (r"/?", RoutingWebhookHandler, {"pool": pool}),
+    ]))
+    server.listen(port, address="0.0.0.0")
+    try:
+        async with Bot(os.getenv("BOT_TOKEN")) as bot:
+            await bot.set_webhook(url=webhook_url)
+        startup.mark("webhook")
+        logger.info(f"Webhook слушает порт {port}, рабочих процессов: {workers}")
+        startup.report()
+        await stop.wait()
+    finally:
+        server.stop()
+        await pool.stop()
+
+def worker_main(index: int, socket_path: str) -> None:
+    """
+    Точка входа рабочего процесса.
+    
+    Args:
+        index: Номер процесса
+        socket_path: Unix-сокет принимающего процесса
+    """
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(
+        format=f"%(asctime)s - worker {index} - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    # Ctrl+C получает вся группа процессов, а останавливает процессы принимающий
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, socket_path))
+
+async def _run_worker(index: int, socket_path: str) -> None:
+    """Обрабатывать обновления, полученные от принимающего процесса, до команды остановки."""
+    # Обработчики загружаются только в рабочих процессах
+    from bot.application import build_application, start_warm_up
+    from bot.handlers import coalescer
+    
+    application = build_application(polling=False)
+    metrics_server = MetricsServer(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    stop = asyncio.Event()
+    # SIGTERM процессу - плавный перезапуск: он дообработает принятые обновления
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    
+    await application.initialize()
+    await application.start()
+    metrics_server.start()
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=MAX_MESSAGE_BYTES)
+    writer.write(_encode({"worker": index}))
+    startup.mark("initialize")
+    startup.report()
+    start_warm_up()
+    
+    tasks: Set[asyncio.Task] = set()
+    
+    async def process(seq: int, data: Dict[str, Any]) -> None:
+        try:
+            update = Update.de_json(data, application.bot)
+            await application.update_processor.process_update(update, application.process_update(update))
+            # Сообщения объединяются и получают ответ позже: подтверждаем после ответа
+            if update.effective_chat is not None and update.effective_user is not None:
+                await coalescer.wait_idle(update.effective_chat.id, update.effective_user.id)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке обновления {seq}: {e}", exc_info=True)
+        if not writer.is_closing():
+            writer.write(_encode({"ack": seq}))
+    
+    async def receive() -> None:
+        while line := await reader.readline():
+            message = json.loads(line)
+            if message.get("stop"):
+                return
+            task = asyncio.create_task(process(message["seq"], message["update"]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    
+    receiving = asyncio.create_task(receive())
+    stopping = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait([receiving, stopping], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        receiving.cancel()
+        stopping.cancel()
+        if tasks:
+            await asyncio.wait(list(tasks), timeout=WORKER_STOP_TIMEOUT)
+        writer.close()
+        metrics_server.stop()
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
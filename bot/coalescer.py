@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import time
+from contextlib import nullcontext
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from bot.config import COALESCE_WINDOW
+from bot.metrics import ERRORS, TURN_SECONDS
+from bot.profiling import profiler
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Обработка обмена: обновление для ответа, контекст, объединенный текст и
+# функция, которую нужно вызвать при получении первого токена ответа
+TurnRunner = Callable[[Update, ContextTypes.DEFAULT_TYPE, str, Callable[[], None]], Awaitable[Any]]
+
+# Сообщения объединяются по чату и отправителю: в группе у каждого участника своя история
+ChatKey = Tuple[int, int]
+
+class _ChatState:
+    """Состояние чата: накопленные сообщения, таймер ожидания и текущий обмен."""
+    
+    __slots__ = ("pending", "pending_since", "update", "context", "timer", "turn", "turn_texts", "turn_since", "started")
+    
+    def __init__(self):
+        self.pending: List[str] = []
+        # Время получения первого из ожидающих сообщений
+        self.pending_since = 0.0
+        self.update: Optional[Update] = None
+        self.context: Optional[ContextTypes.DEFAULT_TYPE] = None
+        self.timer: Optional[asyncio.Task] = None
+        self.turn: Optional[asyncio.Task] = None
+        self.turn_texts: List[str] = []
+        self.turn_since = 0.0
+        self.started = False
+
+class MessageCoalescer:
+    """
+    Объединение быстро идущих подряд сообщений одного пользователя в чате в один запрос.
+    
+    Сообщения, пришедшие с интервалом меньше COALESCE_WINDOW, отправляются
+    модели одним обменом. Если новое сообщение пришло, когда запрос уже
+    отправлен, но первый токен ответа еще не получен, запрос отменяется и
+    повторяется с объединенным текстом. Если ответ уже начал выводиться,
+    новые сообщения ждут его завершения и уходят следующим обменом.
+    
+    Состояние хранится по паре (чат, пользователь): история диалога своя
+    у каждого пользователя, поэтому сообщения разных участников группы
+    не объединяются.
+    
+    Обмен выполняется отдельной задачей уже после того, как обработчик
+    сообщения вернул управление диспетчеру, поэтому он занимает слот из slots
+    на время запроса к модели: общий лимит параллельной обработки действует
+    и на обмены. Очередь обменов одного пользователя в чате соблюдает сам
+    объединитель: следующий обмен начинается только после предыдущего.
+    """
+    
+    def __init__(self, run_turn: TurnRunner, window: float = COALESCE_WINDOW, slots: Optional[asyncio.Semaphore] = None):
+        """
+        Args:
+            run_turn: Функция обработки одного обмена
+            window: Время ожидания следующего сообщения в секундах
+            slots: Слоты параллельной обработки, общие с диспетчером (None - без ограничения)
+        """
+        self.run_turn = run_turn
+        self.window = window
+        self.slots = slots
+        self._chats: Dict[ChatKey, _ChatState] = {}
+        
+        # Статистика для оценки эффекта
+        self.messages = 0
+        self.turns = 0
+        self.cancelled = 0
+    
+    def submit(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Принять сообщение пользователя.
+        
+        Args:
+            update: Обновление с текстовым сообщением
+            context: Контекст обработчика
+        """
+        key = (update.effective_chat.id, update.effective_user.id)
+        state = self._chats.get(key)
+        if state is None:
+            state = self._chats[key] = _ChatState()
+        
+        self.messages += 1
+        if not state.pending:
+            state.pending_since = time.monotonic()
+        state.pending.append(update.message.text)
+        # Отвечаем на последнее сообщение серии
+        state.update = update
+        state.context = context
+        
+        if state.turn is not None:
+            if state.started:
+                # Ответ уже выводится - сообщение уйдет следующим обменом
+                return
+            # Первый токен еще не получен - начинаем заново с объединенным текстом
+            self.cancelled += 1
+            state.turn.cancel()
+            state.pending = state.turn_texts + state.pending
+            state.pending_since = state.turn_since
+            state.turn = None
+            state.turn_texts = []
+        
+        self._restart_timer(key, state)
+    
+    async def cancel(self, chat_id: int, user_id: int) -> None:
+        """
+        Отменить накопленные сообщения пользователя в чате (например, при сбросе истории).
+        
+        Обмен, который еще не получил первый токен, отменяется. Если ответ уже
+        выводится, дожидаемся его сохранения, чтобы он не попал в историю
+        после сброса.
+        
+        Args:
+            chat_id: ID чата
+            user_id: ID пользователя
+        """
+        state = self._chats.pop((chat_id, user_id), None)
+        if state is None:
+            return
+        state.pending = []
+        if state.timer is not None:
+            state.timer.cancel()
+            state.timer = None
+        if state.turn is not None:
+            if not state.started:
+                self.cancelled += 1
+                state.turn.cancel()
+            await asyncio.gather(state.turn, return_exceptions=True)
+    
+    async def wait_idle(self, chat_id: int, user_id: int) -> None:
+        """
+        Дождаться, пока у пользователя в чате не останется накопленных сообщений и выполняемых обменов.
+        
+        Args:
+            chat_id: ID чата
+            user_id: ID пользователя
+        """
+        while True:
+            state = self._chats.get((chat_id, user_id))
+            tasks = [task for task in (state.timer, state.turn) if task is not None] if state is not None else []
+            if not tasks:
+                return
+            await asyncio.wait(tasks)
+    
+    async def drain(self) -> None:
+        """Немедленно обработать накопленные сообщения и дождаться всех обменов."""
+        while self._chats:
+            for key, state in list(self._chats.items()):
+                if state.timer is not None:
+                    state.timer.cancel()
+                    state.timer = None
+                    if state.turn is None:
+                        self._start_turn(key, state)
+            turns = [state.turn for state in self._chats.values() if state.turn is not None]
+            if not turns:
+                break
+            await asyncio.gather(*turns, return_exceptions=True)
+    
+    def stats(self) -> Dict[str, int]:
+        """Количество принятых сообщений, выполненных и отмененных обменов."""
+        return {"messages": self.messages, "turns": self.turns, "cancelled": self.cancelled}
+    
+    def _restart_timer(self, key: ChatKey, state: _ChatState) -> None:
+        if state.timer is not None:
+            state.timer.cancel()
+        state.timer = asyncio.create_task(self._wait_and_start(key, state))
+    
+    async def _wait_and_start(self, key: ChatKey, state: _ChatState) -> None:
+        await asyncio.sleep(self.window)
+        state.timer = None
+        self._start_turn(key, state)
+    
+    def _start_turn(self, key: ChatKey, state: _ChatState) -> None:
+        state.turn_texts = state.pending
+        state.turn_since = state.pending_since
+        state.pending = []
+        state.started = False
+        state.turn = asyncio.create_task(self._run(key, state, "\n".join(state.turn_texts)))
+        self.turns += 1
+    
+    async def _run(self, key: ChatKey, state: _ChatState, text: str) -> None:
+        """Выполнить обмен и запустить следующий, если за это время пришли новые сообщения."""
+        chat_id = key[0]
+        task = asyncio.current_task()
+        
+        def on_first_token() -> None:
+            if state.turn is task:
+                state.started = True
+        
+        status = "ok"
+        try:
+            with profiler.trace(f"turn {chat_id}"):
+                # Обмен, ждущий слота, еще не получил первый токен и может быть отменен
+                async with self.slots if self.slots is not None else nullcontext():
+                    await self.run_turn(state.update, state.context, text, on_first_token)
+        except asyncio.CancelledError:
+            # Обмен заменен новым с объединенным текстом
+            status = "cancelled"
+        except Exception as e:
+            status = "error"
+            ERRORS.inc(type=type(e).__name__)
+            logger.error(f"Ошибка при обработке сообщения в чате {chat_id}: {str(e)}", exc_info=True)
+        finally:
+            if status != "cancelled":
+                # Отмененный обмен будет учтен вместе с тем, что его заменил
+                TURN_SECONDS.observe(time.monotonic() - state.turn_since, status=status)
+            if state.turn is task:
+                state.turn = None
+                state.turn_texts = []
+                if state.pending:
+                    self._restart_timer(key, state)
+                elif state.timer is None and self._chats.get(key) is state:
+                    # Пользователь в чате простаивает - состояние больше не нужно
+                    del self._chats[key]
@@ -4,6 +4,48 @@ import os
 PORT = int(os.getenv("PORT", 5000))
 WEBHOOK_URL = os.getenv("APP_LINK") if os.getenv("APP_LINK") else None
 
+# Метрики в формате Prometheus: в режиме webhook отдаются на порту PORT,
+# в режиме polling - на отдельном порту METRICS_PORT (0 - не запускать)
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9090))
+
+# Прогрев после запуска: подключение к базе и провайдерам, загрузка токенизатора.
+# Выполняется в фоне и не задерживает прием сообщений. Токенизатор загружается
+# в фоне и без этой настройки
+WARMUP = os.getenv("WARMUP", "false").lower() == "true"
+
+# Профилирование (включается и командой /profile без перезапуска): задержка цикла событий
+# и стек блокирующего вызова, этапы обработки каждого обновления и выборочное
+# профилирование стеков доли PROFILE_SAMPLE_RATE обменов. Для обменов дольше
+# PROFILE_SLOW_THRESHOLD секунд этапы пишутся в лог, а стеки - в файл для flamegraph
+PROFILING = os.getenv("PROFILING", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.01))  # Доля обменов, стеки которых собираются
+PROFILE_SLOW_THRESHOLD = float(os.getenv("PROFILE_SLOW_THRESHOLD", 10.0))  # Время обработки, после которого она считается медленной
+PROFILE_INTERVAL_MS = int(os.getenv("PROFILE_INTERVAL_MS", 10))  # Период снятия стеков
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")  # Каталог файлов стеков
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 100))  # Сколько последних файлов стеков хранить
+LOOP_LAG_THRESHOLD = int(os.getenv("LOOP_LAG_THRESHOLD_MS", 100)) / 1000  # Блокировка цикла событий, о которой сообщается в лог
+
+# Параллельная обработка обновлений: разные чаты обрабатываются одновременно,
+# обновления одного чата - строго по очереди
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 64))  # Одновременно обрабатываемых обновлений и обменов с моделью
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", 1024))  # Обновлений в обработке и в очереди своего чата
+
+# Несколько рабочих процессов (только webhook): принимающий процесс распределяет
+# обновления между WORKERS процессами по ID пользователя. Общие лимиты Telegram
+# и провайдеров делятся между процессами поровну
+WORKERS = max(1, int(os.getenv("WORKERS", 1)))
+WORKER_ID = os.getenv("WORKER_ID", "")  # Номер рабочего процесса, задается принимающим процессом
+# Между сколькими процессами делятся лимиты: WORKER_ID есть только у процессов кластера,
+# а одиночный процесс (polling или WORKERS=1) пользуется лимитами целиком
+LIMIT_SHARES = WORKERS if WORKER_ID else 1
+WORKER_SOCKET_PATH = os.getenv("WORKER_SOCKET_PATH", "/tmp/telegpt-workers.sock")  # Unix-сокет для связи с процессами
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 1000))  # Обновлений в очереди каждого процесса
+WORKER_MAX_INFLIGHT = int(os.getenv("WORKER_MAX_INFLIGHT", 1024))  # Переданных процессу и еще не обработанных обновлений
+WORKER_ENQUEUE_TIMEOUT = float(os.getenv("WORKER_ENQUEUE_TIMEOUT", 5.0))  # Ожидание места в очереди, затем вебхук отвечает 503
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", 1.0))  # Пауза перед перезапуском упавшего процесса
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", 30.0))  # Ожидание обработки принятых обновлений при остановке
+
 # Настройки моделей
 DEFAULT_MODEL = "gpt-4o"
 AVAILABLE_MODELS = {
@@ -14,9 +56,184 @@ AVAILABLE_MODELS = {
 }
 
 # Лимиты и настройки контекста
-MAX_HISTORY_LENGTH = 10  # Максимальное количество сообщений в истории
+MAX_HISTORY_LENGTH = int(os.getenv("MAX_HISTORY_LENGTH", 50))  # Максимальное количество обменов, хранимых в истории
 MAX_TOKENS = 1000  # Максимальное количество токенов на ответ
 
+# Бюджет токенов контекста (запрос вместе с ответом) для каждой модели.
+# Старые сообщения отбрасываются, пока запрос и MAX_TOKENS ответа не уложатся в бюджет
+MODEL_CONTEXT_BUDGETS = {
+    "gpt-4o": int(os.getenv("GPT4O_CONTEXT_BUDGET", 16000)),
+    "gpt-3.5-turbo": int(os.getenv("GPT35_CONTEXT_BUDGET", 12000)),
+    "claude-3-5-sonnet": int(os.getenv("CLAUDE35_CONTEXT_BUDGET", 16000)),
+    "claude-3-7-sonnet": int(os.getenv("CLAUDE37_CONTEXT_BUDGET", 16000)),
+    "default": 8000,
+}
+
+# Сжатие старой истории: самые старые сообщения заменяются кратким содержанием,
+# которое готовит дешевая модель в фоне, не задерживая ответ пользователю
+SUMMARY_ENABLED = os.getenv("HISTORY_SUMMARY", "false").lower() == "true"
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-3.5-turbo")  # Модель для составления краткого содержания
+SUMMARY_THRESHOLD = int(os.getenv("SUMMARY_THRESHOLD", 30))  # Сообщений (без системных), после которых история сжимается
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", 10))  # Последних сообщений, которые остаются без изменений
+SUMMARY_PROMPT = (
+    "Составь краткое содержание диалога пользователя с ассистентом. Сохрани факты о пользователе, "
+    "его цели, принятые решения и важные детали, которые понадобятся для продолжения разговора. "
+    "Пиши сжато, от третьего лица, без вступлений."
+)
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога:\n"
+
+# Хранилище данных пользователей: mongo (MongoDB) или sqlite (встроенная база для одного узла)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "telegpt.db")  # Файл базы SQLite
+
+# Отложенная запись истории: новые сообщения сохраняются в базу фоновыми пакетами,
+# а не во время ответа пользователю
+STORAGE_WRITE_BEHIND = os.getenv("STORAGE_WRITE_BEHIND", "false").lower() == "true"
+STORAGE_FLUSH_INTERVAL = int(os.getenv("STORAGE_FLUSH_INTERVAL_MS", 200)) / 1000  # Максимальная задержка сохранения
+STORAGE_FLUSH_OPS = int(os.getenv("STORAGE_FLUSH_OPS", 100))  # Записей, после которых пакет сохраняется сразу
+STORAGE_JOURNAL_PATH = os.getenv("STORAGE_JOURNAL_PATH", "")  # Файл журнала для восстановления после сбоя (пусто - не вести)
+if STORAGE_JOURNAL_PATH and WORKER_ID:
+    # У каждого рабочего процесса свой журнал
+    STORAGE_JOURNAL_PATH = f"{STORAGE_JOURNAL_PATH}.{WORKER_ID}"
+
+# Настройки подключения к MongoDB
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))  # Максимум соединений в пуле
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))  # Минимум постоянно открытых соединений
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 60000))  # Время жизни простаивающего соединения
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS", 5000))  # Таймаут выбора сервера и подключения
+
+# Кэш данных пользователей в памяти процесса
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", 10000))  # Максимум пользователей в кэше
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 600))  # Время жизни записи в секундах
+USER_CACHE_MAX_BYTES = int(os.getenv("USER_CACHE_MAX_BYTES", 64 * 1024 * 1024))  # Примерный лимит памяти кэша
+
+# Пулы HTTP-соединений с API провайдеров
+PROVIDER_MAX_CONNECTIONS = int(os.getenv("PROVIDER_MAX_CONNECTIONS", 100))  # Максимум одновременных соединений
+PROVIDER_MAX_KEEPALIVE = int(os.getenv("PROVIDER_MAX_KEEPALIVE", 20))  # Соединений, удерживаемых открытыми
+PROVIDER_KEEPALIVE_EXPIRY = float(os.getenv("PROVIDER_KEEPALIVE_EXPIRY", 60))  # Время жизни простаивающего соединения
+PROVIDER_TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", 60))  # Общий таймаут запроса в секундах
+PROVIDER_CONNECT_TIMEOUT = float(os.getenv("PROVIDER_CONNECT_TIMEOUT", 5))  # Таймаут установки соединения
+
+# Потоковая выдача ответов
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() == "true"  # Показывать ответ по мере генерации
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))  # Минимальный интервал между правками сообщения
+STREAM_PLACEHOLDER = "…"  # Текст сообщения до появления первых токенов
+
+# Лимиты отправки сообщений в Telegram: всего, в личный чат и в группу
+TELEGRAM_MESSAGES_PER_SECOND = float(os.getenv("TELEGRAM_MESSAGES_PER_SECOND", 30))
+TELEGRAM_CHAT_MESSAGES_PER_SECOND = float(os.getenv("TELEGRAM_CHAT_MESSAGES_PER_SECOND", 1))
+TELEGRAM_GROUP_MESSAGES_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_MESSAGES_PER_MINUTE", 20))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", 3))  # Сообщений, которые можно отправить в чат подряд без пауз
+TELEGRAM_SEND_ATTEMPTS = int(os.getenv("TELEGRAM_SEND_ATTEMPTS", 3))  # Попыток отправки при ограничении частоты (flood wait)
+TYPING_INTERVAL = 4.0  # Индикатор набора текста держится 5 секунд, чаще его обновлять незачем
+
+# Объединение быстро идущих подряд сообщений одного чата в один запрос
+COALESCE_WINDOW = int(os.getenv("COALESCE_WINDOW_MS", 700)) / 1000  # Ожидание следующего сообщения (0 - без ожидания)
+
+# Лимиты запросов к провайдерам: запросов в минуту, токенов в минуту и одновременных запросов
+PROVIDER_LIMITS = {
+    "openai": {
+        "rpm": int(os.getenv("OPENAI_RPM", 500)),
+        "tpm": int(os.getenv("OPENAI_TPM", 300000)),
+        "max_concurrency": int(os.getenv("OPENAI_MAX_CONCURRENCY", 32)),
+    },
+    "anthropic": {
+        "rpm": int(os.getenv("ANTHROPIC_RPM", 50)),
+        "tpm": int(os.getenv("ANTHROPIC_TPM", 40000)),
+        "max_concurrency": int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", 16)),
+    },
+}
+
+# Кэш ответов на одинаковые запросы (включается для отдельных моделей)
+RESPONSE_CACHE_MODELS = {
+    model.strip() for model in os.getenv("RESPONSE_CACHE_MODELS", "").split(",") if model.strip()
+}  # Например: gpt-4o,gpt-3.5-turbo
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1000))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 3600))  # Время жизни ответа в секундах
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+
+# Кэширование неизменной части запроса на стороне Anthropic (системное сообщение и история)
+ANTHROPIC_PROMPT_CACHING = os.getenv("ANTHROPIC_PROMPT_CACHING", "true").lower() == "true"
+
+# Повторы запросов при временных ошибках провайдера
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", 3))  # Всего попыток к одной модели
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 1.0))  # Базовая задержка экспоненциальной паузы
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 20.0))  # Максимальная пауза между попытками
+
+# Автоматический выключатель: после серии сбоев провайдер временно считается недоступным
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))  # Сбоев подряд до размыкания
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30.0))  # Секунд до пробного запроса
+
+# Резервные модели другого провайдера на случай его недоступности
+MODEL_FALLBACK_ENABLED = os.getenv("MODEL_FALLBACK", "false").lower() == "true"
+FALLBACK_MODELS = {
+    "gpt-4o": "claude-3-5-sonnet",
+    "gpt-3.5-turbo": "claude-3-5-sonnet",
+    "claude-3-5-sonnet": "gpt-4o",
+    "claude-3-7-sonnet": "gpt-4o",
+}
+
+# Дублирующие запросы (hedging): если модель отвечает дольше обычного для нее времени
+# (перцентиль HEDGE_PERCENTILE недавних запросов), отправляется второй такой же запрос,
+# используется ответ, пришедший первым, а второй запрос отменяется
+HEDGE_MODELS = {
+    model.strip() for model in os.getenv("HEDGE_MODELS", "").split(",") if model.strip()
+}  # Например: gpt-4o,claude-3-5-sonnet
+HEDGE_SIBLINGS = dict(
+    pair.strip().split(":", 1) for pair in os.getenv("HEDGE_SIBLINGS", "").split(",") if ":" in pair
+)  # Модель для дублирующего запроса, если не та же самая. Например: claude-3-7-sonnet:claude-3-5-sonnet
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))  # Перцентиль задержки, после которого запрос дублируется
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", 200))  # Недавних замеров задержки каждой модели
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20))  # Замеров, после которых начинается дублирование
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 1.0))  # Минимальное ожидание перед дублированием, с
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", 0.05))  # Доля запросов, которые можно дублировать
+HEDGE_BUDGET_BURST = float(os.getenv("HEDGE_BUDGET_BURST", 10))  # Запас дублирований, накопленный в спокойное время
+
+# Контроль допуска запросов к моделям. Если в процессе уже выполняется или ждет
+# очереди провайдера ADMISSION_MAX_PENDING запросов, новый запрос сразу получает
+# ответ "попробуйте позже", а не встает в очередь. Модели разделены по приоритету:
+# запрос к модели принимается, пока занято меньше ее доли лимита, поэтому при
+# перегрузке первыми отклоняются запросы к дорогим моделям, а быстрые продолжают работать
+ADMISSION_MAX_PENDING = int(os.getenv("ADMISSION_MAX_PENDING", 256))  # 0 - без ограничения
+ADMISSION_MODEL_SHARES = {
+    "gpt-4o": float(os.getenv("GPT4O_ADMISSION_SHARE", 0.75)),
+    "gpt-3.5-turbo": float(os.getenv("GPT35_ADMISSION_SHARE", 1.0)),
+    "claude-3-5-sonnet": float(os.getenv("CLAUDE35_ADMISSION_SHARE", 0.75)),
+    "claude-3-7-sonnet": float(os.getenv("CLAUDE37_ADMISSION_SHARE", 0.75)),
+    "default": 1.0,
+}
+ADMISSION_BACKGROUND_SHARE = float(os.getenv("ADMISSION_BACKGROUND_SHARE", 0.5))  # Доля для фоновых запросов (сжатие истории)
+
+# Квоты пользователя в скользящем окне: запросов и токенов (запрос и ответ) за USER_QUOTA_WINDOW секунд.
+# Квоты хранятся в памяти процесса и периодически сохраняются в хранилище
+USER_QUOTA_WINDOW = int(os.getenv("USER_QUOTA_WINDOW", 3600))
+USER_REQUEST_QUOTA = int(os.getenv("USER_REQUEST_QUOTA", 0))  # 0 - без ограничения
+USER_TOKEN_QUOTA = int(os.getenv("USER_TOKEN_QUOTA", 0))  # 0 - без ограничения
+USER_QUOTA_SAVE_INTERVAL = float(os.getenv("USER_QUOTA_SAVE_INTERVAL", 30))  # Период сохранения квот в секундах
+
+# Цены моделей в долларах за миллион токенов запроса и ответа для отчета о расходах
+MODEL_PRICES = {
+    "gpt-4o": {"prompt": 2.5, "completion": 10.0},
+    "gpt-3.5-turbo": {"prompt": 0.5, "completion": 1.5},
+    "claude-3-5-sonnet": {"prompt": 3.0, "completion": 15.0},
+    "claude-3-7-sonnet": {"prompt": 3.0, "completion": 15.0},
+}
+
+# Статистика использования моделей копится в памяти по пользователям, моделям и часам
+# и сохраняется в хранилище пакетом раз в USAGE_FLUSH_INTERVAL секунд
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", 60))
+
+# Администраторы бота: ID пользователей Telegram через запятую, им доступна команда /usage
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+
+# Дополнительные лимиты отдельных моделей (0 - без ограничения сверх лимита провайдера)
+MODEL_LIMITS = {
+    "gpt-4o": {"rpm": 0, "tpm": 0},
+    "gpt-3.5-turbo": {"rpm": 0, "tpm": 0},
+    "claude-3-5-sonnet": {"rpm": 0, "tpm": 0},
+    "claude-3-7-sonnet": {"rpm": 0, "tpm": 0},
+}
+
 # Системные сообщения для разных моделей
 SYSTEM_MESSAGES = {
     "gpt-4o": "Вы - полезный и дружелюбный ассистент, встроенный в Telegram бота.",
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from bot.config import MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES
+from bot.metrics import UPDATE_SECONDS
+from bot.profiling import profiler
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Слоты параллельной обработки. Обмены с моделью после объединения сообщений
+# выполняются отдельными задачами и занимают те же слоты, что и обновления
+update_slots = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+
+class _ChatLock:
+    """Блокировка чата и число обновлений, которые ее держат или ждут."""
+    
+    __slots__ = ("lock", "users")
+    
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+class ChatSerializedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обработчик обновлений: разные чаты параллельно, один чат строго по очереди.
+    
+    Обработка сообщения читает и дополняет историю пользователя, поэтому
+    обновления одного чата выполняются последовательно в порядке поступления.
+    Обновления, ждущие своего чата, не занимают слоты параллельной обработки,
+    так что один активный чат не задерживает остальные. Блокировка чата
+    удаляется, как только у него не остается обновлений.
+    """
+    
+    def __init__(
+        self,
+        max_concurrent_updates: int = MAX_CONCURRENT_UPDATES,
+        max_pending_updates: int = MAX_PENDING_UPDATES,
+        slots: Optional[asyncio.Semaphore] = None
+    ):
+        """
+        Args:
+            max_concurrent_updates: Максимум одновременно обрабатываемых обновлений
+            max_pending_updates: Максимум обновлений в обработке и ожидании своего чата
+            slots: Общие слоты параллельной обработки на max_concurrent_updates мест
+                (по умолчанию собственные)
+        """
+        # Базовый класс ограничивает все принятые обновления, включая ждущие свой чат
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.max_running_updates = max_concurrent_updates
+        self._running = slots if slots is not None else asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks: Dict[int, _ChatLock] = {}
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """
+        Обработать обновление после завершения предыдущих обновлений того же чата.
+        
+        Args:
+            update: Обновление Telegram
+            coroutine: Корутина обработки обновления
+        """
+        # Время считаем вместе с ожиданием предыдущих обновлений чата
+        update_type = self._update_type(update)
+        with UPDATE_SECONDS.time(type=update_type), profiler.trace(f"{update_type} {self._chat_id(update)}"):
+            await self._process_in_order(update, coroutine)
+    
+    async def _process_in_order(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat_id = self._chat_id(update)
+        if chat_id is None:
+            async with self._running:
+                await coroutine
+            return
+        
+        chat_lock = self._chat_locks.get(chat_id)
+        if chat_lock is None:
+            chat_lock = self._chat_locks[chat_id] = _ChatLock()
+        chat_lock.users += 1
+        try:
+            async with chat_lock.lock:
+                async with self._running:
+                    await coroutine
+        finally:
+            chat_lock.users -= 1
+            if not chat_lock.users:
+                # У чата больше нет обновлений - блокировка не нужна
+                del self._chat_locks[chat_id]
+    
+    @staticmethod
+    def _chat_id(update: object) -> Optional[int]:
+        """ID чата обновления или None для обновлений без чата."""
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+    
+    @staticmethod
+    def _update_type(update: object) -> str:
+        """Тип обновления для метрик."""
+        if isinstance(update, Update):
+            if update.message and update.message.text and update.message.text.startswith("/"):
+                return "command"
+            if update.message:
+                return "message"
+            if update.callback_query:
+                return "callback_query"
+        return "other"
+    
+    def active_chats(self) -> int:
+        """Количество чатов с обновлениями в обработке или в ожидании."""
+        return len(self._chat_locks)
+    
+    async def initialize(self) -> None:
+        """Ресурсы создаются в конструкторе, дополнительная инициализация не нужна."""
+    
+    async def shutdown(self) -> None:
+        """Незавершенные обновления дожидается само приложение, освобождать нечего."""
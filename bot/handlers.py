@@ -1,49 +1,61 @@
+import asyncio
 import logging
+from typing import Callable
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CallbackQueryHandler, CommandHandler, MessageHandler, filters
 from telegram.constants import ParseMode
 
-from bot.storage import storage
-from bot.config import WELCOME_MESSAGE, HELP_MESSAGE, MODEL_HELP_MESSAGE, AVAILABLE_MODELS, SYSTEM_MESSAGES
+from bot.coalescer import MessageCoalescer
+from bot.dispatcher import update_slots
+from bot.profiling import profiler
+from bot.sender import sender
+from bot.storage import storage, ConversationTurn
+from bot.streaming import StreamingReply
+from bot.summarizer import summarizer
+from bot.config import WELCOME_MESSAGE, HELP_MESSAGE, MODEL_HELP_MESSAGE, AVAILABLE_MODELS, STREAM_RESPONSES, ADMIN_IDS
 from services.ai_service import get_completion
+from services.errors import CompletionError
+from services.usage import format_report, tracker
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+# Максимальный период отчета /usage в часах
+MAX_USAGE_REPORT_HOURS = 24 * 31
+
+# Ответ на случай, если модель вернула пустой ответ
+ERROR_MESSAGE = "Извините, произошла ошибка. Пожалуйста, попробуйте еще раз или используйте команду /reset."
+
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start."""
     user = update.effective_user
     user_id = user.id
     
-    # Сбрасываем историю диалога
-    storage.reset_messages(user_id)
-    
-    # Добавляем системное сообщение в историю
-    model = storage.get_model(user_id)
-    storage.add_message(user_id, "system", SYSTEM_MESSAGES[model])
+    # Отменяем еще не отправленные модели сообщения и сбрасываем историю диалога
+    await coalescer.cancel(update.effective_chat.id, user_id)
+    await storage.reset_messages(user_id)
     
     # Отправляем приветственное сообщение
-    await update.message.reply_text(
+    await sender.reply(
+        update.message,
         WELCOME_MESSAGE.format(user.first_name),
         parse_mode=ParseMode.MARKDOWN
     )
 
 async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /help."""
-    await update.message.reply_text(HELP_MESSAGE)
+    await sender.reply(update.message, HELP_MESSAGE)
 
 async def reset_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /reset."""
     user_id = update.effective_user.id
     
-    # Сбрасываем историю диалога
-    storage.reset_messages(user_id)
-    
-    # Добавляем системное сообщение в историю
-    model = storage.get_model(user_id)
-    storage.add_message(user_id, "system", SYSTEM_MESSAGES[model])
+    # Отменяем еще не отправленные модели сообщения и сбрасываем историю диалога
+    await coalescer.cancel(update.effective_chat.id, user_id)
+    await storage.reset_messages(user_id)
     
-    await update.message.reply_text(
+    await sender.reply(
+        update.message,
         "История диалога сброшена. Теперь мы можем начать новый разговор!"
     )
 
@@ -63,7 +75,8 @@ async def model_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     # Отправляем сообщение с кнопками
-    await update.message.reply_text(
+    await sender.reply(
+        update.message,
         "Выберите модель ИИ для общения:",
         reply_markup=reply_markup
     )
@@ -87,15 +100,10 @@ async def model_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text(f"Модель '{model_key}' не найдена.")
         return
     
-    # Устанавливаем новую модель
+    # Устанавливаем новую модель и сбрасываем историю диалога одной записью
     model = AVAILABLE_MODELS[model_key]
-    storage.set_model(user_id, model)
-    
-    # Сбрасываем историю диалога при смене модели
-    storage.reset_messages(user_id)
-    
-    # Добавляем системное сообщение для новой модели
-    storage.add_message(user_id, "system", SYSTEM_MESSAGES[model])
+    await coalescer.cancel(update.effective_chat.id, user_id)
+    await storage.reset_messages(user_id, model=model)
     
     # Отображаем название выбранной модели
     model_display_names = {
@@ -111,37 +119,142 @@ async def model_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         f"Вы выбрали модель: {display_name}. История диалога сброшена."
     )
 
-async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик текстовых сообщений."""
-    user_id = update.effective_user.id
-    user_message = update.message.text
+async def usage_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /usage [часов] - отчет администратору о токенах, скорости и стоимости запросов."""
+    if update.effective_user.id not in ADMIN_IDS:
+        # Для остальных пользователей команды нет
+        return
+    
+    hours = 24
+    if context.args:
+        try:
+            hours = min(MAX_USAGE_REPORT_HOURS, max(1, int(context.args[0])))
+        except ValueError:
+            await sender.reply(update.message, "Укажите период в часах, например: /usage 24")
+            return
+    
+    try:
+        report = await tracker.report(hours)
+    except Exception as e:
+        # Отчет читается из базы, ошибка которой не должна оставить команду без ответа
+        logger.error(f"Не удалось построить отчет об использовании: {str(e)}", exc_info=True)
+        await sender.reply(update.message, ERROR_MESSAGE)
+        return
+    await sender.reply(update.message, format_report(report))
+
+async def profile_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /profile [on|off|доля] - включение профилирования администратором без перезапуска."""
+    if update.effective_user.id not in ADMIN_IDS:
+        # Для остальных пользователей команды нет
+        return
+    
+    if context.args:
+        argument = context.args[0].lower()
+        if argument in ("on", "off"):
+            profiler.configure(enabled=argument == "on")
+        else:
+            try:
+                # Доля задается числом (0.01) или в процентах (1%)
+                rate = float(argument[:-1]) / 100 if argument.endswith("%") else float(argument)
+            except ValueError:
+                await sender.reply(update.message, "Укажите on, off или долю обновлений со стеками, например: /profile 0.01")
+                return
+            profiler.configure(enabled=True, sample_rate=rate)
     
-    # Отправляем индикатор набора текста
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+    status = profiler.status()
+    await sender.reply(
+        update.message,
+        f"Профилирование {'включено' if status['enabled'] else 'выключено'}.\n"
+        f"Стеки снимаются для {status['sample_rate']:.2%} обновлений, "
+        f"сохраняются в {status['directory']} для обработки дольше {status['slow_threshold']:.0f} с.\n"
+        f"В лог пишутся блокировки цикла событий дольше {status['lag_threshold'] * 1000:.0f} мс."
+    )
+
+async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик текстовых сообщений: быстро идущие подряд сообщения объединяются в один запрос."""
+    coalescer.submit(update, context)
+
+async def _run_turn(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    user_message: str,
+    on_first_token: Callable[[], None]
+) -> None:
+    """
+    Получить и отправить ответ модели на одно или несколько объединенных сообщений.
     
-    # Сохраняем сообщение пользователя
-    storage.add_message(user_id, "user", user_message)
+    Args:
+        update: Последнее из объединенных обновлений, на него отправляется ответ
+        context: Контекст обработчика
+        user_message: Объединенный текст сообщений пользователя
+        on_first_token: Вызывается при получении первого токена ответа, после чего обмен больше не отменяется
+    """
+    user_id = update.effective_user.id
     
-    # Получаем модель пользователя
-    model = storage.get_model(user_id)
+    # Отправляем индикатор набора текста, если он еще не показан
+    await sender.send_chat_action(context.bot, update.effective_chat.id)
     
-    # Получаем историю сообщений
-    messages = storage.get_messages(user_id)
+    # Получаем модель и историю одним чтением
+    turn = await storage.begin_turn(user_id, user_message)
     
     # Логируем информацию о запросе
-    logger.info(f"Пользователь {user_id} отправил сообщение, используя модель {model}")
+    logger.info(f"Пользователь {user_id} отправил сообщение, используя модель {turn.model}")
+    
+    if STREAM_RESPONSES:
+        await _stream_reply(update, turn, on_first_token)
+        return
     
     # Получаем ответ от соответствующего API
-    response = await get_completion(messages, model)
+    try:
+        response = await get_completion(turn.messages, turn.model, user_id=user_id)
+    except CompletionError as e:
+        # Ошибку показываем пользователю, но не сохраняем в историю
+        on_first_token()
+        await sender.reply(update.message, e.user_message)
+        return
+    on_first_token()
     
     if response:
-        # Сохраняем ответ модели в историю
-        storage.add_message(user_id, "assistant", response)
+        # Сохраняем сообщение пользователя и ответ модели одной записью
+        await storage.commit_turn(turn, response)
+        summarizer.schedule(turn)
         
         # Отправляем ответ пользователю
-        await update.message.reply_text(response)
+        await sender.reply(update.message, response)
     else:
         # Если получили пустой ответ (что не должно происходить, но на всякий случай)
-        await update.message.reply_text(
-            "Извините, произошла ошибка. Пожалуйста, попробуйте еще раз или используйте команду /reset."
-        )
\ No newline at end of file
+        await sender.reply(update.message, ERROR_MESSAGE)
+
+async def _stream_reply(update: Update, turn: ConversationTurn, on_first_token: Callable[[], None]) -> None:
+    """Показывать ответ модели по мере генерации, дописывая одно сообщение."""
+    reply = StreamingReply(update.message)
+    await reply.start()
+    
+    response = ""
+    try:
+        async for delta in await get_completion(turn.messages, turn.model, stream=True, user_id=turn.user_id):
+            if not response:
+                on_first_token()
+            response += delta
+            await reply.update(response)
+    except CompletionError as e:
+        # Оборванный ответ и ошибку показываем, но в историю не сохраняем
+        on_first_token()
+        await reply.finish(f"{response}\n\n{e.user_message}" if response else e.user_message)
+        return
+    except asyncio.CancelledError:
+        # Запрос заменен новым с объединенным текстом - убираем заглушку
+        await reply.discard()
+        raise
+    on_first_token()
+    
+    if response:
+        # Сохраняем полный ответ только после завершения генерации
+        await storage.commit_turn(turn, response)
+        summarizer.schedule(turn)
+        await reply.finish(response)
+    else:
+        await reply.finish(ERROR_MESSAGE)
+
+# Объединение сообщений, пришедших подряд от одного пользователя в чате
+coalescer = MessageCoalescer(_run_turn, slots=update_slots)
@@ -0,0 +1,200 @@
+import asyncio
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# Границы корзин гистограмм задержки в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Тип содержимого текстового формата Prometheus
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class _Metric:
+    """Общая часть метрик: имя, описание и набор меток."""
+    
+    type_name = ""
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """
+        Args:
+            name: Имя метрики
+            documentation: Описание для строки HELP
+            labelnames: Имена меток
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.append(self)
+    
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def _format_labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+    
+    def render(self) -> List[str]:
+        """Строки метрики в текстовом формате Prometheus."""
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"] + self._samples()
+    
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    """Счетчик, который только увеличивается."""
+    
+    type_name = "counter"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+    
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """
+        Увеличить счетчик.
+        
+        Args:
+            amount: Величина увеличения
+            **labels: Значения меток
+        """
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, **labels: str) -> float:
+        """Текущее значение счетчика с указанными метками."""
+        return self._values.get(self._key(labels), 0)
+    
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        """Значения счетчика по всем наборам меток."""
+        return dict(self._values)
+    
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{self._format_labels(key)} {_format_value(value)}" for key, value in self._values.items()]
+
+class Histogram(_Metric):
+    """Гистограмма значений (обычно задержек) с фиксированными корзинами."""
+    
+    type_name = "histogram"
+    
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        """
+        Args:
+            name: Имя метрики
+            documentation: Описание для строки HELP
+            labelnames: Имена меток
+            buckets: Верхние границы корзин по возрастанию
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # key -> [количество в каждой корзине (последняя - +Inf), сумма]
+        self._values: Dict[Tuple[str, ...], list] = {}
+    
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        Учесть значение.
+        
+        Args:
+            value: Наблюдаемое значение
+            **labels: Значения меток
+        """
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+    
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Измерить время выполнения блока, в том числе завершившегося исключением.
+        
+        Если у гистограммы есть метка status, она заполняется автоматически:
+        ok, error или cancelled.
+        
+        Args:
+            **labels: Значения меток, кроме status
+        """
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except (asyncio.CancelledError, GeneratorExit):
+            status = "cancelled"
+            raise
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            if "status" in self.labelnames:
+                labels["status"] = status
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def count(self, **labels: str) -> int:
+        """Количество наблюдений с указанными метками."""
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+    
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                bucket_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{self._format_labels(key, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render() -> str:
+    """
+    Все метрики в текстовом формате Prometheus.
+    
+    Returns:
+        Текст для ответа на запрос /metrics
+    """
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+# Все созданные метрики в порядке создания
+registry: List[_Metric] = []
+
+# Задержки по этапам обработки
+STORAGE_SECONDS = Histogram("telegpt_storage_seconds", "Время операций с хранилищем", ("backend", "operation"))
+PROVIDER_SECONDS = Histogram("telegpt_provider_seconds", "Время запросов к провайдерам моделей", ("model", "status"))
+PROVIDER_FIRST_TOKEN_SECONDS = Histogram("telegpt_provider_first_token_seconds", "Время до первого фрагмента потокового ответа", ("model",))
+PROVIDER_QUEUE_SECONDS = Histogram("telegpt_provider_queue_seconds", "Ожидание слота в очереди провайдера", ("provider",))
+TELEGRAM_SECONDS = Histogram("telegpt_telegram_seconds", "Время запросов к Telegram Bot API", ("method",))
+TELEGRAM_QUEUE_SECONDS = Histogram("telegpt_telegram_queue_seconds", "Ожидание лимитов Telegram перед отправкой", ("kind",))
+UPDATE_SECONDS = Histogram("telegpt_update_seconds", "Время обработки обновления диспетчером (для сообщений - только прием, обмен учитывается в telegpt_turn_seconds)", ("type",))
+TURN_SECONDS = Histogram("telegpt_turn_seconds", "Время от первого сообщения пользователя до отправки ответа", ("status",))
+LOOP_LAG_SECONDS = Histogram("telegpt_event_loop_lag_seconds", "Задержка срабатывания таймера цикла событий (включается профилированием)")
+STARTUP_SECONDS = Histogram("telegpt_startup_seconds", "Время этапов запуска бота", ("phase",))
+
+# Использование токенов и ошибки
+TOKENS = Counter("telegpt_tokens_total", "Токены запросов и ответов (по данным провайдера или оценка)", ("model", "kind"))
+COST = Counter("telegpt_cost_dollars_total", "Стоимость запросов к моделям в долларах по MODEL_PRICES", ("model",))
+ERRORS = Counter("telegpt_errors_total", "Ошибки по типам", ("type",))
+HEDGES = Counter("telegpt_hedges_total", "Дублирующие запросы к моделям: request, hedge, win, denied", ("model", "event"))
+ADMISSIONS = Counter("telegpt_admissions_total", "Допуск запросов к моделям: admitted, busy, quota", ("model", "result"))
+PROFILER_EVENTS = Counter("telegpt_profiler_events_total", "Профилирование: traced, sampled, slow, dumped, blocked", ("event",))
+WORKER_EVENTS = Counter("telegpt_worker_events_total", "Обновления рабочих процессов: routed, rejected, redelivered, restart", ("worker", "event"))
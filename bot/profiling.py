@@ -0,0 +1,401 @@
+import asyncio
+import gc
+import inspect
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import FrameType
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from bot.config import (
+    PROFILING, PROFILE_SAMPLE_RATE, PROFILE_SLOW_THRESHOLD, PROFILE_INTERVAL_MS,
+    PROFILE_DIR, PROFILE_KEEP, LOOP_LAG_THRESHOLD
+)
+from bot.metrics import LOOP_LAG_SECONDS, PROFILER_EVENTS
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Период таймера, по задержке которого измеряется блокировка цикла событий
+HEARTBEAT_INTERVAL = 0.05
+
+# Сколько этапов хранить для одного обновления (потоковый ответ делает много правок)
+MAX_SPANS = 500
+
+# Сколько этапов медленного обновления показывать в логе
+MAX_LOGGED_SPANS = 30
+
+# Файлы проекта подписываются путем от этого каталога
+ROOT = os.getcwd()
+
+class Trace:
+    """Этапы обработки одного обновления и, если оно выбрано для профилирования, его стеки."""
+    
+    __slots__ = ("name", "started", "spans", "samples", "sampled", "finished")
+    
+    def __init__(self, name: str, sampled: bool):
+        self.name = name
+        self.started = time.perf_counter()
+        # Этап, операция, начало и конец в секундах от начала обработки
+        self.spans: List[Tuple[str, str, float, float]] = []
+        # Свернутый стек ("кадр;кадр;...") и число его замеров
+        self.samples: Counter = Counter()
+        self.sampled = sampled
+        self.finished = False
+    
+    def add(self, stage: str, name: str, start: float, end: float) -> None:
+        if not self.finished and len(self.spans) < MAX_SPANS:
+            self.spans.append((stage, name, start - self.started, end - self.started))
+
+# Обработка, к которой относится текущая задача; задачи, созданные из нее, наследуют значение
+_current: ContextVar[Optional[Trace]] = ContextVar("profiling_trace", default=None)
+
+@contextmanager
+def span(stage: str, name: str) -> Iterator[None]:
+    """
+    Отметить этап обработки текущего обновления.
+    
+    Без включенного профилирования ничего не делает.
+    
+    Args:
+        stage: Этап (storage, provider, send)
+        name: Операция или модель
+    """
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(stage, name, started, time.perf_counter())
+
+def add_span(stage: str, name: str, seconds: float) -> None:
+    """
+    Отметить этап, который закончился только что и длился seconds секунд (ожидание в очереди).
+    
+    Args:
+        stage: Этап (provider_queue, send_queue)
+        name: Провайдер или вид отправки
+        seconds: Длительность этапа
+    """
+    trace = _current.get()
+    if trace is not None:
+        now = time.perf_counter()
+        trace.add(stage, name, now - seconds, now)
+
+class Profiler:
+    """
+    Профилирование обработки обновлений.
+    
+    Включается настройкой PROFILING или командой /profile без перезапуска:
+    - монитор цикла событий: таймер измеряет задержку своего срабатывания,
+      а фоновый поток, заметив, что цикл не отвечает дольше lag_threshold,
+      пишет в лог стек блокирующего вызова;
+    - этапы обработки: обращения к хранилищу, запросы к провайдеру,
+      отправки в Telegram и ожидание в их очередях отмечаются со временем
+      от начала обработки и пишутся в лог для обновлений дольше slow_threshold;
+    - выборочное профилирование: для доли sample_rate обновлений фоновый
+      поток каждые interval секунд снимает стек задачи обработки. Пока
+      задача выполняется, это стек потока цикла событий, а пока она ждет -
+      цепочка await ее корутин, поэтому видно и время ожидания сети.
+      Стеки медленных обновлений сохраняются в directory в свернутом
+      формате ("кадр;кадр;... число"), который принимают flamegraph.pl,
+      speedscope и inferno.
+    
+    Выключенное профилирование стоит одной проверки на обновление и одной
+    переменной контекста на этап.
+    """
+    
+    def __init__(
+        self,
+        enabled: bool = PROFILING,
+        sample_rate: float = PROFILE_SAMPLE_RATE,
+        slow_threshold: float = PROFILE_SLOW_THRESHOLD,
+        interval: float = PROFILE_INTERVAL_MS / 1000,
+        lag_threshold: float = LOOP_LAG_THRESHOLD,
+        directory: str = PROFILE_DIR,
+        keep: int = PROFILE_KEEP
+    ):
+        """
+        Args:
+            enabled: Включено ли профилирование
+            sample_rate: Доля обновлений, стеки которых снимаются
+            slow_threshold: Время обработки в секундах, после которого она считается медленной
+            interval: Период снятия стеков в секундах
+            lag_threshold: Блокировка цикла событий в секундах, о которой сообщается в лог
+            directory: Каталог файлов стеков
+            keep: Сколько последних файлов стеков хранить
+        """
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.interval = interval
+        self.lag_threshold = lag_threshold
+        self.directory = directory
+        self.keep = keep
+        
+        # Задачи выбранных обновлений; читаются фоновым потоком
+        self.sampled: Dict[asyncio.Task, Trace] = {}
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread = 0
+        self._heartbeat = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+    
+    def configure(self, enabled: Optional[bool] = None, sample_rate: Optional[float] = None) -> None:
+        """
+        Изменить настройки без перезапуска.
+        
+        Args:
+            enabled: Включить или выключить профилирование
+            sample_rate: Новая доля обновлений, стеки которых снимаются
+        """
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, sample_rate))
+        if enabled is not None:
+            self.enabled = enabled
+            if enabled:
+                self._ensure_started()
+            else:
+                self.stop()
+        logger.info(f"Профилирование {'включено' if self.enabled else 'выключено'}, доля обновлений со стеками {self.sample_rate:.2%}")
+    
+    @contextmanager
+    def trace(self, name: str) -> Iterator[None]:
+        """
+        Профилировать обработку обновления, выполняемую в блоке.
+        
+        Args:
+            name: Название обработки для лога и имени файла стеков
+        """
+        if not self.enabled:
+            yield
+            return
+        self._ensure_started()
+        trace = Trace(name, sampled=random.random() < self.sample_rate)
+        token = _current.set(trace)
+        task = asyncio.current_task()
+        if trace.sampled and task is not None:
+            PROFILER_EVENTS.inc(event="sampled")
+            with self._lock:
+                self.sampled[task] = trace
+            self._wake.set()
+        try:
+            yield
+        finally:
+            _current.reset(token)
+            if trace.sampled:
+                # После этого поток профилирования больше не добавит замеров
+                with self._lock:
+                    trace.finished = True
+                    self.sampled.pop(task, None)
+            else:
+                trace.finished = True
+            self._finish(trace, time.perf_counter() - trace.started)
+    
+    def _finish(self, trace: Trace, seconds: float) -> None:
+        """Записать в лог этапы медленной обработки и сохранить ее стеки."""
+        if seconds < self.slow_threshold:
+            return
+        PROFILER_EVENTS.inc(event="slow")
+        
+        totals: Dict[str, List[float]] = {}
+        for stage, _, start, end in trace.spans:
+            total = totals.setdefault(stage, [0.0, 0])
+            total[0] += end - start
+            total[1] += 1
+        summary = ", ".join(f"{stage} {total:.2f} с ({count})" for stage, (total, count) in totals.items())
+        lines = [f"Медленная обработка {trace.name}: {seconds:.2f} с; {summary or 'этапов нет'}"]
+        lines += [f"  +{start:.3f} {stage} {name} {end - start:.3f} с" for stage, name, start, end in trace.spans[:MAX_LOGGED_SPANS]]
+        if len(trace.spans) > MAX_LOGGED_SPANS:
+            lines.append(f"  ... еще {len(trace.spans) - MAX_LOGGED_SPANS} этапов")
+        logger.warning("\n".join(lines))
+        
+        with self._lock:
+            samples = dict(trace.samples)
+        if samples:
+            # Запись файла не должна задерживать цикл событий
+            asyncio.get_running_loop().run_in_executor(None, self._dump, trace.name, samples)
+    
+    def _dump(self, name: str, samples: Dict[str, int]) -> None:
+        """Сохранить стеки в свернутом формате и удалить старые файлы."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            slug = re.sub(r"[^\w.-]+", "_", name)
+            filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{slug}.folded"
+            path = os.path.join(self.directory, filename)
+            with open(path, "w", encoding="utf-8") as file:
+                for stack, count in sorted(samples.items()):
+                    file.write(f"{stack} {count}\n")
+            PROFILER_EVENTS.inc(event="dumped")
+            logger.info(f"Стеки обработки {name} ({sum(samples.values())} замеров) сохранены в {path}")
+            
+            dumps = sorted(entry for entry in os.listdir(self.directory) if entry.endswith(".folded"))
+            for old in dumps[:max(0, len(dumps) - self.keep)]:
+                os.remove(os.path.join(self.directory, old))
+        except OSError as e:
+            logger.error(f"Не удалось сохранить стеки обработки {name}: {e}")
+    
+    def _ensure_started(self) -> None:
+        """Запустить монитор цикла событий и поток профилирования при первом обращении из цикла событий."""
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._timer = self._loop.call_later(HEARTBEAT_INTERVAL, self._tick)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="profiler", daemon=True)
+        self._thread.start()
+    
+    def stop(self) -> None:
+        """Остановить монитор цикла событий и поток профилирования."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join(timeout=1)
+            self._thread = None
+    
+    def _tick(self) -> None:
+        """Таймер цикла событий: задержка его срабатывания - время, на которое цикл был занят."""
+        now = time.monotonic()
+        LOOP_LAG_SECONDS.observe(max(0.0, now - self._heartbeat - HEARTBEAT_INTERVAL))
+        self._heartbeat = now
+        self._timer = self._loop.call_later(HEARTBEAT_INTERVAL, self._tick)
+    
+    def _watch(self) -> None:
+        """Фоновый поток: сообщает о блокировках цикла событий и снимает стеки выбранных обновлений."""
+        reported = 0.0
+        while not self._stop.is_set():
+            # Без выбранных обновлений поток просыпается только для проверки цикла
+            self._wake.wait(self.interval if self.sampled else HEARTBEAT_INTERVAL)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            
+            frames = sys._current_frames()
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - HEARTBEAT_INTERVAL
+            if stalled > self.lag_threshold and heartbeat != reported:
+                # О каждой блокировке сообщаем один раз, со стеком на момент обнаружения
+                reported = heartbeat
+                PROFILER_EVENTS.inc(event="blocked")
+                stack = "".join(traceback.format_stack(frames[self._loop_thread])) if self._loop_thread in frames else ""
+                logger.warning(f"Цикл событий не отвечает {stalled * 1000:.0f} мс, блокирующий вызов:\n{stack}")
+            
+            with self._lock:
+                traces = list(self.sampled.items())
+            if traces:
+                self._sample(traces, frames.get(self._loop_thread))
+    
+    def _sample(self, traces: List[Tuple[asyncio.Task, Trace]], loop_frame: Optional[FrameType]) -> None:
+        """Снять стеки задач выбранных обновлений."""
+        running = _thread_stack(loop_frame)
+        stacks = []
+        for task, trace in traces:
+            try:
+                stack = _task_stack(task, running)
+            except Exception:
+                # Задача могла продвинуться, пока обходили ее корутины
+                continue
+            if stack:
+                stacks.append((trace, ";".join(stack)))
+        
+        # Стеки снимаются без блокировки, а счетчики меняются под ней:
+        # обработка, завершившаяся за это время, уже копирует свои замеры
+        with self._lock:
+            for trace, stack in stacks:
+                if not trace.finished:
+                    trace.samples[stack] += 1
+    
+    def status(self) -> Dict[str, Any]:
+        """Текущие настройки и состояние профилирования."""
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "slow_threshold": self.slow_threshold,
+            "lag_threshold": self.lag_threshold,
+            "sampled": len(self.sampled),
+            "directory": self.directory,
+        }
+
+def _thread_stack(frame: Optional[FrameType]) -> List[FrameType]:
+    """Кадры стека потока от внешнего к текущему."""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+def _task_stack(task: asyncio.Task, running: List[FrameType]) -> List[str]:
+    """
+    Стек задачи от ее корутины до текущего кадра.
+    
+    Args:
+        task: Задача обработки обновления
+        running: Стек потока цикла событий в момент замера
+    
+    Returns:
+        Подписи кадров от внешнего к текущему
+    """
+    labels = []
+    awaitable: Any = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "ag_frame", None) or getattr(awaitable, "gi_frame", None)
+        if frame is None:
+            name = type(awaitable).__name__
+            if name in ("async_generator_asend", "async_generator_athrow"):
+                # Шаг async for: сам генератор доступен только через ссылки обертки
+                awaitable = next((ref for ref in gc.get_referents(awaitable) if inspect.isasyncgen(ref)), None)
+                continue
+            if name == "FutureIter":
+                # await future: если это задача, продолжаем по ее корутинам
+                future = next(iter(gc.get_referents(awaitable)), None)
+                if isinstance(future, asyncio.Task):
+                    awaitable = future.get_coro()
+                    continue
+                name = type(future).__name__
+            # Цепочка заканчивается ожиданием future: запроса к сети, таймера или события
+            labels.append(f"<await {name}>")
+            break
+        if frame in running:
+            # Задача выполняется сейчас: дальше ее стек - стек потока
+            labels += [_label(entry) for entry in running[running.index(frame):]]
+            break
+        labels.append(_label(frame))
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "ag_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    return labels
+
+def _label(frame: FrameType) -> str:
+    """Подпись кадра: функция, файл и строка."""
+    code = frame.f_code
+    filename = code.co_filename
+    if filename.startswith(ROOT):
+        filename = os.path.relpath(filename, ROOT)
+    else:
+        # Для библиотек достаточно пакета и модуля
+        filename = "/".join(filename.split(os.sep)[-2:])
+    # co_qualname появилось в Python 3.11, в старых версиях есть только имя функции
+    name = getattr(code, "co_qualname", code.co_name)
+    # ";" разделяет кадры в свернутом формате
+    return f"{name} ({filename}:{frame.f_lineno})".replace(";", ",")
+
+# Создаем единый экземпляр профилировщика
+profiler = Profiler()
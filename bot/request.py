@@ -0,0 +1,43 @@
+from typing import Optional, Tuple
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest, RequestData
+
+from bot.metrics import ERRORS, TELEGRAM_SECONDS
+from bot.profiling import span
+
+class InstrumentedRequest(HTTPXRequest):
+    """Запросы к Telegram Bot API с учетом времени каждого метода в метриках."""
+    
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        *args,
+        **kwargs
+    ) -> Tuple[int, bytes]:
+        """
+        Выполнить запрос к Bot API, измеряя его время.
+        
+        Args:
+            url: Адрес метода Bot API
+            method: HTTP-метод
+            request_data: Параметры запроса
+        
+        Returns:
+            Код ответа и тело ответа
+        """
+        # Последний сегмент адреса - название метода (sendMessage, editMessageText, ...)
+        api_method = url.rsplit("/", 1)[-1]
+        try:
+            with TELEGRAM_SECONDS.time(method=api_method), span("send", api_method):
+                code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except TelegramError as e:
+            # Сетевые ошибки и таймауты
+            ERRORS.inc(type=f"telegram_{type(e).__name__}")
+            raise
+        
+        # Ответы с ошибкой (429, 400, ...) разбирает базовый класс, здесь только считаем их
+        if code >= 400:
+            ERRORS.inc(type=f"telegram_{code}")
+        return code, payload
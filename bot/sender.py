@@ -0,0 +1,337 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from telegram import Bot, Message
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
+
+from bot.config import (
+    TELEGRAM_MESSAGES_PER_SECOND, TELEGRAM_CHAT_MESSAGES_PER_SECOND, TELEGRAM_GROUP_MESSAGES_PER_MINUTE,
+    TELEGRAM_CHAT_BURST, TELEGRAM_SEND_ATTEMPTS, TYPING_INTERVAL, LIMIT_SHARES
+)
+from bot.metrics import ERRORS, TELEGRAM_QUEUE_SECONDS
+from bot.profiling import add_span
+from services.scheduler import TokenBucket
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Сколько чатов хранить лимиты; состояние давно молчавших чатов забывается
+MAX_TRACKED_CHATS = 10000
+
+CODE_FENCE = "```"
+
+def split_text(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> List[str]:
+    """
+    Разбить текст на сообщения не длиннее лимита Telegram.
+    
+    Текст делится по абзацам, блоки кода не разрываются. Слишком длинный
+    блок кода делится по строкам, и каждая часть остается оформленной как
+    код. Слишком длинный абзац делится по строкам, затем по словам.
+    
+    Args:
+        text: Текст ответа
+        limit: Максимальная длина одного сообщения
+    
+    Returns:
+        Части текста в исходном порядке
+    """
+    if len(text) <= limit:
+        return [text]
+    
+    chunks = []
+    current = ""
+    for block in _blocks(text):
+        for piece in _split_block(block, limit):
+            candidate = f"{current}\n\n{piece}" if current else piece
+            if len(candidate) <= limit:
+                current = candidate
+            else:
+                chunks.append(current)
+                current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _blocks(text: str) -> List[str]:
+    """Абзацы текста; блок кода целиком считается одним абзацем, даже с пустыми строками."""
+    blocks = []
+    lines: List[str] = []
+    in_code = False
+    for line in text.split("\n"):
+        if line.strip().startswith(CODE_FENCE):
+            # Блок кода начинается с новой части, даже если перед ним нет пустой строки
+            if not in_code and lines:
+                blocks.append("\n".join(lines))
+                lines = []
+            in_code = not in_code
+            lines.append(line)
+            if not in_code:
+                blocks.append("\n".join(lines))
+                lines = []
+        elif not line.strip() and not in_code:
+            if lines:
+                blocks.append("\n".join(lines))
+                lines = []
+        else:
+            lines.append(line)
+    if lines:
+        blocks.append("\n".join(lines))
+    return blocks
+
+def _split_block(block: str, limit: int) -> List[str]:
+    """Разбить абзац или блок кода, который не помещается в одно сообщение."""
+    if len(block) <= limit:
+        return [block]
+    
+    lines = block.split("\n")
+    if not lines[0].strip().startswith(CODE_FENCE):
+        return _pack(lines, "\n", limit, lambda line: _pack(line.split(" "), " ", limit, _cut(limit)))
+    
+    # Каждая часть блока кода открывается и закрывается заново
+    opening = lines[0]
+    body = lines[1:-1] if len(lines) > 1 and lines[-1].strip() == CODE_FENCE else lines[1:]
+    budget = limit - len(opening) - len(CODE_FENCE) - 2
+    return [f"{opening}\n{piece}\n{CODE_FENCE}" for piece in _pack(body, "\n", budget, _cut(budget))]
+
+def _pack(parts: List[str], separator: str, limit: int, split_part: Callable[[str], List[str]]) -> List[str]:
+    """
+    Собрать части в куски не длиннее limit.
+    
+    Args:
+        parts: Части текста в исходном порядке
+        separator: Разделитель, которым части соединяются
+        limit: Максимальная длина куска
+        split_part: Разбиение части, которая длиннее limit
+    
+    Returns:
+        Куски текста
+    """
+    pieces = []
+    current: Optional[str] = None
+    for part in parts:
+        for sub in (split_part(part) if len(part) > limit else [part]):
+            candidate = sub if current is None else f"{current}{separator}{sub}"
+            if len(candidate) <= limit:
+                current = candidate
+            else:
+                pieces.append(current)
+                current = sub
+    if current is not None:
+        pieces.append(current)
+    return pieces
+
+def _cut(limit: int) -> Callable[[str], List[str]]:
+    """Разбиение части на куски ровно по лимиту, если других границ нет."""
+    return lambda part: [part[start:start + limit] for start in range(0, len(part), limit)]
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        retry_after = retry_after.total_seconds()
+    return float(retry_after)
+
+class _ChatLimiter:
+    """Лимит отправки в один чат и состояние его отправок."""
+    
+    __slots__ = ("bucket", "lock", "paused_until", "typing_at")
+    
+    def __init__(self, chat_id: int):
+        # Личные чаты имеют положительный ID, группы и каналы - отрицательный
+        rate_per_minute = TELEGRAM_CHAT_MESSAGES_PER_SECOND * 60 if chat_id > 0 else TELEGRAM_GROUP_MESSAGES_PER_MINUTE
+        self.bucket = TokenBucket(rate_per_minute, capacity=TELEGRAM_CHAT_BURST)
+        # Отправки в один чат идут по очереди, поэтому части ответа не перемешиваются
+        self.lock = asyncio.Lock()
+        # До этого момента Telegram просил не писать в чат (flood wait)
+        self.paused_until = 0.0
+        self.typing_at = 0.0
+
+class _PendingEdit:
+    """Правка, ожидающая отправки; следующие правки того же сообщения заменяют ее текст."""
+    
+    __slots__ = ("text", "future")
+    
+    def __init__(self, text: str):
+        self.text = text
+        self.future = asyncio.get_running_loop().create_future()
+
+class TelegramSender:
+    """
+    Отправка сообщений в Telegram с учетом лимитов.
+    
+    Telegram допускает около 30 сообщений в секунду от бота, одно сообщение
+    в секунду в личный чат и 20 в минуту в группу, а при превышении отвечает
+    ошибкой flood wait. Отправитель ждет свободного места в общей корзине
+    и в корзине чата, а получив flood wait, приостанавливает отправку в чат
+    на указанное время и повторяет запрос. Длинные ответы делятся на части,
+    правки одного сообщения и индикаторы набора текста объединяются.
+    """
+    
+    def __init__(self, messages_per_second: float = TELEGRAM_MESSAGES_PER_SECOND):
+        """
+        Args:
+            messages_per_second: Общий лимит сообщений в секунду (0 - без ограничения)
+        """
+        self.bucket = TokenBucket(messages_per_second * 60, capacity=max(1.0, messages_per_second))
+        self.chats: "OrderedDict[int, _ChatLimiter]" = OrderedDict()
+        self.edits: Dict[Tuple[int, int], _PendingEdit] = {}
+    
+    async def reply(self, message: Message, text: str, **kwargs: Any) -> List[Message]:
+        """
+        Ответить на сообщение, разбив длинный текст на несколько сообщений.
+        
+        Args:
+            message: Сообщение, на которое отвечаем
+            text: Текст ответа
+            **kwargs: Параметры reply_text для каждой части (parse_mode, reply_markup)
+        
+        Returns:
+            Отправленные сообщения
+        """
+        sent = []
+        for chunk in split_text(text):
+            sent.append(await self._send(
+                message.chat_id,
+                "send",
+                lambda chunk=chunk: message.reply_text(chunk, **kwargs)
+            ))
+        # Отправленное сообщение убирает индикатор набора текста
+        self._chat(message.chat_id).typing_at = 0.0
+        return sent
+    
+    async def edit(self, message: Message, text: str, wait_flood: bool = True) -> Any:
+        """
+        Заменить текст сообщения.
+        
+        Пока правка ждет своей очереди, следующие правки того же сообщения
+        только заменяют ее текст: отправляется одна правка с последним текстом.
+        
+        Args:
+            message: Редактируемое сообщение бота
+            text: Новый текст
+            wait_flood: Ждать и повторять правку при flood wait (иначе RetryAfter пробрасывается)
+        
+        Returns:
+            Результат edit_text
+        """
+        key = (message.chat_id, message.message_id)
+        pending = self.edits.get(key)
+        if pending is not None:
+            pending.text = text
+            return await asyncio.shield(pending.future)
+        
+        pending = self.edits[key] = _PendingEdit(text)
+        
+        async def request() -> Any:
+            # Текст, заданный после этого момента, уйдет следующей правкой
+            if self.edits.get(key) is pending:
+                del self.edits[key]
+            try:
+                return await message.edit_text(pending.text)
+            except BadRequest as e:
+                # Telegram возвращает ошибку, если текст сообщения не изменился
+                if "not modified" not in str(e).lower():
+                    raise
+                return None
+        
+        try:
+            result = await self._send(message.chat_id, "edit", request, wait_flood)
+        except BaseException as e:
+            if self.edits.get(key) is pending:
+                del self.edits[key]
+            if not pending.future.done():
+                if isinstance(e, asyncio.CancelledError):
+                    pending.future.cancel()
+                else:
+                    pending.future.set_exception(e)
+                    # Ошибку получат объединенные правки; если их нет, она не должна считаться необработанной
+                    pending.future.exception()
+            raise
+        pending.future.set_result(result)
+        return result
+    
+    async def send_chat_action(self, bot: Bot, chat_id: int, action: str = "typing") -> None:
+        """
+        Показать индикатор действия, если он еще не показан.
+        
+        Args:
+            bot: Бот
+            chat_id: ID чата
+            action: Действие
+        """
+        chat = self._chat(chat_id)
+        now = time.monotonic()
+        if now - chat.typing_at < TYPING_INTERVAL:
+            return
+        chat.typing_at = now
+        await bot.send_chat_action(chat_id=chat_id, action=action)
+    
+    async def _send(
+        self,
+        chat_id: int,
+        kind: str,
+        request: Callable[[], Awaitable[Any]],
+        wait_flood: bool = True
+    ) -> Any:
+        """
+        Выполнить запрос к Bot API, дождавшись лимитов и повторяя его при flood wait.
+        
+        Args:
+            chat_id: ID чата
+            kind: Вид запроса для метрик
+            request: Запрос
+            wait_flood: Ждать и повторять запрос при flood wait
+        
+        Returns:
+            Результат запроса
+        """
+        chat = self._chat(chat_id)
+        async with chat.lock:
+            for attempt in range(1, TELEGRAM_SEND_ATTEMPTS + 1):
+                started = time.monotonic()
+                await self._wait_turn(chat)
+                waited = time.monotonic() - started
+                TELEGRAM_QUEUE_SECONDS.observe(waited, kind=kind)
+                add_span("send_queue", kind, waited)
+                try:
+                    return await request()
+                except RetryAfter as e:
+                    retry_after = retry_after_seconds(e)
+                    chat.paused_until = time.monotonic() + retry_after
+                    ERRORS.inc(type="telegram_flood_wait")
+                    logger.warning(f"Telegram ограничил частоту отправки в чат {chat_id}, пауза {retry_after} секунд")
+                    if not wait_flood or attempt == TELEGRAM_SEND_ATTEMPTS:
+                        raise
+    
+    async def _wait_turn(self, chat: _ChatLimiter) -> None:
+        """Дождаться места в общей корзине и в корзине чата и занять его."""
+        while True:
+            delay = max(
+                chat.paused_until - time.monotonic(),
+                self.bucket.delay(1),
+                chat.bucket.delay(1)
+            )
+            if delay <= 0:
+                self.bucket.consume(1)
+                chat.bucket.consume(1)
+                return
+            await asyncio.sleep(delay)
+    
+    def _chat(self, chat_id: int) -> _ChatLimiter:
+        """Лимит чата; давно не использованные лимиты свободных чатов забываются."""
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = _ChatLimiter(chat_id)
+            if len(self.chats) > MAX_TRACKED_CHATS:
+                oldest_id, oldest = next(iter(self.chats.items()))
+                if not oldest.lock.locked():
+                    del self.chats[oldest_id]
+        else:
+            self.chats.move_to_end(chat_id)
+        return chat
+
+# Создаем единый экземпляр отправителя; общий лимит бота делится между рабочими процессами
+sender = TelegramSender(TELEGRAM_MESSAGES_PER_SECOND / LIMIT_SHARES)
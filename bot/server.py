@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+import signal
+from typing import Optional
+from telegram import Update
+from telegram.ext import Application
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as WebApplication, HTTPError, RequestHandler
+
+from bot import metrics
+from bot.config import METRICS_PATH, WARMUP
+from bot.startup import startup, warm_up
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class MetricsHandler(RequestHandler):
+    """Отдает метрики в текстовом формате Prometheus."""
+    
+    def get(self) -> None:
+        self.set_header("Content-Type", metrics.CONTENT_TYPE)
+        self.write(metrics.render())
+
+class WebhookHandler(RequestHandler):
+    """Принимает обновления от Telegram и передает их в очередь приложения."""
+    
+    def initialize(self, bot_application: Application) -> None:
+        self.bot_application = bot_application
+    
+    async def post(self) -> None:
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise HTTPError(400, reason="Некорректный JSON")
+        
+        update = Update.de_json(data, self.bot_application.bot)
+        await self.bot_application.update_queue.put(update)
+
+def build_web_app(application: Optional[Application] = None) -> WebApplication:
+    """
+    Собрать HTTP-приложение с метриками и, если передано приложение бота, вебхуком.
+    
+    Args:
+        application: Приложение бота, которому передаются обновления вебхука
+    
+    Returns:
+        Приложение tornado
+    """
+    routes = [(METRICS_PATH, MetricsHandler)]
+    if application is not None:
+        # Как и встроенный сервер python-telegram-bot, вебхук слушаем в корне
+        routes.append((r"/?", WebhookHandler, {"bot_application": application}))
+    return WebApplication(routes)
+
+class MetricsServer:
+    """Отдельный HTTP-сервер метрик для режима polling."""
+    
+    def __init__(self, port: int):
+        """
+        Args:
+            port: Порт сервера (0 - сервер не запускается)
+        """
+        self.port = port
+        self._server: Optional[HTTPServer] = None
+    
+    def start(self) -> None:
+        """Начать принимать запросы метрик."""
+        if not self.port or self._server is not None:
+            return
+        self._server = HTTPServer(build_web_app())
+        self._server.listen(self.port)
+        logger.info(f"Метрики доступны на порту {self.port}, путь {METRICS_PATH}")
+    
+    def stop(self) -> None:
+        """Остановить сервер."""
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+async def run_webhook(application: Application, port: int, webhook_url: str) -> None:
+    """
+    Запустить бота в режиме webhook с метриками на том же порту.
+    
+    Повторяет жизненный цикл Application.run_webhook, но использует собственный
+    HTTP-сервер, чтобы рядом с вебхуком отдавать METRICS_PATH.
+    
+    Args:
+        application: Приложение бота, собранное без Updater
+        port: Порт, на котором принимаются вебхуки и запросы метрик
+        webhook_url: Публичный адрес вебхука
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    startup.mark("initialize")
+    
+    server = HTTPServer(build_web_app(application))
+    server.listen(port, address="0.0.0.0")
+    warmup_task = None
+    try:
+        await application.bot.set_webhook(url=webhook_url)
+        await application.start()
+        startup.mark("webhook")
+        logger.info(f"Webhook и метрики слушают порт {port}")
+        startup.report()
+        # Прогрев идет в фоне: вебхук уже принимает обновления
+        warmup_task = asyncio.create_task(warm_up(full=WARMUP))
+        await stop.wait()
+    finally:
+        if warmup_task is not None:
+            warmup_task.cancel()
+        server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from bot.metrics import STARTUP_SECONDS
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class StartupTimer:
+    """
+    Замер этапов запуска бота.
+    
+    Отсчет идет от импорта этого модуля, поэтому main.py импортирует его
+    раньше остальных модулей бота. Каждый этап - время от предыдущей отметки.
+    """
+    
+    def __init__(self):
+        self.started = time.monotonic()
+        self.last = self.started
+        self.phases: List[Tuple[str, float]] = []
+    
+    def mark(self, phase: str) -> None:
+        """
+        Завершить этап запуска.
+        
+        Args:
+            phase: Название этапа
+        """
+        now = time.monotonic()
+        duration = now - self.last
+        self.last = now
+        self.phases.append((phase, duration))
+        STARTUP_SECONDS.observe(duration, phase=phase)
+    
+    def report(self) -> None:
+        """Записать в лог время этапов и всего запуска."""
+        phases = ", ".join(f"{phase} {duration:.2f} с" for phase, duration in self.phases)
+        logger.info(f"Бот запущен за {self.last - self.started:.2f} с ({phases})")
+
+# Создаем единый экземпляр замера
+startup = StartupTimer()
+
+async def warm_up(full: bool = True) -> None:
+    """
+    Прогреть соединения после запуска: база, провайдеры моделей и токенизатор.
+    
+    Без прогрева все это происходит при первом сообщении, и первый
+    пользователь ждет дольше остальных. Ошибки прогрева не мешают работе:
+    соединение будет открыто при первом запросе.
+    
+    Args:
+        full: Прогреть все; иначе только загрузить токенизатор, который иначе
+            скачивался бы синхронно в цикле событий при первом сообщении
+    """
+    # Импорт здесь: модули провайдеров сами лениво загружают SDK
+    from bot.storage import storage
+    from services import ai_service, tokens
+    from services.admission import admission
+    
+    steps: Dict[str, Callable[[], Awaitable[None]]] = {
+        "storage": storage.warm_up,
+        "providers": ai_service.warm_up,
+        "tokenizer": tokens.warm_up,
+        "quotas": admission.warm_up,
+    }
+    if not full:
+        steps = {"tokenizer": tokens.warm_up}
+    
+    async def run(name: str, step: Callable[[], Awaitable[None]]) -> None:
+        started = time.monotonic()
+        try:
+            await step()
+        except Exception as e:
+            logger.warning(f"Прогрев {name} не удался: {e}")
+            return
+        duration = time.monotonic() - started
+        STARTUP_SECONDS.observe(duration, phase=f"warmup_{name}")
+        logger.info(f"Прогрев {name}: {duration:.2f} с")
+    
+    await asyncio.gather(*(run(name, step) for name, step in steps.items()))
@@ -0,0 +1,28 @@
+"""
+Хранилище данных пользователей.
+Бэкенд выбирается настройкой STORAGE_BACKEND: mongo (MongoDB) или sqlite (встроенная база SQLite).
+"""
+from bot.config import STORAGE_BACKEND
+from bot.storage.base import ConversationTurn, Storage
+
+def create_storage(backend: str = STORAGE_BACKEND) -> Storage:
+    """
+    Создать хранилище выбранного типа.
+    
+    Args:
+        backend: Тип хранилища: "mongo" или "sqlite"
+    
+    Returns:
+        Хранилище данных пользователей
+    """
+    # Импортируем только выбранный бэкенд, чтобы не требовать драйверы остальных
+    if backend == "mongo":
+        from bot.storage.mongo import MongoStorage
+        return MongoStorage()
+    if backend == "sqlite":
+        from bot.storage.sqlite import SQLiteStorage
+        return SQLiteStorage()
+    raise ValueError(f"Неизвестный тип хранилища: {backend}")
+
+# Создаем единый экземпляр хранилища
+storage = create_storage()
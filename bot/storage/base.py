@@ -0,0 +1,502 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Any, Optional, Tuple
+from bot.cache import LRUCache
+from bot.metrics import STORAGE_SECONDS
+from bot.profiling import span
+from services.tokens import count_tokens
+from bot.config import (
+    DEFAULT_MODEL, MAX_HISTORY_LENGTH, SYSTEM_MESSAGES, STORAGE_WRITE_BEHIND,
+    USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL, USER_CACHE_MAX_BYTES
+)
+from bot.storage.journal import WriteBehindJournal
+
+# Поля окна квот пользователя, см. services/admission.py
+QUOTA_FIELDS = ("start", "requests", "tokens", "previous_requests", "previous_tokens")
+
+# Поля агрегата использования моделей за час, см. services/usage.py
+USAGE_FIELDS = ("requests", "prompt_tokens", "completion_tokens", "seconds", "cost")
+
+class ConversationTurn:
+    """
+    Один обмен сообщениями: загружается одним чтением и сохраняется одной записью.
+    
+    Сообщение пользователя не попадает в базу до вызова Storage.commit_turn,
+    поэтому ошибка провайдера не оставляет в истории вопрос без ответа.
+    """
+    
+    def __init__(self, user_id: int, model: str, history: List[Dict[str, str]], user_message: str):
+        """
+        Args:
+            user_id: ID пользователя
+            model: Модель пользователя на момент начала обмена
+            history: История сообщений до текущего обмена
+            user_message: Текст нового сообщения пользователя
+        """
+        self.user_id = user_id
+        self.model = model
+        self.history = history
+        self.user_message = {"role": "user", "content": user_message, "tokens": count_tokens(user_message, model)}
+    
+    @property
+    def messages(self) -> List[Dict[str, str]]:
+        """История вместе с новым сообщением пользователя для отправки в API."""
+        return self.history + [self.user_message]
+
+def _make_message(role: str, content: str, model: str) -> Dict[str, Any]:
+    """
+    Создать сообщение истории с заранее подсчитанным количеством токенов.
+    
+    Токены считаются один раз при сохранении и больше не пересчитываются
+    при сборке контекста.
+    
+    Args:
+        role: Роль сообщения
+        content: Содержание сообщения
+        model: Модель, для токенизатора которой ведется подсчет
+    
+    Returns:
+        Сообщение истории
+    """
+    return {"role": role, "content": content, "tokens": count_tokens(content, model)}
+
+def _user_data_size(user_data: Dict[str, Any]) -> int:
+    """Примерная оценка объема памяти, занимаемого данными пользователя."""
+    return 200 + sum(100 + len(msg.get("content", "")) * 2 for msg in user_data.get("messages", []))
+
+def _trim_messages(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """
+    Обрезать историю: системные сообщения остаются всегда, из остальных - последние MAX_HISTORY_LENGTH * 2.
+    
+    Хранилища выполняют ту же обрезку на своей стороне.
+    
+    Args:
+        messages: Полная история сообщений
+    
+    Returns:
+        Системные сообщения и последние MAX_HISTORY_LENGTH * 2 остальных
+    """
+    system_messages = [msg for msg in messages if msg["role"] == "system"]
+    other_messages = [msg for msg in messages if msg["role"] != "system"][-MAX_HISTORY_LENGTH * 2:]
+    return system_messages + other_messages
+
+def _merge_batch(batch: List[Tuple[int, List[Dict[str, Any]]]]) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Объединить записи пакета по пользователям: одна запись на пользователя.
+    
+    Args:
+        batch: Пары (ID пользователя, добавляемые сообщения) в порядке добавления
+    
+    Returns:
+        Сообщения каждого пользователя в порядке добавления
+    """
+    merged: Dict[int, List[Dict[str, Any]]] = {}
+    for user_id, messages in batch:
+        merged.setdefault(user_id, []).extend(messages)
+    return merged
+
+class Storage(ABC):
+    """
+    Хранилище данных пользователей: модель и история диалога.
+    
+    Общая часть - кэш активных пользователей и сборка обменов - реализована
+    здесь. Конкретное хранилище реализует только операции с базой. Все
+    записи проходят через этот класс, поэтому кэш обновляется вместе с
+    базой (write-through) и остается согласованным.
+    
+    В режиме отложенной записи новые сообщения сохраняются в базу фоновыми
+    пакетами через WriteBehindJournal, а до сохранения берутся из журнала.
+    """
+    
+    # Название хранилища для метрик
+    backend = ""
+    
+    def __init__(self, write_behind: bool = STORAGE_WRITE_BEHIND):
+        """
+        Args:
+            write_behind: Сохранять новые сообщения отложенной пакетной записью
+        """
+        # Кэш данных активных пользователей
+        self.cache = LRUCache(
+            max_entries=USER_CACHE_MAX_ENTRIES,
+            ttl=USER_CACHE_TTL,
+            max_bytes=USER_CACHE_MAX_BYTES,
+            sizeof=_user_data_size
+        )
+        self.journal = WriteBehindJournal(self._flush_batch) if write_behind else None
+    
+    async def get_user_data(self, user_id: int) -> Dict[str, Any]:
+        """
+        Получить данные пользователя, создавая их при необходимости.
+        
+        Args:
+            user_id: ID пользователя
+        
+        Returns:
+            Словарь с данными пользователя
+        """
+        user_data = self.cache.get(user_id)
+        if user_data is None:
+            user_data = await self._read_user(user_id)
+            self.cache.set(user_id, user_data)
+        
+        # Возвращаем копию, чтобы вызывающий код не мог изменить кэш
+        return {**user_data, "messages": list(user_data.get("messages", []))}
+    
+    async def _read_user(self, user_id: int) -> Dict[str, Any]:
+        """Прочитать данные пользователя из базы вместе с несохраненными сообщениями журнала."""
+        if self.journal is None:
+            with self._timed("find_user"):
+                return await self._load_user(user_id)
+        
+        generation = self.journal.generation
+        with self._timed("find_user"):
+            user_data = await self._load_user(user_id)
+        if self.journal.generation != generation or self.journal.lock.locked():
+            # Чтение пересеклось с сохранением пакета, и неизвестно, попал ли пакет
+            # в прочитанные данные. Читаем заново, не давая сохранению начаться
+            async with self.journal.lock:
+                with self._timed("find_user"):
+                    user_data = await self._load_user(user_id)
+                return self._with_pending(user_data)
+        return self._with_pending(user_data)
+    
+    def _with_pending(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Добавить к прочитанной истории сообщения, еще не сохраненные из журнала."""
+        pending = self.journal.pending(user_data["_id"])
+        if pending:
+            user_data["messages"] = _trim_messages(user_data.get("messages", []) + pending)
+        return user_data
+    
+    async def get_messages(self, user_id: int) -> List[Dict[str, str]]:
+        """
+        Получить историю сообщений пользователя.
+        
+        Args:
+            user_id: ID пользователя
+        
+        Returns:
+            Список сообщений пользователя
+        """
+        user_data = await self.get_user_data(user_id)
+        return user_data.get("messages", [])
+    
+    async def add_message(self, user_id: int, role: str, content: str) -> None:
+        """
+        Добавить сообщение в историю пользователя.
+        
+        Добавление и обрезка истории выполняются одной атомарной операцией,
+        поэтому параллельные обновления не теряют данные. Если пользователя
+        еще нет, он создается той же операцией.
+        
+        Args:
+            user_id: ID пользователя
+            role: Роль сообщения ("user", "assistant", "system")
+            content: Содержание сообщения
+        """
+        cached = self.cache.peek(user_id)
+        model = cached.get("model", DEFAULT_MODEL) if cached else DEFAULT_MODEL
+        await self._append_messages(user_id, [_make_message(role, content, model)])
+    
+    async def begin_turn(self, user_id: int, user_message: str) -> ConversationTurn:
+        """
+        Начать обмен сообщениями: получить модель и историю одним чтением.
+        
+        Args:
+            user_id: ID пользователя
+            user_message: Текст сообщения пользователя
+        
+        Returns:
+            Незавершенный обмен, который нужно сохранить через commit_turn
+        """
+        user_data = await self.get_user_data(user_id)
+        return ConversationTurn(
+            user_id,
+            user_data.get("model", DEFAULT_MODEL),
+            user_data.get("messages", []),
+            user_message
+        )
+    
+    async def commit_turn(self, turn: ConversationTurn, assistant_message: str) -> None:
+        """
+        Сохранить сообщение пользователя и ответ модели одной записью.
+        
+        Args:
+            turn: Обмен, начатый через begin_turn
+            assistant_message: Ответ модели
+        """
+        await self._append_messages(
+            turn.user_id,
+            [turn.user_message, _make_message("assistant", assistant_message, turn.model)]
+        )
+    
+    async def _append_messages(self, user_id: int, messages: List[Dict[str, str]]) -> None:
+        """
+        Добавить сообщения в историю одной атомарной операцией.
+        
+        Args:
+            user_id: ID пользователя
+            messages: Добавляемые сообщения
+        """
+        if self.journal is None:
+            with self._timed("append"):
+                await self._store_messages(user_id, messages)
+        else:
+            self.journal.append(user_id, messages)
+        
+        # Повторяем ту же обрезку для закэшированной копии
+        cached = self.cache.peek(user_id)
+        if cached is not None:
+            self._update_cache(user_id, messages=_trim_messages(cached.get("messages", []) + messages))
+    
+    async def reset_messages(self, user_id: int, model: Optional[str] = None) -> None:
+        """
+        Сбросить историю сообщений пользователя, оставив системное сообщение его модели.
+        
+        Смена модели, сброс истории и добавление системного сообщения
+        выполняются одной записью без предварительного чтения.
+        
+        Args:
+            user_id: ID пользователя
+            model: Новая модель пользователя (None - оставить текущую)
+        """
+        if self.journal is None:
+            with self._timed("reset"):
+                await self._reset(user_id, model)
+        else:
+            # Несохраненные сообщения все равно были бы удалены сбросом
+            async with self.journal.lock:
+                self.journal.discard(user_id)
+                with self._timed("reset"):
+                    await self._reset(user_id, model)
+        
+        if model is None:
+            cached = self.cache.peek(user_id)
+            if cached is None:
+                return
+            model = cached.get("model", DEFAULT_MODEL)
+        self.cache.set(user_id, {"_id": user_id, "model": model, "messages": [self._system_message(model)]})
+    
+    @staticmethod
+    def _system_message(model: str) -> Dict[str, Any]:
+        """Системное сообщение для указанной модели."""
+        return _make_message("system", SYSTEM_MESSAGES.get(model, SYSTEM_MESSAGES["gpt-4o"]), model)
+    
+    async def apply_summary(
+        self,
+        user_id: int,
+        summarized: List[Dict[str, Any]],
+        summary: Dict[str, Any]
+    ) -> bool:
+        """
+        Заменить самые старые сообщения кратким содержанием одной атомарной операцией.
+        
+        Краткое содержание ставится сразу за системным сообщением и заменяет
+        предыдущее. Если за время подготовки история была сброшена,
+        ничего не меняется.
+        
+        Args:
+            user_id: ID пользователя
+            summarized: Сжатые сообщения - начало истории без системных сообщений
+            summary: Сообщение с кратким содержанием
+        
+        Returns:
+            True, если история обновлена
+        """
+        if self.journal is None:
+            with self._timed("apply_summary"):
+                applied = await self._replace_with_summary(user_id, summarized, summary)
+        else:
+            # Сжимаемые сообщения должны быть уже в базе
+            async with self.journal.lock:
+                await self.journal.flush_locked()
+                with self._timed("apply_summary"):
+                    applied = await self._replace_with_summary(user_id, summarized, summary)
+        
+        # Проще перечитать историю при следующем обращении, чем повторять преобразование
+        self.cache.pop(user_id)
+        return applied
+    
+    async def set_model(self, user_id: int, model: str) -> None:
+        """
+        Установить модель для пользователя.
+        
+        Args:
+            user_id: ID пользователя
+            model: Название модели
+        """
+        with self._timed("set_model"):
+            await self._store_model(user_id, model)
+        self._update_cache(user_id, model=model)
+    
+    async def get_model(self, user_id: int) -> str:
+        """
+        Получить модель пользователя.
+        
+        Args:
+            user_id: ID пользователя
+        
+        Returns:
+            Название модели
+        """
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return cached.get("model", DEFAULT_MODEL)
+        
+        # Без истории: она может не понадобиться
+        with self._timed("find_model"):
+            return await self._load_model(user_id)
+    
+    async def load_quotas(self, since: float) -> Dict[int, Dict[str, float]]:
+        """
+        Прочитать сохраненные окна квот пользователей.
+        
+        Args:
+            since: Время (Unix), раньше которого окна уже не влияют на квоты
+        
+        Returns:
+            Окна квот по ID пользователей
+        """
+        with self._timed("load_quotas"):
+            return await self._load_quotas(since)
+    
+    async def save_quotas(self, quotas: Dict[int, Dict[str, float]]) -> None:
+        """
+        Сохранить окна квот пользователей одной пакетной записью.
+        
+        Args:
+            quotas: Окна квот по ID пользователей
+        """
+        if not quotas:
+            return
+        with self._timed("save_quotas"):
+            await self._store_quotas(quotas)
+    
+    async def load_usage(self, since: int) -> List[Dict[str, Any]]:
+        """
+        Прочитать агрегаты использования моделей.
+        
+        Args:
+            since: Начало первого часа (Unix-время)
+        
+        Returns:
+            Агрегаты с полями user_id, model, hour и USAGE_FIELDS
+        """
+        with self._timed("load_usage"):
+            return await self._load_usage(since)
+    
+    async def save_usage(self, usage: Dict[Tuple[int, str, int], Dict[str, float]]) -> None:
+        """
+        Прибавить агрегаты использования к сохраненным одной пакетной записью.
+        
+        Args:
+            usage: Поля USAGE_FIELDS по ключам (ID пользователя, модель, час)
+        """
+        if not usage:
+            return
+        with self._timed("save_usage"):
+            await self._store_usage(usage)
+    
+    async def warm_up(self) -> None:
+        """Заранее подключиться к базе, чтобы первый запрос не ждал соединения."""
+    
+    async def flush(self) -> None:
+        """Сохранить в базу сообщения из журнала отложенной записи."""
+        if self.journal is not None:
+            await self.journal.flush()
+    
+    async def close(self) -> None:
+        """Сохранить журнал отложенной записи и освободить соединения с базой."""
+        if self.journal is not None:
+            await self.journal.close()
+        await self._close()
+    
+    async def _flush_batch(self, batch: List[Tuple[int, List[Dict[str, Any]]]]) -> None:
+        with self._timed("flush"):
+            await self._store_batch(batch)
+    
+    def _update_cache(self, user_id: int, **fields: Any) -> None:
+        """
+        Обновить поля закэшированных данных пользователя после записи в базу.
+        
+        Если пользователя нет в кэше, ничего не делаем: следующее чтение
+        загрузит актуальные данные из базы.
+        
+        Args:
+            user_id: ID пользователя
+            **fields: Новые значения полей
+        """
+        cached = self.cache.peek(user_id)
+        if cached is not None:
+            self.cache.set(user_id, {**cached, **fields})
+    
+    @contextmanager
+    def _timed(self, operation: str) -> Iterator[None]:
+        """Измерить время операции с базой и отметить ее в этапах обработки обновления."""
+        with STORAGE_SECONDS.time(backend=self.backend, operation=operation), span("storage", operation):
+            yield
+    
+    @abstractmethod
+    async def _load_user(self, user_id: int) -> Dict[str, Any]:
+        """
+        Прочитать данные пользователя, атомарно создав запись по умолчанию, если ее нет.
+        
+        Returns:
+            Словарь с полями model и messages (системные сообщения в начале)
+        """
+    
+    async def _load_model(self, user_id: int) -> str:
+        """Прочитать модель пользователя. Хранилища, где это дешевле полной загрузки, переопределяют метод."""
+        user_data = await self._load_user(user_id)
+        return user_data.get("model", DEFAULT_MODEL)
+    
+    @abstractmethod
+    async def _store_messages(self, user_id: int, messages: List[Dict[str, str]]) -> None:
+        """Добавить сообщения и обрезать историю как _trim_messages, создав пользователя при необходимости."""
+    
+    async def _store_batch(self, batch: List[Tuple[int, List[Dict[str, Any]]]]) -> None:
+        """
+        Сохранить пакет записей журнала. Хранилища, умеющие пакетную запись, переопределяют метод.
+        
+        Args:
+            batch: Пары (ID пользователя, добавляемые сообщения) в порядке добавления
+        """
+        for user_id, messages in _merge_batch(batch).items():
+            await self._store_messages(user_id, messages)
+    
+    @abstractmethod
+    async def _reset(self, user_id: int, model: Optional[str]) -> None:
+        """Оставить в истории только системное сообщение модели, при необходимости сменив модель."""
+    
+    @abstractmethod
+    async def _replace_with_summary(
+        self,
+        user_id: int,
+        summarized: List[Dict[str, Any]],
+        summary: Dict[str, Any]
+    ) -> bool:
+        """Заменить сжатые сообщения и прежнее краткое содержание новым, если история не изменилась."""
+    
+    @abstractmethod
+    async def _store_model(self, user_id: int, model: str) -> None:
+        """Сохранить модель пользователя."""
+    
+    @abstractmethod
+    async def _load_quotas(self, since: float) -> Dict[int, Dict[str, float]]:
+        """Прочитать окна квот, начавшиеся не раньше since (поля QUOTA_FIELDS)."""
+    
+    @abstractmethod
+    async def _store_quotas(self, quotas: Dict[int, Dict[str, float]]) -> None:
+        """Записать окна квот, заменив прежние окна этих пользователей."""
+    
+    @abstractmethod
+    async def _load_usage(self, since: int) -> List[Dict[str, Any]]:
+        """Прочитать агрегаты использования за часы, начиная с since."""
+    
+    @abstractmethod
+    async def _store_usage(self, usage: Dict[Tuple[int, str, int], Dict[str, float]]) -> None:
+        """Прибавить агрегаты к сохраненным, создав недостающие."""
+    
+    @abstractmethod
+    async def _close(self) -> None:
+        """Освободить соединения с базой."""
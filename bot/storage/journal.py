@@ -0,0 +1,186 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from bot.config import STORAGE_FLUSH_INTERVAL, STORAGE_FLUSH_OPS, STORAGE_JOURNAL_PATH
+from bot.metrics import ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Запись журнала: пользователь и добавляемые в его историю сообщения
+JournalEntry = Tuple[int, List[Dict[str, Any]]]
+
+class WriteBehindJournal:
+    """
+    Журнал отложенной записи истории (write-behind).
+    
+    Добавленные сообщения сразу попадают в журнал в памяти процесса, а
+    фоновая задача сохраняет накопленное одной пакетной записью каждые
+    interval секунд или как только набралось max_ops записей. Ответ
+    пользователю больше не ждет записи в базу, а под нагрузкой записей
+    в базу становится меньше.
+    
+    Записи удаляются из журнала только после успешного сохранения, поэтому
+    до этого момента их видят чтения (см. pending). Если указан файл,
+    каждая запись дублируется в него, и после аварийного завершения
+    процесса несохраненные сообщения восстанавливаются при запуске.
+    Сообщения, сохраненные перед самой аварией, при этом могут записаться
+    повторно.
+    """
+    
+    def __init__(
+        self,
+        store_batch: Callable[[List[JournalEntry]], Awaitable[None]],
+        interval: float = STORAGE_FLUSH_INTERVAL,
+        max_ops: int = STORAGE_FLUSH_OPS,
+        path: str = STORAGE_JOURNAL_PATH
+    ):
+        """
+        Args:
+            store_batch: Сохранение пакета записей в базу
+            interval: Максимальная задержка сохранения в секундах
+            max_ops: Записей, после которых пакет сохраняется сразу
+            path: Файл журнала на диске (пустая строка - только в памяти)
+        """
+        self.store_batch = store_batch
+        self.interval = interval
+        self.max_ops = max_ops
+        self.entries: List[JournalEntry] = []
+        # Сохранение пакета и операции, которые должны его дождаться, не пересекаются
+        self.lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        # Меняется в начале и в конце каждого сохранения: по нему чтение
+        # узнает, что пересеклось с сохранением пакета
+        self.generation = 0
+        
+        self._file = None
+        if path:
+            self.entries = self._recover(path)
+            self._file = open(path, "a", encoding="utf-8")
+    
+    @staticmethod
+    def _recover(path: str) -> List[JournalEntry]:
+        """Прочитать записи, не сохраненные до завершения процесса."""
+        if not os.path.exists(path):
+            return []
+        
+        entries = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Последняя строка могла не дописаться при аварии
+                    continue
+                entries.append((record["user_id"], record["messages"]))
+        if entries:
+            logger.warning(f"Восстановлено из журнала несохраненных записей: {len(entries)}")
+        return entries
+    
+    def append(self, user_id: int, messages: List[Dict[str, Any]]) -> None:
+        """
+        Добавить сообщения в журнал.
+        
+        Args:
+            user_id: ID пользователя
+            messages: Добавляемые сообщения
+        """
+        self.entries.append((user_id, messages))
+        if self._file is not None:
+            self._file.write(json.dumps({"user_id": user_id, "messages": messages}, ensure_ascii=False) + "\n")
+            self._file.flush()
+        
+        self._ensure_task()
+        if len(self.entries) >= self.max_ops:
+            self._wakeup.set()
+    
+    def pending(self, user_id: int) -> List[Dict[str, Any]]:
+        """
+        Сообщения пользователя, еще не сохраненные в базу.
+        
+        Args:
+            user_id: ID пользователя
+        
+        Returns:
+            Сообщения в порядке добавления
+        """
+        self._ensure_task()
+        return [message for entry_user, messages in self.entries if entry_user == user_id for message in messages]
+    
+    def discard(self, user_id: int) -> None:
+        """
+        Выбросить несохраненные сообщения пользователя, например перед сбросом истории.
+        
+        Вызывается под lock, чтобы не потерять пакет, который уже сохраняется.
+        """
+        self.entries = [entry for entry in self.entries if entry[0] != user_id]
+        self._rewrite_file()
+    
+    async def flush(self) -> None:
+        """Сохранить все накопленные записи."""
+        async with self.lock:
+            await self.flush_locked()
+    
+    async def flush_locked(self) -> None:
+        """Сохранить все накопленные записи. Вызывается под lock."""
+        if not self.entries:
+            return
+        
+        batch = list(self.entries)
+        self.generation += 1
+        try:
+            await self.store_batch(batch)
+            # Пока пакет сохранялся, в журнал могли добавиться новые записи
+            self.entries = self.entries[len(batch):]
+            self._rewrite_file()
+        finally:
+            self.generation += 1
+    
+    def _rewrite_file(self) -> None:
+        """Оставить в файле журнала только несохраненные записи."""
+        if self._file is None:
+            return
+        self._file.seek(0)
+        self._file.truncate()
+        for user_id, messages in self.entries:
+            self._file.write(json.dumps({"user_id": user_id, "messages": messages}, ensure_ascii=False) + "\n")
+        self._file.flush()
+    
+    def _ensure_task(self) -> None:
+        """Запустить фоновое сохранение при первом обращении из цикла событий."""
+        if self._task is None and not self._closed:
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            
+            try:
+                await self.flush()
+            except Exception as e:
+                # Записи остаются в журнале и сохранятся следующим пакетом
+                ERRORS.inc(type="storage_flush")
+                logger.error(f"Ошибка сохранения журнала ({len(self.entries)} записей): {e}")
+    
+    async def close(self) -> None:
+        """Остановить фоновое сохранение и сохранить оставшиеся записи."""
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
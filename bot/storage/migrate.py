@@ -0,0 +1,93 @@
+"""
+Перенос истории MongoDB из массива messages профиля в коллекцию messages.
+
+Запуск (до запуска новой версии бота):
+    python -m bot.storage.migrate [--dry-run]
+
+Перенос можно прервать и запустить снова: профиль меняется последним,
+поэтому необработанные пользователи переносятся заново с нуля.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from typing import Any, Dict, List
+from dotenv import load_dotenv
+from bot.storage.mongo import MongoStorage
+
+logger = logging.getLogger(__name__)
+
+# Профили в старой схеме хранят историю в массиве messages
+LEGACY_FILTER = {"messages": {"$exists": True}}
+
+async def migrate_user(storage: MongoStorage, document: Dict[str, Any]) -> int:
+    """
+    Перенести историю одного пользователя.
+    
+    Args:
+        storage: Хранилище MongoDB
+        document: Профиль пользователя в старой схеме
+    
+    Returns:
+        Количество перенесенных сообщений
+    """
+    user_id = document["_id"]
+    messages: List[Dict[str, Any]] = document.get("messages") or []
+    system = [msg for msg in messages if msg.get("role") == "system"]
+    history = [msg for msg in messages if msg.get("role") != "system"]
+    
+    # Остатки прерванного переноса удаляются, чтобы не было повторов
+    await storage.messages_collection.delete_many({"user_id": user_id})
+    if history:
+        await storage.messages_collection.insert_many([
+            {"user_id": user_id, "seq": seq, **message}
+            for seq, message in enumerate(history, start=1)
+        ])
+    await storage.users_collection.update_one(
+        {"_id": user_id, **LEGACY_FILTER},
+        {"$set": {"system": system, "seq": len(history)}, "$unset": {"messages": ""}}
+    )
+    return len(history)
+
+async def migrate(dry_run: bool = False) -> Dict[str, int]:
+    """
+    Перенести историю всех пользователей в старой схеме.
+    
+    Args:
+        dry_run: Только посчитать пользователей, которых нужно перенести
+    
+    Returns:
+        Количество пользователей и сообщений
+    """
+    storage = MongoStorage()
+    try:
+        if dry_run:
+            return {"users": await storage.users_collection.count_documents(LEGACY_FILTER), "messages": 0}
+        
+        await storage.ensure_indexes()
+        users = messages = 0
+        async for document in storage.users_collection.find(LEGACY_FILTER, {"messages": 1}):
+            messages += await migrate_user(storage, document)
+            users += 1
+            if users % 1000 == 0:
+                logger.info(f"Перенесено пользователей: {users}")
+        return {"users": users, "messages": messages}
+    finally:
+        await storage.close()
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Перенос истории MongoDB в коллекцию messages")
+    parser.add_argument("--dry-run", action="store_true", help="Только посчитать пользователей в старой схеме")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    
+    load_dotenv()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    
+    result = asyncio.run(migrate(args.dry_run))
+    if args.dry_run:
+        logger.info(f"Пользователей в старой схеме: {result['users']}")
+    else:
+        logger.info(f"Перенесено пользователей: {result['users']}, сообщений: {result['messages']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+from typing import Dict, List, Any, Optional, Tuple
+import asyncio
+import os
+from pymongo import AsyncMongoClient, ASCENDING, DeleteMany, ReplaceOne, ReturnDocument, UpdateOne
+from bot.config import (
+    DEFAULT_MODEL, MAX_HISTORY_LENGTH, SYSTEM_MESSAGES,
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS, MONGO_TIMEOUT_MS
+)
+from bot.storage.base import QUOTA_FIELDS, USAGE_FIELDS, Storage, _merge_batch
+
+# Поля сообщения, которые читаются из базы
+MESSAGE_PROJECTION = {"_id": 0, "seq": 1, "role": 1, "content": 1, "tokens": 1, "summary": 1}
+
+class MongoStorage(Storage):
+    """
+    Хранилище данных пользователей в MongoDB.
+    
+    Схема из четырех коллекций:
+    - users: небольшой профиль пользователя - модель, системные сообщения
+      (системный промпт и краткое содержание), счетчик seq последнего
+      сообщения и summarized_seq последнего сообщения, вошедшего в краткое
+      содержание;
+    - messages: по документу на каждое сообщение диалога с составным
+      индексом (user_id, seq);
+    - quotas: окно квот пользователя, которое периодически сохраняет
+      контроль допуска запросов;
+    - usage: токены, время и стоимость запросов по пользователю, модели и часу.
+    
+    Объем данных и время каждой операции не зависят от длины диалога:
+    модель читается без истории, сообщения добавляются отдельными документами,
+    а обрезка истории - удаление диапазона seq по индексу.
+    
+    Сообщения вставляются как upsert по (user_id, seq), а номера пакета
+    журнала, который не удалось сохранить, запоминаются до его успешной
+    записи: повтор пакета после частично примененного bulk_write не
+    вставляет сообщения второй раз.
+    
+    Документы в старой схеме (история в массиве messages профиля)
+    переносятся командой python -m bot.storage.migrate.
+    """
+    
+    backend = "mongo"
+    
+    def __init__(self):
+        """Подготовка подключения к MongoDB. Клиент создается при первом обращении к базе."""
+        super().__init__()
+        self._client: Optional[AsyncMongoClient] = None
+        self._users_collection = None
+        self._messages_collection = None
+        self._quotas_collection = None
+        self._usage_collection = None
+        self._indexes_ready = False
+        # Номера, зарезервированные для несохраненных сообщений журнала каждого
+        # пользователя: журнал повторяет пакет, начиная с тех же сообщений
+        self._reserved: Dict[int, List[int]] = {}
+    
+    @property
+    def client(self) -> AsyncMongoClient:
+        """Асинхронный клиент MongoDB."""
+        if self._client is None:
+            # Получаем строку подключения из переменных окружения
+            mongo_uri = os.getenv("MONGODB_URI")
+            if not mongo_uri:
+                raise ValueError("MONGODB_URI environment variable is not set")
+            
+            # Создаем асинхронный клиент MongoDB с настраиваемым пулом соединений.
+            # Клиент не блокирует цикл событий: пока один запрос ждет ответа базы,
+            # бот продолжает обрабатывать сообщения других пользователей
+            self._client = AsyncMongoClient(
+                mongo_uri,
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+                serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+                connectTimeoutMS=MONGO_TIMEOUT_MS,
+            )
+        return self._client
+    
+    @property
+    def users_collection(self):
+        """Коллекция профилей пользователей."""
+        if self._users_collection is None:
+            self._users_collection = self.client.get_database("telegpt_db").users
+        return self._users_collection
+    
+    @property
+    def messages_collection(self):
+        """Коллекция сообщений диалогов."""
+        if self._messages_collection is None:
+            self._messages_collection = self.client.get_database("telegpt_db").messages
+        return self._messages_collection
+    
+    @property
+    def quotas_collection(self):
+        """Коллекция окон квот пользователей."""
+        if self._quotas_collection is None:
+            self._quotas_collection = self.client.get_database("telegpt_db").quotas
+        return self._quotas_collection
+    
+    @property
+    def usage_collection(self):
+        """Коллекция статистики использования моделей."""
+        if self._usage_collection is None:
+            self._usage_collection = self.client.get_database("telegpt_db").usage
+        return self._usage_collection
+    
+    async def ensure_indexes(self) -> None:
+        """Создать индексы истории (user_id, seq) и статистики по часам, если их еще нет."""
+        if not self._indexes_ready:
+            await self.messages_collection.create_index(
+                [("user_id", ASCENDING), ("seq", ASCENDING)],
+                unique=True
+            )
+            await self.usage_collection.create_index([("hour", ASCENDING)])
+            self._indexes_ready = True
+    
+    async def warm_up(self) -> None:
+        """Подключиться к MongoDB и создать индексы до первого сообщения."""
+        await self.client.admin.command("ping")
+        await self.ensure_indexes()
+    
+    async def _load_profile(self, user_id: int, projection: Dict[str, int]) -> Dict[str, Any]:
+        """Прочитать профиль пользователя, атомарно создав его при необходимости."""
+        # Находим пользователя или атомарно создаем запись по умолчанию
+        # за один запрос, без гонки между find_one и insert_one
+        return await self.users_collection.find_one_and_update(
+            {"_id": user_id},
+            {"$setOnInsert": {"model": DEFAULT_MODEL, "system": [], "seq": 0}},
+            projection=projection,
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def _load_user(self, user_id: int) -> Dict[str, Any]:
+        await self.ensure_indexes()
+        # Профиль и история читаются параллельно
+        profile, history = await asyncio.gather(
+            self._load_profile(user_id, {"model": 1, "system": 1, "summarized_seq": 1}),
+            self.messages_collection.find({"user_id": user_id}, MESSAGE_PROJECTION).sort("seq", ASCENDING).to_list(None)
+        )
+        # Сообщения, уже вошедшие в краткое содержание, но не удаленные из-за
+        # ошибки между записями, не показываем: их удалит следующая запись
+        summarized_seq = profile.get("summarized_seq", 0)
+        return {
+            "_id": user_id,
+            "model": profile.get("model", DEFAULT_MODEL),
+            "messages": profile.get("system", []) + [message for message in history if message.pop("seq") > summarized_seq]
+        }
+    
+    async def _load_model(self, user_id: int) -> str:
+        profile = await self._load_profile(user_id, {"model": 1})
+        return profile.get("model", DEFAULT_MODEL)
+    
+    async def _store_messages(self, user_id: int, messages: List[Dict[str, str]]) -> None:
+        await self.ensure_indexes()
+        seqs, trim_seq = await self._reserve(user_id, len(messages))
+        await self.messages_collection.bulk_write(self._append_requests(user_id, messages, seqs, trim_seq))
+    
+    async def _store_batch(self, batch: List[Tuple[int, List[Dict[str, Any]]]]) -> None:
+        await self.ensure_indexes()
+        merged = _merge_batch(batch)
+        # Номера резервируются параллельно, а сообщения всех пользователей
+        # вставляются и обрезаются одним пакетным запросом
+        reservations = await asyncio.gather(*(
+            self._reserve_batch(user_id, messages)
+            for user_id, messages in merged.items()
+        ))
+        await self.messages_collection.bulk_write(
+            [
+                request
+                for (user_id, messages), (seqs, trim_seq) in zip(merged.items(), reservations)
+                for request in self._append_requests(user_id, messages, seqs, trim_seq)
+            ],
+            ordered=False
+        )
+        # Пакет сохранен: при следующем сохранении номера резервируются заново
+        for user_id in merged:
+            self._reserved.pop(user_id, None)
+    
+    async def _reserve_batch(self, user_id: int, messages: List[Dict[str, Any]]) -> Tuple[List[int], int]:
+        """
+        Номера для сообщений пакета журнала.
+        
+        Если предыдущее сохранение пакета не удалось, его сообщения идут
+        первыми и получают те же номера, новые номера резервируются только
+        для добавленных после него.
+        """
+        reserved = self._reserved.get(user_id, [])[:len(messages)]
+        seqs, trim_seq = await self._reserve(user_id, len(messages) - len(reserved))
+        seqs = self._reserved[user_id] = reserved + seqs
+        return seqs, trim_seq
+    
+    async def _reserve(self, user_id: int, count: int) -> Tuple[List[int], int]:
+        """
+        Зарезервировать номера для новых сообщений одним атомарным инкрементом.
+        
+        Args:
+            user_id: ID пользователя
+            count: Количество сообщений
+        
+        Returns:
+            Номера сообщений и номер, до которого включительно история обрезается
+        """
+        profile = await self.users_collection.find_one_and_update(
+            {"_id": user_id},
+            {
+                "$inc": {"seq": count},
+                "$setOnInsert": {"model": DEFAULT_MODEL, "system": []}
+            },
+            projection={"seq": 1, "summarized_seq": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        last_seq = profile["seq"]
+        # Номера сообщений идут подряд, поэтому последние MAX_HISTORY_LENGTH * 2
+        # сообщения - это seq > last_seq - MAX_HISTORY_LENGTH * 2, а остальное
+        # удаляется по диапазону индекса. Заодно удаляются сообщения, которые
+        # остались после прерванной замены кратким содержанием
+        trim_seq = max(last_seq - MAX_HISTORY_LENGTH * 2, profile.get("summarized_seq", 0))
+        return list(range(last_seq - count + 1, last_seq + 1)), trim_seq
+    
+    @staticmethod
+    def _append_requests(user_id: int, messages: List[Dict[str, Any]], seqs: List[int], trim_seq: int) -> List[Any]:
+        """
+        Построить запросы вставки сообщений и обрезки истории.
+        
+        Args:
+            user_id: ID пользователя
+            messages: Добавляемые сообщения
+            seqs: Номера сообщений
+            trim_seq: Номер, до которого включительно история обрезается
+        
+        Returns:
+            Запросы для bulk_write коллекции messages
+        """
+        # Вставка по уникальному индексу (user_id, seq): повтор ничего не меняет
+        return [
+            *(
+                UpdateOne({"user_id": user_id, "seq": seq}, {"$setOnInsert": message}, upsert=True)
+                for seq, message in zip(seqs, messages)
+            ),
+            DeleteMany({"user_id": user_id, "seq": {"$lte": trim_seq}})
+        ]
+    
+    async def _reset(self, user_id: int, model: Optional[str]) -> None:
+        # Несохраненные сообщения журнала выброшены вместе с их номерами
+        self._reserved.pop(user_id, None)
+        await self.users_collection.update_one(
+            {"_id": user_id},
+            self._reset_pipeline(model),
+            upsert=True
+        )
+        await self.messages_collection.delete_many({"user_id": user_id})
+    
+    @classmethod
+    def _reset_pipeline(cls, model: Optional[str]) -> List[Dict[str, Any]]:
+        """
+        Построить конвейер обновления профиля, который оставляет только системный промпт.
+        
+        Args:
+            model: Новая модель пользователя (None - оставить текущую)
+        
+        Returns:
+            Конвейер для update_one
+        """
+        if model is not None:
+            return [{"$set": {
+                "model": {"$literal": model},
+                "system": {"$literal": [cls._system_message(model)]},
+                "seq": {"$ifNull": ["$seq", 0]}
+            }}]
+        
+        # Модель неизвестна без чтения, поэтому выбираем системное сообщение на сервере
+        return [
+            {"$set": {"model": {"$ifNull": ["$model", DEFAULT_MODEL]}, "seq": {"$ifNull": ["$seq", 0]}}},
+            {"$set": {"system": [{"$switch": {
+                "branches": [
+                    {"case": {"$eq": ["$model", name]}, "then": {"$literal": cls._system_message(name)}}
+                    for name in SYSTEM_MESSAGES
+                ],
+                "default": {"$literal": cls._system_message(DEFAULT_MODEL)}
+            }}]}}
+        ]
+    
+    async def _replace_with_summary(
+        self,
+        user_id: int,
+        summarized: List[Dict[str, Any]],
+        summary: Dict[str, Any]
+    ) -> bool:
+        profile = await self.users_collection.find_one({"_id": user_id}, {"summarized_seq": 1})
+        summarized_seq = (profile or {}).get("summarized_seq", 0)
+        
+        # Сжатые сообщения все еще должны быть началом истории
+        oldest = await self.messages_collection.find(
+            {"user_id": user_id, "seq": {"$gt": summarized_seq}},
+            {"_id": 0, "seq": 1, "role": 1, "content": 1}
+        ).sort("seq", ASCENDING).limit(len(summarized)).to_list(None)
+        if not oldest or not self._same_message(oldest[0], summarized[0]) or not any(
+            self._same_message(message, summarized[-1]) for message in oldest
+        ):
+            return False
+        
+        # Краткое содержание заменяет прежнее в системных сообщениях профиля
+        # той же записью, что отмечает сжатые сообщения. Если удалить их
+        # не удастся, чтение их уже не покажет, а удалит следующая запись
+        await self.users_collection.update_one(
+            {"_id": user_id},
+            [{"$set": {
+                "system": {"$concatArrays": [
+                    {"$filter": {
+                        "input": {"$ifNull": ["$system", []]},
+                        "cond": {"$ne": [{"$ifNull": ["$$this.summary", False]}, True]}
+                    }},
+                    {"$literal": [summary]}
+                ]},
+                "summarized_seq": {"$literal": oldest[-1]["seq"]}
+            }}]
+        )
+        await self.messages_collection.delete_many({"user_id": user_id, "seq": {"$lte": oldest[-1]["seq"]}})
+        return True
+    
+    @staticmethod
+    def _same_message(stored: Dict[str, Any], message: Dict[str, Any]) -> bool:
+        return stored["role"] == message["role"] and stored["content"] == message["content"]
+    
+    async def _store_model(self, user_id: int, model: str) -> None:
+        await self.users_collection.update_one(
+            {"_id": user_id},
+            {"$set": {"model": model}}
+        )
+    
+    async def _load_quotas(self, since: float) -> Dict[int, Dict[str, float]]:
+        documents = await self.quotas_collection.find({"start": {"$gte": since}}).to_list(None)
+        return {
+            document["_id"]: {field: document.get(field, 0) for field in QUOTA_FIELDS}
+            for document in documents
+        }
+    
+    async def _store_quotas(self, quotas: Dict[int, Dict[str, float]]) -> None:
+        await self.quotas_collection.bulk_write(
+            [
+                ReplaceOne({"_id": user_id}, {"_id": user_id, **quota}, upsert=True)
+                for user_id, quota in quotas.items()
+            ],
+            ordered=False
+        )
+    
+    async def _load_usage(self, since: int) -> List[Dict[str, Any]]:
+        return await self.usage_collection.find({"hour": {"$gte": since}}, {"_id": 0}).to_list(None)
+    
+    async def _store_usage(self, usage: Dict[Tuple[int, str, int], Dict[str, float]]) -> None:
+        await self.ensure_indexes()
+        await self.usage_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": f"{user_id}:{model}:{hour}"},
+                    {
+                        "$inc": {field: totals[field] for field in USAGE_FIELDS},
+                        "$setOnInsert": {"user_id": user_id, "model": model, "hour": hour}
+                    },
+                    upsert=True
+                )
+                for (user_id, model, hour), totals in usage.items()
+            ],
+            ordered=False
+        )
+    
+    async def _close(self) -> None:
+        """Закрыть пул соединений с MongoDB."""
+        if self._client is not None:
+            await self._client.close()
@@ -0,0 +1,239 @@
+import sqlite3
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from bot.config import DEFAULT_MODEL, MAX_HISTORY_LENGTH, SQLITE_PATH
+from bot.storage.base import QUOTA_FIELDS, USAGE_FIELDS, Storage, _merge_batch
+
+# Схема: модель пользователя и история, упорядоченная по (user_id, seq).
+# Первичный ключ messages служит индексом истории пользователя, а WITHOUT ROWID
+# хранит сообщения пользователя рядом, так что история читается одним проходом
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    model TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    user_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER,
+    summary INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS quotas (
+    user_id INTEGER PRIMARY KEY,
+    start REAL NOT NULL,
+    requests REAL NOT NULL,
+    tokens REAL NOT NULL,
+    previous_requests REAL NOT NULL,
+    previous_tokens REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usage (
+    hour INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    cost REAL NOT NULL,
+    PRIMARY KEY (hour, user_id, model)
+) WITHOUT ROWID;
+"""
+
+# Запросы - постоянные строки: sqlite3 подготавливает каждую один раз
+# и берет готовую из кэша подготовленных запросов соединения
+ENSURE_USER = "INSERT INTO users (user_id, model) VALUES (?, ?) ON CONFLICT (user_id) DO NOTHING"
+SELECT_MODEL = "SELECT model FROM users WHERE user_id = ?"
+SELECT_MESSAGES = "SELECT role, content, tokens, summary FROM messages WHERE user_id = ? ORDER BY seq"
+SELECT_LAST_SEQ = "SELECT COALESCE(MAX(seq), 0) FROM messages WHERE user_id = ?"
+INSERT_MESSAGE = "INSERT INTO messages (user_id, seq, role, content, tokens, summary) VALUES (?, ?, ?, ?, ?, ?)"
+# Удаляет все, кроме последних ? несистемных сообщений: одно удаление диапазона по индексу
+TRIM_MESSAGES = """
+DELETE FROM messages
+WHERE user_id = ? AND role != 'system' AND seq <= (
+    SELECT seq FROM messages WHERE user_id = ? AND role != 'system'
+    ORDER BY seq DESC LIMIT 1 OFFSET ?
+)
+"""
+UPSERT_MODEL = "INSERT INTO users (user_id, model) VALUES (?, ?) ON CONFLICT (user_id) DO UPDATE SET model = excluded.model"
+DELETE_MESSAGES = "DELETE FROM messages WHERE user_id = ?"
+SELECT_OTHER_MESSAGES = "SELECT seq, role, content FROM messages WHERE user_id = ? AND role != 'system' ORDER BY seq"
+DELETE_SUMMARIZED = "DELETE FROM messages WHERE user_id = ? AND ((role != 'system' AND seq <= ?) OR summary = 1)"
+SELECT_QUOTAS = "SELECT user_id, start, requests, tokens, previous_requests, previous_tokens FROM quotas WHERE start >= ?"
+UPSERT_QUOTA = """
+INSERT INTO quotas (user_id, start, requests, tokens, previous_requests, previous_tokens) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (user_id) DO UPDATE SET
+    start = excluded.start, requests = excluded.requests, tokens = excluded.tokens,
+    previous_requests = excluded.previous_requests, previous_tokens = excluded.previous_tokens
+"""
+SELECT_USAGE = "SELECT user_id, model, hour, requests, prompt_tokens, completion_tokens, seconds, cost FROM usage WHERE hour >= ?"
+ADD_USAGE = """
+INSERT INTO usage (hour, user_id, model, requests, prompt_tokens, completion_tokens, seconds, cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (hour, user_id, model) DO UPDATE SET
+    requests = requests + excluded.requests, prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+    completion_tokens = completion_tokens + excluded.completion_tokens,
+    seconds = seconds + excluded.seconds, cost = cost + excluded.cost
+"""
+
+class SQLiteStorage(Storage):
+    """
+    Встроенное хранилище данных пользователей в SQLite (режим WAL).
+    
+    Для одного узла это избавляет от сетевого запроса на каждое сообщение:
+    чтение и запись истории - локальные операции, занимающие микросекунды.
+    Поэтому запросы выполняются прямо в цикле событий, без пула потоков,
+    переключение на который обошлось бы дороже самого запроса.
+    """
+    
+    backend = "sqlite"
+    
+    def __init__(self, path: str = SQLITE_PATH):
+        """
+        Args:
+            path: Путь к файлу базы данных
+        """
+        super().__init__()
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+    
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Соединение с базой; открывается при первом обращении."""
+        if self._connection is None:
+            # Транзакции открываются явно, см. _transaction
+            connection = sqlite3.connect(self.path, isolation_level=None, cached_statements=64)
+            # WAL: читатели не блокируют писателя, а запись не ждет fsync на каждую транзакцию
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute("PRAGMA busy_timeout = 5000")
+            connection.executescript(SCHEMA)
+            self._connection = connection
+        return self._connection
+    
+    async def warm_up(self) -> None:
+        """Открыть базу и создать схему до первого сообщения."""
+        self.connection
+    
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        """Выполнить несколько запросов одной транзакцией."""
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+    
+    async def _load_user(self, user_id: int) -> Dict[str, Any]:
+        with self._transaction() as cursor:
+            cursor.execute(ENSURE_USER, (user_id, DEFAULT_MODEL))
+            model = cursor.execute(SELECT_MODEL, (user_id,)).fetchone()[0]
+            rows = cursor.execute(SELECT_MESSAGES, (user_id,)).fetchall()
+        return {"_id": user_id, "model": model, "messages": [self._row_to_message(row) for row in rows]}
+    
+    async def _load_model(self, user_id: int) -> str:
+        with self._transaction() as cursor:
+            cursor.execute(ENSURE_USER, (user_id, DEFAULT_MODEL))
+            return cursor.execute(SELECT_MODEL, (user_id,)).fetchone()[0]
+    
+    @staticmethod
+    def _row_to_message(row: tuple) -> Dict[str, Any]:
+        role, content, tokens, summary = row
+        message = {"role": role, "content": content}
+        if tokens is not None:
+            message["tokens"] = tokens
+        if summary:
+            message["summary"] = True
+        return message
+    
+    @staticmethod
+    def _message_row(user_id: int, seq: int, message: Dict[str, Any]) -> tuple:
+        return (user_id, seq, message["role"], message["content"], message.get("tokens"), int(bool(message.get("summary"))))
+    
+    async def _store_messages(self, user_id: int, messages: List[Dict[str, str]]) -> None:
+        with self._transaction() as cursor:
+            self._insert_messages(cursor, user_id, messages)
+    
+    async def _store_batch(self, batch: List[Tuple[int, List[Dict[str, Any]]]]) -> None:
+        # Весь пакет - одна транзакция и одна запись в WAL
+        with self._transaction() as cursor:
+            for user_id, messages in _merge_batch(batch).items():
+                self._insert_messages(cursor, user_id, messages)
+    
+    def _insert_messages(self, cursor: sqlite3.Cursor, user_id: int, messages: List[Dict[str, Any]]) -> None:
+        """Добавить сообщения пользователя и обрезать историю внутри открытой транзакции."""
+        cursor.execute(ENSURE_USER, (user_id, DEFAULT_MODEL))
+        last_seq = cursor.execute(SELECT_LAST_SEQ, (user_id,)).fetchone()[0]
+        cursor.executemany(INSERT_MESSAGE, [
+            self._message_row(user_id, last_seq + number, message)
+            for number, message in enumerate(messages, start=1)
+        ])
+        cursor.execute(TRIM_MESSAGES, (user_id, user_id, MAX_HISTORY_LENGTH * 2))
+    
+    async def _reset(self, user_id: int, model: Optional[str]) -> None:
+        with self._transaction() as cursor:
+            if model is None:
+                cursor.execute(ENSURE_USER, (user_id, DEFAULT_MODEL))
+                model = cursor.execute(SELECT_MODEL, (user_id,)).fetchone()[0]
+            else:
+                cursor.execute(UPSERT_MODEL, (user_id, model))
+            cursor.execute(DELETE_MESSAGES, (user_id,))
+            cursor.execute(INSERT_MESSAGE, self._message_row(user_id, 0, self._system_message(model)))
+    
+    async def _replace_with_summary(
+        self,
+        user_id: int,
+        summarized: List[Dict[str, Any]],
+        summary: Dict[str, Any]
+    ) -> bool:
+        first, last = summarized[0], summarized[-1]
+        with self._transaction() as cursor:
+            oldest = cursor.execute(SELECT_OTHER_MESSAGES, (user_id,)).fetchall()[:len(summarized)]
+            # Сжатые сообщения все еще должны быть началом истории: после сброса
+            # или обрезки удалились бы не те сообщения
+            if not oldest or oldest[0][1:] != (first["role"], first["content"]) or (last["role"], last["content"]) not in {
+                (role, content) for _, role, content in oldest
+            }:
+                return False
+            
+            # Краткое содержание занимает место последнего сжатого сообщения:
+            # после системного сообщения и перед оставшейся историей
+            cutoff = oldest[-1][0]
+            cursor.execute(DELETE_SUMMARIZED, (user_id, cutoff))
+            cursor.execute(INSERT_MESSAGE, self._message_row(user_id, cutoff, summary))
+        return True
+    
+    async def _store_model(self, user_id: int, model: str) -> None:
+        self.connection.execute(UPSERT_MODEL, (user_id, model))
+    
+    async def _load_quotas(self, since: float) -> Dict[int, Dict[str, float]]:
+        rows = self.connection.execute(SELECT_QUOTAS, (since,)).fetchall()
+        return {row[0]: dict(zip(QUOTA_FIELDS, row[1:])) for row in rows}
+    
+    async def _store_quotas(self, quotas: Dict[int, Dict[str, float]]) -> None:
+        with self._transaction() as cursor:
+            cursor.executemany(UPSERT_QUOTA, [
+                (user_id, *(quota[field] for field in QUOTA_FIELDS))
+                for user_id, quota in quotas.items()
+            ])
+    
+    async def _load_usage(self, since: int) -> List[Dict[str, Any]]:
+        rows = self.connection.execute(SELECT_USAGE, (since,)).fetchall()
+        return [dict(zip(("user_id", "model", "hour", *USAGE_FIELDS), row)) for row in rows]
+    
+    async def _store_usage(self, usage: Dict[Tuple[int, str, int], Dict[str, float]]) -> None:
+        with self._transaction() as cursor:
+            cursor.executemany(ADD_USAGE, [
+                (hour, user_id, model, *(totals[field] for field in USAGE_FIELDS))
+                for (user_id, model, hour), totals in usage.items()
+            ])
+    
+    async def _close(self) -> None:
+        """Закрыть соединение с базой."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+from telegram import Message
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter, TelegramError
+
+from bot.config import STREAM_EDIT_INTERVAL, STREAM_PLACEHOLDER
+from bot.sender import sender, split_text, retry_after_seconds
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class StreamingReply:
+    """
+    Ответ, который постепенно дописывается правками одного сообщения.
+    
+    Правки объединяются: сообщение обновляется не чаще одного раза
+    за STREAM_EDIT_INTERVAL секунд, чтобы не упираться в лимиты Telegram.
+    Промежуточные правки отправляются в фоне: пока правка ждет очереди
+    отправителя, ответ модели продолжает читаться.
+    """
+    
+    def __init__(self, message: Message, interval: float = STREAM_EDIT_INTERVAL):
+        """
+        Args:
+            message: Сообщение пользователя, на которое отвечаем
+            interval: Минимальный интервал между правками в секундах
+        """
+        self.message = message
+        self.interval = interval
+        self.reply = None
+        self.shown_text = ""
+        self.next_edit_at = 0.0
+        self.edit_task: Optional[asyncio.Task] = None
+    
+    async def start(self) -> None:
+        """Отправить сообщение-заглушку, которое будет дописываться."""
+        self.reply = (await sender.reply(self.message, STREAM_PLACEHOLDER))[0]
+        self.next_edit_at = time.monotonic() + self.interval
+    
+    async def update(self, text: str) -> None:
+        """
+        Показать текущий текст ответа, если с прошлой правки прошло достаточно времени.
+        
+        Args:
+            text: Весь сгенерированный на данный момент текст
+        """
+        if time.monotonic() < self.next_edit_at or (self.edit_task is not None and not self.edit_task.done()):
+            return
+        self.edit_task = asyncio.create_task(self._edit(text[:MessageLimit.MAX_TEXT_LENGTH]))
+    
+    async def finish(self, text: str) -> None:
+        """
+        Показать окончательный текст ответа.
+        
+        Текст длиннее лимита Telegram делится по абзацам и блокам кода,
+        остальные части отправляются отдельными сообщениями.
+        
+        Args:
+            text: Полный текст ответа
+        """
+        if self.edit_task is not None:
+            await self.edit_task
+        first, *rest = split_text(text)
+        await self._edit(first, force=True)
+        for chunk in rest:
+            await sender.reply(self.message, chunk)
+    
+    async def discard(self) -> None:
+        """Удалить сообщение-заглушку, если ответ отменен до появления текста."""
+        if self.edit_task is not None:
+            self.edit_task.cancel()
+        if self.reply is None or self.shown_text:
+            return
+        try:
+            await self.reply.delete()
+        except TelegramError as e:
+            logger.warning(f"Не удалось удалить сообщение-заглушку: {str(e)}")
+    
+    async def _edit(self, text: str, force: bool = False) -> None:
+        """Отредактировать сообщение-заглушку, пропуская правки без изменений."""
+        if not text or text == self.shown_text:
+            return
+        try:
+            # Окончательный текст нельзя потерять, поэтому при flood wait отправитель
+            # дожидается разрешения; промежуточную правку проще пропустить
+            await sender.edit(self.reply, text, wait_flood=force)
+            self.shown_text = text
+            self.next_edit_at = time.monotonic() + self.interval
+        except RetryAfter as e:
+            self.next_edit_at = time.monotonic() + retry_after_seconds(e)
+        except TelegramError as e:
+            if force:
+                raise
+            # Промежуточная правка не обязательна: окончательный текст покажет следующая
+            logger.warning(f"Не удалось обновить ответ: {str(e)}")
+            self.next_edit_at = time.monotonic() + self.interval
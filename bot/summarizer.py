@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Set
+
+from bot.config import (
+    SUMMARY_ENABLED, SUMMARY_MODEL, SUMMARY_THRESHOLD, SUMMARY_KEEP_RECENT,
+    SUMMARY_PROMPT, SUMMARY_PREFIX
+)
+from bot.storage import storage, ConversationTurn
+from services.ai_service import get_completion
+from services.errors import CompletionError
+from services.tokens import count_tokens
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class HistorySummarizer:
+    """
+    Фоновое сжатие длинной истории диалога.
+    
+    Когда история превышает SUMMARY_THRESHOLD сообщений, самые старые из них
+    (кроме последних SUMMARY_KEEP_RECENT) заменяются кратким содержанием,
+    которое готовит SUMMARY_MODEL. Сжатие выполняется отдельной задачей
+    после ответа пользователю и не влияет на время ответа.
+    """
+    
+    def __init__(self):
+        # Пользователи, для которых сжатие уже выполняется
+        self._running: Set[int] = set()
+        # Ссылки на фоновые задачи, чтобы их не удалил сборщик мусора
+        self._tasks: Set[asyncio.Task] = set()
+    
+    def schedule(self, turn: ConversationTurn) -> None:
+        """
+        Запустить сжатие истории в фоне, если она стала слишком длинной.
+        
+        Args:
+            turn: Только что сохраненный обмен сообщениями
+        """
+        if not SUMMARY_ENABLED or turn.user_id in self._running:
+            return
+        
+        # История до обмена плюс вопрос и ответ
+        length = sum(1 for msg in turn.history if msg["role"] != "system") + 2
+        if length <= SUMMARY_THRESHOLD:
+            return
+        
+        self._running.add(turn.user_id)
+        task = asyncio.create_task(self._summarize(turn.user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _summarize(self, user_id: int) -> None:
+        """Сжать историю пользователя."""
+        try:
+            messages = await storage.get_messages(user_id)
+            history = [msg for msg in messages if msg["role"] != "system"]
+            summarized = history[:-SUMMARY_KEEP_RECENT]
+            if not summarized:
+                return
+            
+            previous = next((msg for msg in messages if msg.get("summary")), None)
+            text = await get_completion(self._build_prompt(previous, summarized), SUMMARY_MODEL)
+            
+            content = SUMMARY_PREFIX + text
+            summary = {
+                "role": "system",
+                "content": content,
+                "tokens": count_tokens(content, SUMMARY_MODEL),
+                "summary": True
+            }
+            if await storage.apply_summary(user_id, summarized, summary):
+                logger.info(f"История пользователя {user_id} сжата: {len(summarized)} сообщений")
+        
+        except CompletionError as e:
+            logger.warning(f"Не удалось сжать историю пользователя {user_id}: {e.user_message}")
+        except Exception as e:
+            logger.error(f"Ошибка при сжатии истории пользователя {user_id}: {str(e)}", exc_info=True)
+        finally:
+            self._running.discard(user_id)
+    
+    @staticmethod
+    def _build_prompt(previous: Dict[str, Any], summarized: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        """Собрать запрос к модели: прежнее краткое содержание и сжимаемые сообщения."""
+        roles = {"user": "Пользователь", "assistant": "Ассистент"}
+        lines = []
+        if previous:
+            lines.append(previous["content"])
+        lines += [f"{roles.get(msg['role'], msg['role'])}: {msg['content']}" for msg in summarized]
+        return [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": "\n\n".join(lines)}
+        ]
+    
+    async def close(self) -> None:
+        """Дождаться завершения начатых сжатий."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+# Создаем единый экземпляр
+summarizer = HistorySummarizer()
@@ -1,15 +1,17 @@
+import asyncio
 import os
 import logging
 from dotenv import load_dotenv
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 
-from bot.handlers import start_handler, help_handler, reset_handler, model_handler, message_handler, model_callback_handler
-from bot.config import WEBHOOK_URL, PORT
-
-# Загружаем переменные окружения из файла .env
+# Загружаем переменные окружения из файла .env до импорта модулей бота:
+# настройки из bot/config.py и хранилище читаются при импорте
 load_dotenv()
 
+# Отсчет времени запуска начинается до импорта остальных модулей бота
+from bot.startup import startup
+from bot.config import WEBHOOK_URL, PORT, WORKERS, STORAGE_BACKEND
+
 # Настройка логирования
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -18,32 +20,35 @@ logger = logging.getLogger(__name__)
 
 def main() -> None:
     """Запуск бота."""
-    # Создаем экземпляр приложения бота
-    application = Application.builder().token(os.getenv("BOT_TOKEN")).build()
-
-    # Регистрируем обработчики команд
-    application.add_handler(CommandHandler("start", start_handler))
-    application.add_handler(CommandHandler("help", help_handler))
-    application.add_handler(CommandHandler("reset", reset_handler))
-    application.add_handler(CommandHandler("model", model_handler))
+    production = os.getenv("ENVIRONMENT") == "production"
     
-    # Обработчик для кнопок выбора модели
-    application.add_handler(CallbackQueryHandler(model_callback_handler, pattern="^model:"))
+    if production and WORKERS > 1:
+        if STORAGE_BACKEND == "sqlite":
+            # Процессы конкурировали бы за запись в один файл базы, а SQLite ждет
+            # блокировки синхронно, останавливая цикл событий процесса до 5 секунд
+            logger.error("Несколько рабочих процессов не поддерживаются с STORAGE_BACKEND=sqlite: задайте WORKERS=1 или используйте MongoDB")
+            raise SystemExit(1)
+        # Принимающий процесс только распределяет обновления: обработчики,
+        # хранилище и клиенты провайдеров загружают рабочие процессы
+        from bot.cluster import run_cluster
+        asyncio.run(run_cluster(PORT, WEBHOOK_URL, WORKERS))
+        return
+    if WORKERS > 1:
+        logger.warning("Несколько рабочих процессов поддерживаются только в режиме webhook, запускаем один")
+    
+    from bot.application import build_application
+    from bot.server import run_webhook
+    startup.mark("import")
+    
+    application = build_application(polling=not production)
     
-    # Регистрируем обработчик текстовых сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-
     # Настройка webhook или polling в зависимости от окружения
-    if os.getenv("ENVIRONMENT") == "production":
-        # Используем webhook для production
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            webhook_url=WEBHOOK_URL,
-        )
+    if production:
+        # Используем webhook для production, метрики отдаются на том же порту
+        asyncio.run(run_webhook(application, PORT, WEBHOOK_URL))
     else:
         # Используем polling для разработки
         application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,328 @@
+import asyncio
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Set, Tuple
+
+from bot.config import (
+    ADMISSION_MAX_PENDING, ADMISSION_MODEL_SHARES, ADMISSION_BACKGROUND_SHARE,
+    USER_QUOTA_WINDOW, USER_REQUEST_QUOTA, USER_TOKEN_QUOTA, USER_QUOTA_SAVE_INTERVAL
+)
+from bot.metrics import ADMISSIONS, ERRORS
+from bot.storage import storage
+from services.errors import AdmissionError
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Ответ, когда запросов в работе больше, чем допускает лимит
+BUSY_MESSAGE = "Извините, сейчас слишком много запросов. Пожалуйста, попробуйте через минуту."
+
+# Ответ, когда перегружена только выбранная модель, а более быстрые еще принимают запросы
+BUSY_MODEL_MESSAGE = "Извините, эта модель сейчас перегружена. Пожалуйста, попробуйте через минуту или выберите более быструю модель с помощью команды /model."
+
+# Ответ пользователю, исчерпавшему квоту
+QUOTA_MESSAGE = "Вы исчерпали лимит запросов. Пожалуйста, попробуйте снова через {} мин."
+
+class _QuotaWindow:
+    """
+    Счетчики пользователя в скользящем окне.
+    
+    Хранятся счетчики текущего и предыдущего периодов длиной в окно.
+    Использование за последние window секунд оценивается как счетчик
+    текущего периода плюс часть предыдущего, пропорциональная тому, насколько
+    окно еще его захватывает. Это пять чисел на пользователя вместо журнала
+    всех запросов, и их легко сохранить.
+    """
+    
+    __slots__ = ("start", "requests", "tokens", "previous_requests", "previous_tokens")
+    
+    def __init__(
+        self,
+        start: float,
+        requests: float = 0,
+        tokens: float = 0,
+        previous_requests: float = 0,
+        previous_tokens: float = 0
+    ):
+        self.start = start
+        self.requests = requests
+        self.tokens = tokens
+        self.previous_requests = previous_requests
+        self.previous_tokens = previous_tokens
+    
+    def advance(self, now: float, length: float) -> None:
+        """Перейти к периоду, в который попадает now."""
+        periods = int((now - self.start) // length)
+        if periods <= 0:
+            return
+        if periods == 1:
+            self.previous_requests, self.previous_tokens = self.requests, self.tokens
+        else:
+            self.previous_requests = self.previous_tokens = 0
+        self.requests = self.tokens = 0
+        self.start += periods * length
+    
+    def usage(self, now: float, length: float) -> Tuple[float, float]:
+        """Запросы и токены за последние length секунд."""
+        weight = 1 - (now - self.start) / length
+        return self.requests + self.previous_requests * weight, self.tokens + self.previous_tokens * weight
+    
+    def to_dict(self) -> Dict[str, float]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+def _retry_after(current: float, previous: float, limit: float, elapsed: float, length: float) -> float:
+    """
+    Через сколько секунд оценка использования опустится ниже лимита.
+    
+    Args:
+        current: Счетчик текущего периода
+        previous: Счетчик предыдущего периода
+        limit: Квота
+        elapsed: Время от начала текущего периода
+        length: Длина окна
+    
+    Returns:
+        Время ожидания в секундах
+    """
+    if current >= limit:
+        # Текущий период станет предыдущим и будет уходить из окна
+        return length - elapsed + length * (1 - limit / current)
+    return max(0.0, length * (1 - (limit - current) / previous) - elapsed)
+
+class AdmissionController:
+    """
+    Контроль допуска запросов к моделям.
+    
+    Проверяется до того, как запрос встанет в очередь провайдера:
+    - общий лимит запросов в работе: сверх него пользователь сразу получает
+      ответ "попробуйте позже", вместо того чтобы ждать в очереди вместе со
+      всеми и замедлять ответы остальным;
+    - приоритет моделей: запрос к модели принимается, пока в работе меньше
+      ее доли общего лимита, поэтому при перегрузке запросы к быстрым
+      моделям продолжают приниматься, когда к дорогим - уже нет;
+    - квоты пользователя на запросы и токены в скользящем окне.
+    
+    Квоты хранятся в памяти процесса и сохраняются в хранилище раз в
+    save_interval секунд, поэтому перезапуск не обнуляет их. Состояние
+    загружается при первом запросе. В режиме нескольких рабочих процессов
+    пользователь всегда обрабатывается одним процессом, а лимит запросов
+    в работе действует в каждом процессе отдельно.
+    """
+    
+    def __init__(
+        self,
+        max_pending: int = ADMISSION_MAX_PENDING,
+        shares: Dict[str, float] = ADMISSION_MODEL_SHARES,
+        background_share: float = ADMISSION_BACKGROUND_SHARE,
+        window: float = USER_QUOTA_WINDOW,
+        request_quota: int = USER_REQUEST_QUOTA,
+        token_quota: int = USER_TOKEN_QUOTA,
+        save_interval: float = USER_QUOTA_SAVE_INTERVAL
+    ):
+        """
+        Args:
+            max_pending: Максимум запросов в работе (0 - без ограничения)
+            shares: Доля лимита, доступная запросам к каждой модели
+            background_share: Доля лимита для фоновых запросов без пользователя
+            window: Длина скользящего окна квот в секундах
+            request_quota: Запросов пользователя в окне (0 - без ограничения)
+            token_quota: Токенов пользователя в окне (0 - без ограничения)
+            save_interval: Период сохранения квот в секундах
+        """
+        self.max_pending = max_pending
+        self.shares = shares
+        self.background_share = background_share
+        self.window = window
+        self.request_quota = request_quota
+        self.token_quota = token_quota
+        self.save_interval = save_interval
+        
+        self.pending = 0
+        self.windows: Dict[int, _QuotaWindow] = {}
+        # Пользователи, окна которых изменились после последнего сохранения
+        self.dirty: Set[int] = set()
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+    
+    @property
+    def quotas_enabled(self) -> bool:
+        """Заданы ли квоты пользователей."""
+        return bool(self.request_quota or self.token_quota)
+    
+    @asynccontextmanager
+    async def admit(self, user_id: Optional[int], model: str) -> AsyncIterator[None]:
+        """
+        Принять запрос к модели на время выполнения блока.
+        
+        Args:
+            user_id: ID пользователя (None - фоновый запрос, без квот)
+            model: Название модели
+        
+        Raises:
+            AdmissionError: Если бот перегружен или пользователь исчерпал квоту
+        """
+        if user_id is not None and self.quotas_enabled:
+            await self._ensure_loaded()
+            self._ensure_task()
+        self.check(user_id, model)
+        
+        self.pending += 1
+        if user_id is not None and self.quotas_enabled:
+            self._window(user_id).requests += 1
+            self.dirty.add(user_id)
+        ADMISSIONS.inc(model=model, result="admitted")
+        try:
+            yield
+        finally:
+            self.pending -= 1
+    
+    def check(self, user_id: Optional[int], model: str) -> None:
+        """
+        Проверить, можно ли принять запрос.
+        
+        Args:
+            user_id: ID пользователя (None - фоновый запрос)
+            model: Название модели
+        
+        Raises:
+            AdmissionError: Если запрос нужно отклонить
+        """
+        if self.max_pending and self.pending >= self.max_pending * self._share(user_id, model):
+            ADMISSIONS.inc(model=model, result="busy")
+            logger.warning(f"Запрос к {model} отклонен: в работе {self.pending} запросов")
+            # Если перегружена только эта модель, подсказываем выбрать другую
+            message = BUSY_MODEL_MESSAGE if self.pending < self.max_pending else BUSY_MESSAGE
+            raise AdmissionError(message, "busy")
+        
+        if user_id is None or not self.quotas_enabled:
+            return
+        retry_after = self._quota_retry_after(user_id)
+        if retry_after is not None:
+            ADMISSIONS.inc(model=model, result="quota")
+            logger.info(f"Пользователь {user_id} исчерпал квоту, следующий запрос через {retry_after:.0f} с")
+            raise AdmissionError(QUOTA_MESSAGE.format(max(1, math.ceil(retry_after / 60))), "quota")
+    
+    def charge(self, user_id: Optional[int], tokens: int) -> None:
+        """
+        Учесть токены выполненного запроса в квоте пользователя.
+        
+        Args:
+            user_id: ID пользователя
+            tokens: Токены запроса и ответа
+        """
+        if user_id is None or not self.quotas_enabled:
+            return
+        self._window(user_id).tokens += tokens
+        self.dirty.add(user_id)
+    
+    def _share(self, user_id: Optional[int], model: str) -> float:
+        """Доля лимита запросов в работе, доступная запросу."""
+        if user_id is None:
+            return self.background_share
+        return self.shares.get(model, self.shares.get("default", 1.0))
+    
+    def _window(self, user_id: int) -> _QuotaWindow:
+        """Окно квот пользователя, переведенное к текущему периоду."""
+        now = time.time()
+        window = self.windows.get(user_id)
+        if window is None:
+            window = self.windows[user_id] = _QuotaWindow(now)
+        else:
+            window.advance(now, self.window)
+        return window
+    
+    def _quota_retry_after(self, user_id: int) -> Optional[float]:
+        """Через сколько секунд пользователь снова уложится в квоты или None, если уже укладывается."""
+        window = self._window(user_id)
+        now = time.time()
+        requests, tokens = window.usage(now, self.window)
+        elapsed = now - window.start
+        delays = []
+        if self.request_quota and requests >= self.request_quota:
+            delays.append(_retry_after(window.requests, window.previous_requests, self.request_quota, elapsed, self.window))
+        if self.token_quota and tokens >= self.token_quota:
+            delays.append(_retry_after(window.tokens, window.previous_tokens, self.token_quota, elapsed, self.window))
+        return max(delays) if delays else None
+    
+    async def warm_up(self) -> None:
+        """Загрузить сохраненные квоты до первого запроса."""
+        if self.quotas_enabled:
+            await self._ensure_loaded()
+    
+    async def _ensure_loaded(self) -> None:
+        """Загрузить сохраненные квоты при первом обращении."""
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            try:
+                saved = await storage.load_quotas(time.time() - 2 * self.window)
+            except Exception as e:
+                # Без сохраненных квот бот работает, просто считает их заново
+                ERRORS.inc(type="quota_load")
+                logger.warning(f"Не удалось загрузить квоты пользователей: {e}")
+                saved = {}
+            for user_id, fields in saved.items():
+                # Запросы, принятые до загрузки, не теряются
+                self.windows.setdefault(user_id, _QuotaWindow(**fields))
+            self._loaded = True
+            logger.info(f"Загружены квоты {len(saved)} пользователей")
+    
+    async def save(self) -> None:
+        """Сохранить изменившиеся окна квот и забыть устаревшие."""
+        now = time.time()
+        # Окно, начавшееся два периода назад, уже не влияет на квоту
+        for user_id in [user_id for user_id, window in self.windows.items() if now - window.start >= 2 * self.window]:
+            if user_id not in self.dirty:
+                del self.windows[user_id]
+        
+        dirty, self.dirty = self.dirty, set()
+        quotas = {user_id: self.windows[user_id].to_dict() for user_id in dirty if user_id in self.windows}
+        try:
+            await storage.save_quotas(quotas)
+        except Exception:
+            # Сохраним при следующей попытке
+            self.dirty |= dirty
+            raise
+    
+    def _ensure_task(self) -> None:
+        """Запустить периодическое сохранение при первом обращении из цикла событий."""
+        if self._task is None and not self._closed:
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.save_interval)
+            try:
+                await self.save()
+            except Exception as e:
+                ERRORS.inc(type="quota_save")
+                logger.error(f"Ошибка сохранения квот ({len(self.dirty)} пользователей): {e}")
+    
+    async def close(self) -> None:
+        """Остановить периодическое сохранение и сохранить квоты."""
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.dirty:
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"Не удалось сохранить квоты при остановке: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Запросы в работе, их лимит и число пользователей с квотами в памяти."""
+        return {"pending": self.pending, "max_pending": self.max_pending, "users": len(self.windows)}
+
+# Создаем единый экземпляр контроля допуска
+admission = AdmissionController()
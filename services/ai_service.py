@@ -1,6 +1,19 @@
+import asyncio
 import logging
-from typing import List, Dict, Optional
-from services import openai_service, anthropic_service
+import time
+from types import ModuleType
+from typing import AsyncIterator, List, Dict, Optional, Tuple, Union
+from bot.config import MAX_TOKENS, RETRY_ATTEMPTS, MODEL_FALLBACK_ENABLED, FALLBACK_MODELS
+from bot.metrics import ERRORS, PROVIDER_FIRST_TOKEN_SECONDS, PROVIDER_QUEUE_SECONDS, PROVIDER_SECONDS, TOKENS
+from bot.profiling import add_span, span
+from services import openai_service, anthropic_service, response_cache
+from services.admission import admission
+from services.hedging import policy as hedging
+from services.errors import CompletionError, ProviderError
+from services.resilience import CircuitBreaker, backoff_delay, get_breaker
+from services.scheduler import get_scheduler
+from services.tokens import TokenUsage, build_context, count_tokens, prompt_tokens
+from services.usage import tracker
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -20,29 +33,442 @@ ANTHROPIC_MODEL_NAMES = {
     "claude-3-7-sonnet": "claude-3-7-sonnet"
 }
 
-async def get_completion(messages: List[Dict[str, str]], model: str) -> Optional[str]:
+# Ответ для моделей без известного провайдера
+UNSUPPORTED_MODEL_MESSAGE = "Извините, указанная модель не поддерживается. Пожалуйста, выберите другую модель с помощью команды /model."
+
+# Ответ, когда провайдер отключен автоматическим выключателем
+PROVIDER_UNAVAILABLE_MESSAGE = "Извините, сервис модели временно недоступен. Пожалуйста, попробуйте позже или выберите другую модель с помощью команды /model."
+
+async def get_completion(
+    messages: List[Dict[str, str]],
+    model: str,
+    stream: bool = False,
+    user_id: Optional[int] = None
+) -> Union[str, AsyncIterator[str]]:
     """
     Маршрутизатор для выбора соответствующего API сервиса в зависимости от модели.
     
+    Запрос сначала проходит контроль допуска (services/admission.py): при
+    перегрузке или исчерпанной квоте он отклоняется сразу, не вставая
+    в очередь провайдера. История обрезается под бюджет токенов модели.
+    Временные ошибки повторяются с экспоненциальной паузой. Если модель
+    недоступна, запрос передается резервной модели (при MODEL_FALLBACK).
+    Запросы к моделям из HEDGE_MODELS, которые выполняются дольше обычного,
+    дублируются (см. services/hedging.py).
+    
     Args:
         messages: Список сообщений для API
         model: Название модели для использования
+        stream: Вернуть ответ по частям по мере генерации
+        user_id: ID пользователя для справедливого распределения очереди запросов
     
     Returns:
-        Ответ от модели или None в случае ошибки
+        Ответ от модели. В потоковом режиме - асинхронный итератор фрагментов ответа
+    
+    Raises:
+        CompletionError: Если ни одна модель не ответила
+        AdmissionError: Если запрос отклонен контролем допуска
+    """
+    if stream:
+        return stream_completion(messages, model, user_id)
+    
+    # Одинаковые запросы к моделям с включенным кэшем не отправляем повторно
+    cached = response_cache.get(messages, model)
+    if cached is not None:
+        return cached
+    
+    async with admission.admit(user_id, model):
+        last_error = None
+        for candidate in _candidate_models(model):
+            try:
+                served_by, response = await _complete_hedged(messages, candidate, user_id)
+                # Ответ резервной модели или модели-заменителя не должен попасть в кэш запрошенной модели
+                if served_by == model:
+                    response_cache.put(messages, model, response)
+                return response
+            except ProviderError as e:
+                last_error = e
+        raise CompletionError(last_error.user_message)
+
+async def stream_completion(
+    messages: List[Dict[str, str]],
+    model: str,
+    user_id: Optional[int] = None
+) -> AsyncIterator[str]:
+    """
+    Получить ответ модели по частям по мере генерации.
+    
+    Повторы и переход на резервную модель возможны только до первого
+    фрагмента ответа: начатый ответ нельзя продолжить другим запросом.
+    
+    Args:
+        messages: Список сообщений для API
+        model: Название модели для использования
+        user_id: ID пользователя для справедливого распределения очереди запросов
+    
+    Yields:
+        Фрагменты текста ответа
+    
+    Raises:
+        CompletionError: Если ни одна модель не ответила
+        AdmissionError: Если запрос отклонен контролем допуска
+    """
+    cached = response_cache.get(messages, model)
+    if cached is not None:
+        yield cached
+        return
+    
+    async with admission.admit(user_id, model):
+        last_error = None
+        for candidate in _candidate_models(model):
+            provider = MODEL_PROVIDERS.get(candidate)
+            if provider is None:
+                ERRORS.inc(type="unsupported_model")
+                last_error = ProviderError(UNSUPPORTED_MODEL_MESSAGE)
+                continue
+            breaker = get_breaker(provider)
+            context = build_context(messages, candidate)
+            request_tokens = prompt_tokens(context, candidate)
+            
+            for attempt in range(RETRY_ATTEMPTS):
+                if not breaker.allow():
+                    ERRORS.inc(type="circuit_open")
+                    last_error = ProviderError(PROVIDER_UNAVAILABLE_MESSAGE)
+                    break
+                
+                parts = []
+                # Модель, которая отвечает: при дублировании запроса это может быть модель-заменитель
+                served_by = candidate
+                try:
+                    served_by, stream = await _open_stream(messages, candidate, context, request_tokens, user_id)
+                    try:
+                        async for delta in stream:
+                            parts.append(delta)
+                            yield delta
+                    finally:
+                        # Закрываем поток и освобождаем слот провайдера, даже если ответ больше не нужен
+                        await stream.aclose()
+                    if served_by == model:
+                        response_cache.put(messages, model, "".join(parts))
+                    return
+                except ProviderError as e:
+                    last_error = e
+                    if served_by != candidate:
+                        # Ответ модели-заменителя оборвался: это сбой ее провайдера, повторить нельзя
+                        _handle_failure(get_breaker(MODEL_PROVIDERS[served_by]), e, 0, attempts=1)
+                        raise CompletionError(e.user_message) from e
+                    retry = _handle_failure(breaker, e, attempt)
+                    if parts:
+                        # Часть ответа уже показана пользователю, повторить запрос нельзя
+                        raise CompletionError(e.user_message) from e
+                    if not retry:
+                        break
+                    await asyncio.sleep(backoff_delay(attempt, e.retry_after))
+        
+        raise CompletionError(last_error.user_message)
+
+async def _open_stream(
+    messages: List[Dict[str, str]],
+    model: str,
+    context: List[Dict[str, str]],
+    request_tokens: int,
+    user_id: Optional[int]
+) -> Tuple[str, AsyncIterator[str]]:
+    """
+    Начать потоковый ответ и дождаться первого фрагмента.
+    
+    Если первый фрагмент задерживается, запрос дублируется: ответ еще
+    не показан пользователю, поэтому можно взять любой из двух потоков.
+    
+    Args:
+        messages: Список сообщений для API
+        model: Название модели
+        context: Сообщения, обрезанные под бюджет модели
+        request_tokens: Токены запроса
+        user_id: ID пользователя
+    
+    Returns:
+        Модель, которая отвечает, и поток фрагментов ответа начиная с первого
+    """
+    if not hedging.is_enabled(model):
+        served_by, head, stream = await _first_delta(model, context, request_tokens, user_id)
+        return served_by, _chain(head, stream)
+    
+    async def hedge() -> Tuple[str, List[str], AsyncIterator[str]]:
+        sibling = hedging.sibling(model)
+        provider = MODEL_PROVIDERS.get(sibling)
+        if provider is None:
+            ERRORS.inc(type="unsupported_model")
+            raise ProviderError(UNSUPPORTED_MODEL_MESSAGE)
+        breaker = get_breaker(provider)
+        if not breaker.allow():
+            ERRORS.inc(type="circuit_open")
+            raise ProviderError(PROVIDER_UNAVAILABLE_MESSAGE)
+        sibling_context = context if sibling == model else build_context(messages, sibling)
+        try:
+            return await _first_delta(sibling, sibling_context, prompt_tokens(sibling_context, sibling), user_id)
+        except ProviderError as e:
+            _handle_failure(breaker, e, 0, attempts=1)
+            raise
+    
+    async def discard(result: Tuple[str, List[str], AsyncIterator[str]]) -> None:
+        await result[2].aclose()
+    
+    served_by, head, stream = await hedging.race(
+        model,
+        "first_token",
+        lambda started: _first_delta(model, context, request_tokens, user_id, started),
+        hedge,
+        discard
+    )
+    return served_by, _chain(head, stream)
+
+async def _first_delta(
+    model: str,
+    context: List[Dict[str, str]],
+    request_tokens: int,
+    user_id: Optional[int],
+    started: Optional[asyncio.Event] = None
+) -> Tuple[str, List[str], AsyncIterator[str]]:
+    """
+    Начать потоковый ответ модели и дождаться его первого фрагмента.
+    
+    Returns:
+        Модель, полученные фрагменты (первый или ни одного) и остаток потока
+    """
+    stream = _stream_once(model, context, request_tokens, user_id, started)
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        return model, [], stream
+    except BaseException:
+        await stream.aclose()
+        raise
+    return model, [first], stream
+
+async def _chain(head: List[str], stream: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Уже полученные фрагменты, затем остаток потока."""
+    try:
+        for delta in head:
+            yield delta
+        async for delta in stream:
+            yield delta
+    finally:
+        await stream.aclose()
+
+async def _stream_once(
+    model: str,
+    context: List[Dict[str, str]],
+    request_tokens: int,
+    user_id: Optional[int],
+    started: Optional[asyncio.Event] = None
+) -> AsyncIterator[str]:
+    """
+    Один потоковый запрос к модели без повторов.
+    
+    Успешный ответ учитывается в выключателе провайдера и в метриках токенов,
+    ошибки учитывает вызывающий код.
+    
+    Args:
+        model: Название модели
+        context: Сообщения, обрезанные под бюджет модели
+        request_tokens: Токены запроса
+        user_id: ID пользователя
+        started: Событие, отмечаемое, когда запрос получил слот провайдера
+    
+    Yields:
+        Фрагменты текста ответа
+    """
+    provider = MODEL_PROVIDERS[model]
+    service, service_model = _route(model)
+    parts = []
+    usage = TokenUsage()
+    # Слот занят, пока не будет получен весь ответ
+    async with get_scheduler(provider).slot(model, user_id, request_tokens + MAX_TOKENS) as wait:
+        PROVIDER_QUEUE_SECONDS.observe(wait, provider=provider)
+        add_span("provider_queue", provider, wait)
+        if started is not None:
+            started.set()
+        with PROVIDER_SECONDS.time(model=model), span("provider", model):
+            request_started = time.perf_counter()
+            async for delta in service.stream_completion(context, service_model, usage=usage):
+                if not parts:
+                    first_token = time.perf_counter() - request_started
+                    PROVIDER_FIRST_TOKEN_SECONDS.observe(first_token, model=model)
+                    hedging.observe(model, "first_token", first_token)
+                parts.append(delta)
+                yield delta
+            seconds = time.perf_counter() - request_started
+    get_breaker(provider).record_success()
+    _record_usage(model, user_id, usage, request_tokens, "".join(parts), seconds)
+
+def _candidate_models(model: str) -> List[str]:
+    """Основная модель и, если включено, резервная модель другого провайдера."""
+    if MODEL_FALLBACK_ENABLED and model in FALLBACK_MODELS:
+        return [model, FALLBACK_MODELS[model]]
+    return [model]
+
+async def _complete_hedged(messages: List[Dict[str, str]], model: str, user_id: Optional[int]) -> Tuple[str, str]:
+    """
+    Получить ответ модели, продублировав запрос, если он выполняется дольше обычного.
+    
+    Returns:
+        Модель, которая ответила (при дублировании это может быть модель-заменитель), и ответ
+    """
+    if not hedging.is_enabled(model):
+        return model, await _complete_with_retries(messages, model, user_id)
+    
+    async def primary(started: asyncio.Event) -> Tuple[str, str]:
+        return model, await _complete_with_retries(messages, model, user_id, started=started)
+    
+    async def hedge() -> Tuple[str, str]:
+        sibling = hedging.sibling(model)
+        return sibling, await _complete_with_retries(messages, sibling, user_id, attempts=1)
+    
+    return await hedging.race(model, "response", primary, hedge)
+
+async def _complete_with_retries(
+    messages: List[Dict[str, str]],
+    model: str,
+    user_id: Optional[int],
+    attempts: int = RETRY_ATTEMPTS,
+    started: Optional[asyncio.Event] = None
+) -> str:
+    """
+    Получить ответ модели, повторяя запрос при временных ошибках.
+    
+    Args:
+        messages: Список сообщений для API
+        model: Название модели
+        user_id: ID пользователя
+        attempts: Всего попыток
+        started: Событие, отмечаемое, когда запрос получил слот провайдера
+    
+    Returns:
+        Ответ от модели
+    
+    Raises:
+        ProviderError: Если все попытки не удались или провайдер отключен
     """
-    # Определяем провайдера на основе названия модели
     provider = MODEL_PROVIDERS.get(model)
+    if provider is None:
+        ERRORS.inc(type="unsupported_model")
+        raise ProviderError(UNSUPPORTED_MODEL_MESSAGE)
+    service, service_model = _route(model)
+    breaker = get_breaker(provider)
+    context = build_context(messages, model)
+    request_tokens = prompt_tokens(context, model)
+    
+    for attempt in range(attempts):
+        if not breaker.allow():
+            ERRORS.inc(type="circuit_open")
+            raise ProviderError(PROVIDER_UNAVAILABLE_MESSAGE)
+        try:
+            # Ждем своей очереди с учетом лимитов провайдера
+            async with get_scheduler(provider).slot(model, user_id, request_tokens + MAX_TOKENS) as wait:
+                PROVIDER_QUEUE_SECONDS.observe(wait, provider=provider)
+                add_span("provider_queue", provider, wait)
+                if started is not None:
+                    started.set()
+                usage = TokenUsage()
+                with PROVIDER_SECONDS.time(model=model), span("provider", model):
+                    request_started = time.perf_counter()
+                    response = await service.get_completion(context, service_model, usage=usage)
+                    seconds = time.perf_counter() - request_started
+                    hedging.observe(model, "response", seconds)
+            breaker.record_success()
+            _record_usage(model, user_id, usage, request_tokens, response, seconds)
+            return response
+        except ProviderError as e:
+            if not _handle_failure(breaker, e, attempt, attempts):
+                raise
+            await asyncio.sleep(backoff_delay(attempt, e.retry_after))
+
+def _handle_failure(breaker: CircuitBreaker, error: ProviderError, attempt: int, attempts: int = RETRY_ATTEMPTS) -> bool:
+    """
+    Учесть ошибку в выключателе и решить, нужен ли повтор.
     
-    logger.info(f"Используем модель {model} от провайдера {provider}")
+    Args:
+        breaker: Выключатель провайдера
+        error: Ошибка запроса
+        attempt: Номер попытки, начиная с 0
+        attempts: Всего попыток
+    
+    Returns:
+        True, если запрос стоит повторить
+    """
+    cause = error.__cause__
+    ERRORS.inc(type=type(cause).__name__ if cause is not None else type(error).__name__)
+    if not error.retryable:
+        # Провайдер ответил, просто запрос некорректен - он доступен
+        breaker.record_success()
+        return False
+    breaker.record_failure()
+    if attempt + 1 >= attempts or breaker.state == CircuitBreaker.OPEN:
+        return False
+    logger.warning(f"Повторяем запрос к {breaker.name} (попытка {attempt + 2} из {attempts})")
+    return True
+
+def _record_usage(
+    model: str,
+    user_id: Optional[int],
+    usage: TokenUsage,
+    request_tokens: int,
+    response: str,
+    seconds: float
+) -> None:
+    """
+    Учесть выполненный запрос в метриках, квоте пользователя и статистике использования.
+    
+    Берутся токены, которые вернул провайдер; если он их не сообщил,
+    используется собственная оценка запроса и ответа.
+    
+    Args:
+        model: Модель, которая ответила
+        user_id: ID пользователя
+        usage: Токены из ответа провайдера
+        request_tokens: Оценка токенов запроса
+        response: Текст ответа
+        seconds: Время запроса без ожидания в очереди
+    """
+    prompt = usage.prompt_tokens if usage.prompt_tokens is not None else request_tokens
+    completion = usage.completion_tokens if usage.completion_tokens is not None else count_tokens(response, model)
+    TOKENS.inc(prompt, model=model, kind="prompt")
+    TOKENS.inc(completion, model=model, kind="completion")
+    admission.charge(user_id, prompt + completion)
+    tracker.record(user_id, model, prompt, completion, seconds)
+
+def _route(model: str) -> Tuple[Optional[ModuleType], str]:
+    """
+    Определить сервис провайдера и имя модели для его API.
+    
+    Args:
+        model: Название модели
+    
+    Returns:
+        Модуль сервиса (None, если провайдер неизвестен) и имя модели
+    """
+    # Определяем провайдера на основе названия модели
+    provider = MODEL_PROVIDERS.get(model)
     
     if provider == "openai":
-        return await openai_service.get_completion(messages, model)
+        return openai_service, model
     elif provider == "anthropic":
         # Используем полное имя модели для Anthropic
         full_model_name = ANTHROPIC_MODEL_NAMES.get(model, model)
-        logger.info(f"Полное имя модели Anthropic: {full_model_name}")
-        return await anthropic_service.get_completion(messages, full_model_name)
+        return anthropic_service, full_model_name
     else:
         logger.error(f"Неизвестный провайдер для модели {model}")
-        return "Извините, указанная модель не поддерживается. Пожалуйста, выберите другую модель с помощью команды /model."
\ No newline at end of file
+        return None, model
+
+async def warm_up() -> None:
+    """Заранее открыть соединения с провайдерами, для которых настроены ключи."""
+    results = await asyncio.gather(openai_service.warm_up(), anthropic_service.warm_up(), return_exceptions=True)
+    for provider, result in zip(("openai", "anthropic"), results):
+        if isinstance(result, Exception):
+            logger.warning(f"Не удалось прогреть провайдера {provider}: {result}")
+
+async def close() -> None:
+    """Закрыть клиенты всех провайдеров."""
+    await openai_service.close()
+    await anthropic_service.close()
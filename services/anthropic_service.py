@@ -1,142 +1,280 @@
 import os
 import logging
-import time
-import random
-import asyncio
-import json
-from typing import List, Dict, Optional
-import anthropic
-from bot.config import MAX_TOKENS, SYSTEM_MESSAGES
+from typing import Any, AsyncIterator, List, Dict, Optional, Tuple, Union
+from bot.config import MAX_TOKENS, SYSTEM_MESSAGES, ANTHROPIC_PROMPT_CACHING
+from services.errors import ProviderError, parse_retry_after
+from services.http_client import build_http_client
+from services.tokens import TokenUsage
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
-# Переменная для отслеживания времени последнего запроса
-last_request_time = 0
-min_request_interval = 1.5  # Минимальный интервал между запросами в секундах
+# Клиент создается при первом запросе, см. get_client
+_client = None
 
-async def get_completion(messages: List[Dict[str, str]], model: str) -> Optional[str]:
+def get_client() -> Any:
     """
-    Получить ответ от Anthropic API с задержкой между запросами.
+    Асинхронный клиент Anthropic, который создается один раз и переиспользует соединения.
+    
+    SDK импортируется, а клиент создается при первом обращении: импорт SDK
+    занимает заметную часть запуска и не нужен, пока модели Claude не используются.
+    """
+    global _client
+    if _client is None:
+        import anthropic
+        # Повторы выполняет ai_service, поэтому встроенные повторы SDK отключены
+        _client = anthropic.AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            http_client=build_http_client(anthropic),
+            max_retries=0
+        )
+    return _client
+
+# Актуальные версии моделей
+MODEL_VERSIONS = {
+    "claude-3-5-sonnet": "claude-3-5-sonnet-20240620",
+    "claude-3-7-sonnet": "claude-3-7-sonnet-20240307",
+}
+
+# Сообщение об отсутствии ключа API
+MISSING_KEY_MESSAGE = "Ошибка: API ключ для Anthropic не настроен. Пожалуйста, выберите модель OpenAI."
+
+async def get_completion(messages: List[Dict[str, str]], model: str, usage: Optional[TokenUsage] = None) -> Optional[str]:
+    """
+    Получить ответ от Anthropic API.
     
     Args:
         messages: Список сообщений для API
         model: Название модели для использования (полное имя)
+        usage: Заполняется токенами запроса и ответа из ответа API
     
     Returns:
-        Ответ от модели или None в случае ошибки
-    """
-    global last_request_time
-    
-    # Логируем ключевую информацию
-    api_key = os.getenv("ANTHROPIC_API_KEY")
-    if not api_key:
-        logger.error("ANTHROPIC_API_KEY не настроен в переменных окружения")
-        return "Ошибка: API ключ для Anthropic не настроен. Пожалуйста, выберите модель OpenAI."
+        Ответ от модели
     
-    logger.info(f"Используем модель Anthropic: {model}")
+    Raises:
+        ProviderError: Если запрос к API не удался
+    """
+    if not _has_api_key():
+        raise ProviderError(MISSING_KEY_MESSAGE)
     
     try:
-        # Проверяем, создан ли клиент Anthropic
-        client = anthropic.Anthropic(api_key=api_key)
-        logger.info("Клиент Anthropic создан успешно")
-        
-        # Преобразуем формат сообщений из telegram-openai в формат Anthropic
-        system_content = ""
-        anthropic_messages = []
-        
-        # Извлекаем системное сообщение
-        for msg in messages:
-            if msg["role"] == "system":
-                system_content = msg["content"]
-                break
-        
-        # Если системного сообщения нет, используем значение по умолчанию
-        if not system_content:
-            system_content = SYSTEM_MESSAGES.get(model, "Вы - полезный и дружелюбный ассистент Claude.")
-        
-        # Добавляем остальные сообщения
-        for msg in messages:
-            if msg["role"] != "system":
-                anthropic_messages.append({
-                    "role": "assistant" if msg["role"] == "assistant" else "user",
-                    "content": msg["content"]
-                })
-        
-        # Вычисляем, сколько времени прошло с последнего запроса
-        current_time = time.time()
-        elapsed = current_time - last_request_time
-        
-        # Если прошло меньше минимального интервала, добавляем задержку
-        if elapsed < min_request_interval:
-            delay = min_request_interval - elapsed + random.uniform(0.1, 0.5)
-            logger.info(f"Добавляем задержку {delay:.2f} секунд между запросами к Anthropic API")
-            await asyncio.sleep(delay)
-        
-        # Обновляем время последнего запроса
-        last_request_time = time.time()
-        
-        # Логируем отправляемые данные
-        logger.info(f"Отправляем в Anthropic API: модель={model}, сообщения={len(anthropic_messages)}")
-        
-        # Проверяем доступные модели
-        available_models = [
-            "claude-3-opus-20240229",
-            "claude-3-sonnet-20240229",
-            "claude-3-haiku-20240307",
-            "claude-3-5-sonnet-20240620",
-            "claude-3-7-sonnet-20240307",
-            "claude-instant-1.2",
-            "claude-2.0",
-            "claude-2.1"
-        ]
-        logger.info(f"Попытка использовать библиотеку anthropic с моделью {model}. Доступные модели: {available_models}")
-        
-        # Пробуем использовать последние версии моделей
-        if model == "claude-3-5-sonnet":
-            model = "claude-3-5-sonnet-20240620"
-        elif model == "claude-3-7-sonnet":
-            model = "claude-3-7-sonnet-20240307"
-        
-        logger.info(f"Используем актуальную модель: {model}")
+        system_content, anthropic_messages = _convert_messages(messages, model)
+        model = _resolve_model(model, len(anthropic_messages))
+        system_content, anthropic_messages = _mark_cacheable(system_content, anthropic_messages)
         
         # Вызываем API Anthropic
-        response = client.messages.create(
+        response = await get_client().messages.create(
             model=model,
             system=system_content,
             messages=anthropic_messages,
             max_tokens=MAX_TOKENS
         )
         
+        _fill_usage(usage, response.usage)
+        
         # Возвращаем ответ
         return response.content[0].text
     
-    except anthropic.NotFoundError as e:
-        logger.error(f"Модель не найдена: {str(e)}")
-        return f"Модель {model} не найдена. Пожалуйста, выберите другую модель с помощью команды /model."
+    except Exception as e:
+        raise _provider_error(e, model) from e
+
+async def stream_completion(messages: List[Dict[str, str]], model: str, usage: Optional[TokenUsage] = None) -> AsyncIterator[str]:
+    """
+    Получить ответ от Anthropic API по частям по мере генерации.
+    
+    Args:
+        messages: Список сообщений для API
+        model: Название модели для использования (полное имя)
+        usage: Заполняется токенами запроса и ответа после завершения потока
+    
+    Yields:
+        Фрагменты текста ответа
+    
+    Raises:
+        ProviderError: Если запрос к API не удался
+    """
+    if not _has_api_key():
+        raise ProviderError(MISSING_KEY_MESSAGE)
+    
+    try:
+        system_content, anthropic_messages = _convert_messages(messages, model)
+        model = _resolve_model(model, len(anthropic_messages))
+        system_content, anthropic_messages = _mark_cacheable(system_content, anthropic_messages)
+        
+        # Вызываем API Anthropic в потоковом режиме
+        async with get_client().messages.stream(
+            model=model,
+            system=system_content,
+            messages=anthropic_messages,
+            max_tokens=MAX_TOKENS
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            _fill_usage(usage, stream.current_message_snapshot.usage)
     
-    except anthropic.RateLimitError:
+    except Exception as e:
+        raise _provider_error(e, model) from e
+
+def _fill_usage(usage: Optional[TokenUsage], response_usage: Any) -> None:
+    """
+    Перенести токены из ответа API.
+    
+    Токены, прочитанные из кэша запроса и записанные в него, Anthropic
+    считает отдельно от input_tokens, но они тоже входят в запрос.
+    """
+    if usage is None or response_usage is None:
+        return
+    usage.prompt_tokens = (
+        response_usage.input_tokens
+        + (getattr(response_usage, "cache_read_input_tokens", None) or 0)
+        + (getattr(response_usage, "cache_creation_input_tokens", None) or 0)
+    )
+    usage.completion_tokens = response_usage.output_tokens
+
+def _has_api_key() -> bool:
+    """Проверить, что ключ API Anthropic настроен."""
+    if not os.getenv("ANTHROPIC_API_KEY"):
+        logger.error("ANTHROPIC_API_KEY не настроен в переменных окружения")
+        return False
+    return True
+
+def _convert_messages(messages: List[Dict[str, str]], model: str) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Преобразовать формат сообщений из telegram-openai в формат Anthropic.
+    
+    Args:
+        messages: Список сообщений в формате OpenAI
+        model: Название модели
+    
+    Returns:
+        Системное сообщение и список остальных сообщений
+    """
+    anthropic_messages = []
+    
+    # Объединяем системные сообщения (основное и краткое содержание старой истории)
+    system_content = "\n\n".join(msg["content"] for msg in messages if msg["role"] == "system")
+    
+    # Если системного сообщения нет, используем значение по умолчанию
+    if not system_content:
+        system_content = SYSTEM_MESSAGES.get(model, "Вы - полезный и дружелюбный ассистент Claude.")
+    
+    # Добавляем остальные сообщения. Контекст уже обрезан под бюджет токенов
+    # в ai_service; Anthropic требует, чтобы диалог начинался с пользователя
+    for msg in messages:
+        if msg["role"] != "system":
+            role = "assistant" if msg["role"] == "assistant" else "user"
+            if not anthropic_messages and role == "assistant":
+                continue
+            anthropic_messages.append({"role": role, "content": msg["content"]})
+    
+    return system_content, anthropic_messages
+
+def _mark_cacheable(
+    system_content: str,
+    anthropic_messages: List[Dict[str, Any]]
+) -> Tuple[Union[str, List[Dict[str, Any]]], List[Dict[str, Any]]]:
+    """
+    Пометить неизменную часть запроса для кэширования на стороне Anthropic.
+    
+    Кэшируются системное сообщение и история до нового сообщения пользователя:
+    на следующем шаге диалога этот префикс совпадет, и Anthropic не будет
+    обрабатывать его заново, что сокращает время до первого токена.
+    
+    Args:
+        system_content: Системное сообщение
+        anthropic_messages: Сообщения в формате Anthropic
+    
+    Returns:
+        Системное сообщение и сообщения с отметками cache_control
+    """
+    if not ANTHROPIC_PROMPT_CACHING:
+        return system_content, anthropic_messages
+    
+    cache_control = {"type": "ephemeral"}
+    system_blocks = [{"type": "text", "text": system_content, "cache_control": cache_control}]
+    
+    # Отмечаем конец истории - последнее сообщение перед новым вопросом
+    if len(anthropic_messages) > 1:
+        anthropic_messages = list(anthropic_messages)
+        prefix_end = anthropic_messages[-2]
+        anthropic_messages[-2] = {
+            "role": prefix_end["role"],
+            "content": [{"type": "text", "text": prefix_end["content"], "cache_control": cache_control}]
+        }
+    
+    return system_blocks, anthropic_messages
+
+def _resolve_model(model: str, message_count: int) -> str:
+    """Получить актуальную версию модели."""
+    model = MODEL_VERSIONS.get(model, model)
+    logger.debug(f"Отправляем в Anthropic API: модель={model}, сообщения={message_count}")
+    return model
+
+def _provider_error(error: Exception, model: str) -> ProviderError:
+    """
+    Преобразовать ошибку API в ошибку провайдера с текстом для пользователя.
+    
+    Args:
+        error: Исключение, возникшее при запросе
+        model: Название модели
+    
+    Returns:
+        Ошибка провайдера с признаком возможности повтора
+    """
+    import anthropic
+    
+    if isinstance(error, anthropic.NotFoundError):
+        logger.error(f"Модель не найдена: {str(error)}")
+        return ProviderError(f"Модель {model} не найдена. Пожалуйста, выберите другую модель с помощью команды /model.")
+    
+    if isinstance(error, anthropic.RateLimitError):
         logger.warning("Anthropic API rate limit exceeded")
-        # Увеличиваем интервал при превышении лимита
-        last_request_time = time.time()
-        return "Извините, превышен лимит запросов к API. Пожалуйста, попробуйте позже."
+        return ProviderError(
+            "Извините, превышен лимит запросов к API. Пожалуйста, попробуйте позже.",
+            retryable=True,
+            retry_after=parse_retry_after(error)
+        )
     
-    except anthropic.APIError as e:
-        logger.error(f"Anthropic API error: {str(e)}")
-        return f"Ошибка в Anthropic API: {str(e)}. Пожалуйста, попробуйте другую модель."
+    if isinstance(error, anthropic.APITimeoutError):
+        logger.error("Anthropic API request timed out")
+        return ProviderError(
+            "Извините, запрос к серверу превысил время ожидания. Пожалуйста, попробуйте позже.",
+            retryable=True
+        )
     
-    except anthropic.APIConnectionError:
+    if isinstance(error, anthropic.APIConnectionError):
         logger.error("Failed to connect to Anthropic API")
-        return "Извините, не удалось соединиться с сервером. Пожалуйста, попробуйте позже."
+        return ProviderError(
+            "Извините, не удалось соединиться с сервером. Пожалуйста, попробуйте позже.",
+            retryable=True
+        )
     
-    except anthropic.APITimeoutError:
-        logger.error("Anthropic API request timed out")
-        return "Извините, запрос к серверу превысил время ожидания. Пожалуйста, попробуйте позже."
+    if isinstance(error, anthropic.APIStatusError) and error.status_code >= 500:
+        # Сюда же относится перегрузка API (529 Overloaded)
+        logger.error(f"Anthropic API server error: {str(error)}")
+        return ProviderError(
+            "Извините, сервер Anthropic временно перегружен. Пожалуйста, попробуйте позже.",
+            retryable=True,
+            retry_after=parse_retry_after(error)
+        )
     
-    except AttributeError as e:
-        logger.error(f"AttributeError: {str(e)}")
-        return f"Ошибка атрибута при работе с Anthropic API: {str(e)}. Попробуйте другую модель."
+    if isinstance(error, anthropic.APIError):
+        logger.error(f"Anthropic API error: {str(error)}")
+        return ProviderError(f"Ошибка в Anthropic API: {str(error)}. Пожалуйста, попробуйте другую модель.")
     
-    except Exception as e:
-        logger.error(f"Error in Anthropic API request: {str(e)}", exc_info=True)
-        return f"Произошла ошибка при обработке запроса: {str(e)}. Пожалуйста, попробуйте использовать модель OpenAI."
\ No newline at end of file
+    if isinstance(error, AttributeError):
+        logger.error(f"AttributeError: {str(error)}")
+        return ProviderError(f"Ошибка атрибута при работе с Anthropic API: {str(error)}. Попробуйте другую модель.")
+    
+    logger.error(f"Error in Anthropic API request: {str(error)}", exc_info=error)
+    return ProviderError(f"Произошла ошибка при обработке запроса: {str(error)}. Пожалуйста, попробуйте использовать модель OpenAI.")
+
+async def warm_up() -> None:
+    """Заранее создать клиент и открыть соединение с API, если ключ настроен."""
+    if os.getenv("ANTHROPIC_API_KEY"):
+        await get_client().models.list()
+
+async def close() -> None:
+    """Закрыть клиент Anthropic и его пул соединений."""
+    if _client is not None:
+        await _client.close()
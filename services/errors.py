@@ -0,0 +1,64 @@
+from typing import Optional
+
+class ProviderError(Exception):
+    """Ошибка запроса к API провайдера."""
+    
+    def __init__(self, user_message: str, retryable: bool = False, retry_after: Optional[float] = None):
+        """
+        Args:
+            user_message: Текст ошибки для пользователя
+            retryable: Имеет ли смысл повторить запрос (лимиты, таймауты, сбои сервера)
+            retry_after: Рекомендованная сервером пауза перед повтором в секундах
+        """
+        super().__init__(user_message)
+        self.user_message = user_message
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+class CompletionError(Exception):
+    """Не удалось получить ответ ни от одной модели; текст ошибки нужно показать пользователю, но не сохранять в историю."""
+    
+    def __init__(self, user_message: str):
+        """
+        Args:
+            user_message: Текст ошибки для пользователя
+        """
+        super().__init__(user_message)
+        self.user_message = user_message
+
+class AdmissionError(CompletionError):
+    """Запрос отклонен контролем допуска: бот перегружен или пользователь исчерпал квоту."""
+    
+    def __init__(self, user_message: str, reason: str):
+        """
+        Args:
+            user_message: Текст ошибки для пользователя
+            reason: Причина для метрик: busy или quota
+        """
+        super().__init__(user_message)
+        self.reason = reason
+
+def parse_retry_after(error: Exception) -> Optional[float]:
+    """
+    Извлечь паузу из заголовков Retry-After ответа API.
+    
+    Args:
+        error: Исключение SDK провайдера
+    
+    Returns:
+        Пауза в секундах или None, если сервер ее не указал
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After в формате даты не поддерживаем, используем обычную задержку
+        pass
+    return None
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import math
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set, Tuple, TypeVar
+
+from bot.config import (
+    HEDGE_MODELS, HEDGE_SIBLINGS, HEDGE_PERCENTILE, HEDGE_WINDOW, HEDGE_MIN_SAMPLES,
+    HEDGE_MIN_DELAY, HEDGE_BUDGET, HEDGE_BUDGET_BURST
+)
+from bot.metrics import HEDGES
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+class HedgePolicy:
+    """
+    Дублирующие запросы (hedging) для сокращения хвоста задержек.
+    
+    Для каждой модели хранятся недавние задержки: время до первого фрагмента
+    потокового ответа (first_token) и время полного ответа (response).
+    Если запрос выполняется дольше перцентиля percentile этих задержек,
+    отправляется второй запрос к той же модели или к модели-заменителю.
+    Используется ответ, пришедший первым, второй запрос отменяется.
+    
+    Дублирование ограничено бюджетом: каждый запрос добавляет budget
+    дублирования (не больше burst), каждый дубль расходует одно. Так
+    дополнительные запросы не превышают доли budget от всех запросов,
+    даже если провайдер медленно отвечает на все запросы сразу.
+    """
+    
+    def __init__(
+        self,
+        models: Set[str] = HEDGE_MODELS,
+        siblings: Dict[str, str] = HEDGE_SIBLINGS,
+        percentile: float = HEDGE_PERCENTILE,
+        window: int = HEDGE_WINDOW,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+        min_delay: float = HEDGE_MIN_DELAY,
+        budget: float = HEDGE_BUDGET,
+        burst: float = HEDGE_BUDGET_BURST
+    ):
+        """
+        Args:
+            models: Модели, запросы к которым дублируются
+            siblings: Модель для дублирующего запроса, если не та же самая
+            percentile: Перцентиль задержки, после которого запрос дублируется
+            window: Недавних замеров задержки каждой модели
+            min_samples: Замеров, после которых начинается дублирование
+            min_delay: Минимальное ожидание перед дублированием в секундах
+            budget: Доля запросов, которые можно дублировать
+            burst: Максимальный запас дублирований
+        """
+        self.models = models
+        self.siblings = siblings
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.budget = budget
+        self.burst = burst
+        self.credits = burst
+        self.samples: Dict[Tuple[str, str], Deque[float]] = {}
+        self.counts: Dict[str, Dict[str, int]] = {}
+    
+    def is_enabled(self, model: str) -> bool:
+        """Дублируются ли запросы к модели."""
+        return model in self.models
+    
+    def sibling(self, model: str) -> str:
+        """Модель для дублирующего запроса."""
+        return self.siblings.get(model, model)
+    
+    def observe(self, model: str, kind: str, seconds: float) -> None:
+        """
+        Учесть задержку успешного запроса.
+        
+        Args:
+            model: Название модели
+            kind: first_token или response
+            seconds: Задержка в секундах
+        """
+        if not self.is_enabled(model):
+            return
+        samples = self.samples.get((model, kind))
+        if samples is None:
+            samples = self.samples[(model, kind)] = deque(maxlen=self.window)
+        samples.append(seconds)
+    
+    def deadline(self, model: str, kind: str) -> Optional[float]:
+        """
+        Время, после которого запрос дублируется.
+        
+        Returns:
+            Задержка в секундах или None, если замеров пока мало
+        """
+        samples = self.samples.get((model, kind))
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(self.percentile / 100 * len(ordered)) - 1))
+        return max(self.min_delay, ordered[index])
+    
+    async def race(
+        self,
+        model: str,
+        kind: str,
+        primary: Callable[[asyncio.Event], Awaitable[T]],
+        hedge: Callable[[], Awaitable[T]],
+        discard: Optional[Callable[[T], Awaitable[None]]] = None
+    ) -> T:
+        """
+        Выполнить запрос, продублировав его, если он не завершился к сроку.
+        
+        Срок отсчитывается с момента, когда основной запрос получил слот
+        провайдера и отметил событие started: ожидание в очереди
+        не считается медленным ответом, а дубль в очереди не поможет.
+        
+        Args:
+            model: Название модели
+            kind: first_token или response
+            primary: Основной запрос; получает событие started
+            hedge: Дублирующий запрос
+            discard: Освобождение результата проигравшего запроса, если он тоже завершился
+        
+        Returns:
+            Результат запроса, завершившегося первым без ошибки
+        
+        Raises:
+            Exception: Ошибка основного запроса, если оба запроса завершились ошибкой
+        """
+        self._count(model, "request")
+        self.credits = min(self.burst, self.credits + self.budget)
+        deadline = self.deadline(model, kind)
+        
+        started = asyncio.Event()
+        first = asyncio.create_task(primary(started))
+        if deadline is None:
+            return await first
+        
+        tasks = [first, asyncio.create_task(started.wait())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            if not first.done():
+                await asyncio.wait([first], timeout=deadline)
+            if first.done():
+                return first.result()
+            
+            if self.credits < 1:
+                self._count(model, "denied")
+                return await first
+            self.credits -= 1
+            self._count(model, "hedge")
+            logger.info(f"Запрос к {model} дольше {deadline:.1f} с, отправляем дублирующий запрос к {self.sibling(model)}")
+            second = asyncio.create_task(hedge())
+            tasks.append(second)
+            
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # При одновременном завершении предпочитаем основной запрос
+                winner = next((task for task in (first, second) if task in done and _succeeded(task)), None)
+                if winner is None:
+                    continue
+                if winner is second:
+                    self._count(model, "win")
+                loser = first if winner is second else second
+                if discard is not None and loser.done() and _succeeded(loser):
+                    await discard(loser.result())
+                return winner.result()
+            return first.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+    
+    def _count(self, model: str, event: str) -> None:
+        counts = self.counts.setdefault(model, {"request": 0, "hedge": 0, "win": 0, "denied": 0})
+        counts[event] += 1
+        HEDGES.inc(model=model, event=event)
+    
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Статистика дублирования по моделям: доля дублированных запросов и доля побед дублей."""
+        return {
+            model: {
+                "requests": counts["request"],
+                "hedged": counts["hedge"],
+                "wins": counts["win"],
+                "denied": counts["denied"],
+                "hedge_rate": counts["hedge"] / counts["request"] if counts["request"] else 0.0,
+                "win_rate": counts["win"] / counts["hedge"] if counts["hedge"] else 0.0,
+            }
+            for model, counts in self.counts.items()
+        }
+
+def _succeeded(task: asyncio.Task) -> bool:
+    return not task.cancelled() and task.exception() is None
+
+# Создаем единый экземпляр политики дублирования
+policy = HedgePolicy()
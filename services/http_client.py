@@ -0,0 +1,30 @@
+from types import ModuleType
+from typing import Any
+from bot.config import (
+    PROVIDER_MAX_CONNECTIONS, PROVIDER_MAX_KEEPALIVE, PROVIDER_KEEPALIVE_EXPIRY,
+    PROVIDER_TIMEOUT, PROVIDER_CONNECT_TIMEOUT
+)
+
+def build_http_client(sdk: ModuleType) -> Any:
+    """
+    Создать асинхронный HTTP-клиент с пулом постоянных соединений для API провайдера.
+    
+    Клиент создается один раз на процесс и переиспользуется всеми запросами,
+    поэтому TLS-рукопожатие выполняется только при открытии нового соединения.
+    
+    Args:
+        sdk: Модуль SDK провайдера (openai или anthropic)
+    
+    Returns:
+        HTTP-клиент SDK с настроенными лимитами пула и таймаутами
+    """
+    # Берем классы из самого SDK, чтобы не зависеть от версии HTTP-библиотеки под ним
+    limits_class = type(sdk.DEFAULT_CONNECTION_LIMITS)
+    return sdk.DefaultAsyncHttpxClient(
+        limits=limits_class(
+            max_connections=PROVIDER_MAX_CONNECTIONS,
+            max_keepalive_connections=PROVIDER_MAX_KEEPALIVE,
+            keepalive_expiry=PROVIDER_KEEPALIVE_EXPIRY,
+        ),
+        timeout=sdk.Timeout(PROVIDER_TIMEOUT, connect=PROVIDER_CONNECT_TIMEOUT),
+    )
@@ -1,83 +1,171 @@
 import os
 import logging
-import time
-import random
-import asyncio
-from typing import List, Dict, Optional
-import openai
-from openai import OpenAI
+from typing import Any, AsyncIterator, List, Dict, Optional
 from bot.config import MAX_TOKENS, SYSTEM_MESSAGES
-
-# Инициализируем клиент OpenAI
-client = OpenAI(api_key=os.getenv("OPENAI_TOKEN"))
+from services.errors import ProviderError, parse_retry_after
+from services.http_client import build_http_client
+from services.tokens import TokenUsage
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
-# Переменная для отслеживания времени последнего запроса
-last_request_time = 0
-min_request_interval = 1.5  # Минимальный интервал между запросами в секундах
+# Клиент создается при первом запросе, см. get_client
+_client = None
+
+def get_client() -> Any:
+    """
+    Асинхронный клиент OpenAI с общим пулом соединений.
+    
+    SDK импортируется, а клиент создается при первом обращении: импорт SDK
+    занимает заметную часть запуска и не нужен, пока модели OpenAI не используются.
+    """
+    global _client
+    if _client is None:
+        import openai
+        # Повторы выполняет ai_service, поэтому встроенные повторы SDK отключены
+        _client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_TOKEN"), http_client=build_http_client(openai), max_retries=0)
+    return _client
 
-async def get_completion(messages: List[Dict[str, str]], model: str) -> Optional[str]:
+async def get_completion(messages: List[Dict[str, str]], model: str, usage: Optional[TokenUsage] = None) -> Optional[str]:
     """
-    Получить ответ от OpenAI API с задержкой между запросами.
+    Получить ответ от OpenAI API.
     
     Args:
         messages: Список сообщений для API
         model: Название модели для использования
+        usage: Заполняется токенами запроса и ответа из ответа API
     
     Returns:
-        Ответ от модели или None в случае ошибки
-    """
-    global last_request_time
+        Ответ от модели
     
+    Raises:
+        ProviderError: Если запрос к API не удался
+    """
     try:
-        # Добавляем системное сообщение, если его нет
-        if not any(msg["role"] == "system" for msg in messages):
-            system_message = SYSTEM_MESSAGES.get(model, SYSTEM_MESSAGES["gpt-4o"])
-            messages = [{"role": "system", "content": system_message}] + messages
-        
-        # Вычисляем, сколько времени прошло с последнего запроса
-        current_time = time.time()
-        elapsed = current_time - last_request_time
-        
-        # Если прошло меньше минимального интервала, добавляем задержку
-        if elapsed < min_request_interval:
-            delay = min_request_interval - elapsed + random.uniform(0.1, 0.5)  # Добавляем небольшой случайный компонент
-            logger.info(f"Добавляем задержку {delay:.2f} секунд между запросами к API")
-            await asyncio.sleep(delay)
-        
-        # Обновляем время последнего запроса
-        last_request_time = time.time()
+        messages = _prepare_messages(messages, model)
         
         # Вызываем API OpenAI
-        response = client.chat.completions.create(
+        response = await get_client().chat.completions.create(
             model=model,
             messages=messages,
-            temperature=0.7,
-            max_tokens=MAX_TOKENS,
-            top_p=1.0,
-            frequency_penalty=0.0,
-            presence_penalty=0.0,
+            **_request_params()
         )
         
+        if usage is not None and response.usage is not None:
+            usage.prompt_tokens = response.usage.prompt_tokens
+            usage.completion_tokens = response.usage.completion_tokens
+        
         # Возвращаем ответ
         return response.choices[0].message.content
     
-    except openai.RateLimitError:
+    except Exception as e:
+        raise _provider_error(e) from e
+
+async def stream_completion(messages: List[Dict[str, str]], model: str, usage: Optional[TokenUsage] = None) -> AsyncIterator[str]:
+    """
+    Получить ответ от OpenAI API по частям по мере генерации.
+    
+    Args:
+        messages: Список сообщений для API
+        model: Название модели для использования
+        usage: Заполняется токенами запроса и ответа из последнего фрагмента потока
+    
+    Yields:
+        Фрагменты текста ответа
+    
+    Raises:
+        ProviderError: Если запрос к API не удался
+    """
+    try:
+        messages = _prepare_messages(messages, model)
+        
+        # Вызываем API OpenAI в потоковом режиме
+        stream = await get_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            # Токены приходят отдельным последним фрагментом без choices
+            stream_options={"include_usage": True},
+            **_request_params()
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if usage is not None and chunk.usage is not None:
+                usage.prompt_tokens = chunk.usage.prompt_tokens
+                usage.completion_tokens = chunk.usage.completion_tokens
+    
+    except Exception as e:
+        raise _provider_error(e) from e
+
+def _prepare_messages(messages: List[Dict[str, str]], model: str) -> List[Dict[str, str]]:
+    """Добавить системное сообщение, если его нет."""
+    if not any(msg["role"] == "system" for msg in messages):
+        system_message = SYSTEM_MESSAGES.get(model, SYSTEM_MESSAGES["gpt-4o"])
+        messages = [{"role": "system", "content": system_message}] + messages
+    return messages
+
+def _request_params() -> Dict[str, float]:
+    """Общие параметры генерации для обычных и потоковых запросов."""
+    return {
+        "temperature": 0.7,
+        "max_tokens": MAX_TOKENS,
+        "top_p": 1.0,
+        "frequency_penalty": 0.0,
+        "presence_penalty": 0.0,
+    }
+
+def _provider_error(error: Exception) -> ProviderError:
+    """
+    Преобразовать ошибку API в ошибку провайдера с текстом для пользователя.
+    
+    Args:
+        error: Исключение, возникшее при запросе
+    
+    Returns:
+        Ошибка провайдера с признаком возможности повтора
+    """
+    import openai
+    
+    if isinstance(error, openai.RateLimitError):
         logger.warning("OpenAI API rate limit exceeded")
-        # Увеличиваем интервал при превышении лимита
-        last_request_time = time.time()
-        return "Извините, превышен лимит запросов к API. Пожалуйста, попробуйте позже."
+        return ProviderError(
+            "Извините, превышен лимит запросов к API. Пожалуйста, попробуйте позже.",
+            retryable=True,
+            retry_after=parse_retry_after(error)
+        )
+    
+    if isinstance(error, openai.APITimeoutError):
+        logger.error("OpenAI API request timed out")
+        return ProviderError(
+            "Извините, запрос к серверу превысил время ожидания. Пожалуйста, попробуйте позже.",
+            retryable=True
+        )
     
-    except openai.APIConnectionError:
+    if isinstance(error, openai.APIConnectionError):
         logger.error("Failed to connect to OpenAI API")
-        return "Извините, не удалось соединиться с сервером. Пожалуйста, попробуйте позже."
+        return ProviderError(
+            "Извините, не удалось соединиться с сервером. Пожалуйста, попробуйте позже.",
+            retryable=True
+        )
     
-    except openai.APITimeoutError:
-        logger.error("OpenAI API request timed out")
-        return "Извините, запрос к серверу превысил время ожидания. Пожалуйста, попробуйте позже."
+    if isinstance(error, openai.APIStatusError) and error.status_code >= 500:
+        logger.error(f"OpenAI API server error: {str(error)}")
+        return ProviderError(
+            "Извините, сервер OpenAI временно недоступен. Пожалуйста, попробуйте позже.",
+            retryable=True,
+            retry_after=parse_retry_after(error)
+        )
     
-    except Exception as e:
-        logger.error(f"Error in OpenAI API request: {str(e)}")
-        return "Произошла ошибка при обработке запроса. Пожалуйста, попробуйте позже."
\ No newline at end of file
+    logger.error(f"Error in OpenAI API request: {str(error)}")
+    return ProviderError("Произошла ошибка при обработке запроса. Пожалуйста, попробуйте позже.")
+
+async def warm_up() -> None:
+    """Заранее создать клиент и открыть соединение с API, если ключ настроен."""
+    if os.getenv("OPENAI_TOKEN"):
+        await get_client().models.list()
+
+async def close() -> None:
+    """Закрыть клиент OpenAI и его пул соединений."""
+    if _client is not None:
+        await _client.close()
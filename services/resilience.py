@@ -0,0 +1,111 @@
+import logging
+import random
+import time
+from typing import Dict, Optional
+from bot.config import (
+    RETRY_BASE_DELAY, RETRY_MAX_DELAY, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT
+)
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель для провайдера.
+    
+    После CIRCUIT_FAILURE_THRESHOLD сбоев подряд запросы к провайдеру сразу
+    отклоняются. Через CIRCUIT_RESET_TIMEOUT секунд пропускается один пробный
+    запрос: успех замыкает цепь, сбой снова размыкает ее.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        """
+        Args:
+            name: Название провайдера
+            failure_threshold: Количество сбоев подряд до размыкания
+            reset_timeout: Время до пробного запроса в секундах
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_progress = False
+    
+    def allow(self) -> bool:
+        """
+        Можно ли сейчас отправить запрос провайдеру.
+        
+        Returns:
+            True, если цепь замкнута или пора выполнить пробный запрос
+        """
+        if self.state == self.CLOSED:
+            return True
+        
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self.trial_in_progress = False
+        
+        # В полуоткрытом состоянии пропускаем только один пробный запрос
+        if self.state == self.HALF_OPEN and not self.trial_in_progress:
+            self.trial_in_progress = True
+            return True
+        return False
+    
+    def record_success(self) -> None:
+        """Отметить успешный запрос."""
+        if self.state != self.CLOSED:
+            logger.info(f"Провайдер {self.name} снова доступен")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trial_in_progress = False
+    
+    def record_failure(self) -> None:
+        """Отметить сбой запроса."""
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Провайдер {self.name} недоступен, запросы отклоняются {self.reset_timeout} секунд")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.trial_in_progress = False
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """
+    Вычислить паузу перед повторной попыткой.
+    
+    Используется экспоненциальная пауза со случайным разбросом, чтобы
+    повторы разных пользователей не приходили к провайдеру одновременно.
+    
+    Args:
+        attempt: Номер неудавшейся попытки, начиная с 0
+        retry_after: Пауза, которую запросил сервер
+    
+    Returns:
+        Пауза в секундах
+    """
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY) + random.uniform(0, RETRY_BASE_DELAY / 2)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+# Выключатели провайдеров
+breakers: Dict[str, CircuitBreaker] = {}
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    """
+    Получить выключатель провайдера.
+    
+    Args:
+        provider: Название провайдера
+    
+    Returns:
+        Выключатель провайдера
+    """
+    if provider not in breakers:
+        breakers[provider] = CircuitBreaker(provider)
+    return breakers[provider]
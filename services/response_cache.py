@@ -0,0 +1,68 @@
+import hashlib
+import json
+import logging
+from typing import Any, Dict, List, Optional
+from bot.cache import LRUCache
+from bot.config import (
+    RESPONSE_CACHE_MODELS, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES
+)
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Кэш ответов: ключ - хэш модели и нормализованного списка сообщений
+_cache = LRUCache(
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=RESPONSE_CACHE_TTL,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    sizeof=lambda response: 100 + len(response) * 2
+)
+
+def _cache_key(messages: List[Dict[str, Any]], model: str) -> str:
+    """
+    Построить ключ кэша по модели и сообщениям.
+    
+    Сообщения нормализуются: учитываются только роль и текст, а пробелы
+    по краям и повторяющиеся пробелы внутри текста не влияют на ключ.
+    """
+    normalized = [[msg["role"], " ".join(msg["content"].split())] for msg in messages]
+    payload = json.dumps([model, normalized], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def is_enabled(model: str) -> bool:
+    """Включен ли кэш ответов для модели."""
+    return model in RESPONSE_CACHE_MODELS
+
+def get(messages: List[Dict[str, Any]], model: str) -> Optional[str]:
+    """
+    Найти сохраненный ответ на такой же запрос.
+    
+    Args:
+        messages: Сообщения запроса
+        model: Название модели
+    
+    Returns:
+        Сохраненный ответ или None
+    """
+    if not is_enabled(model):
+        return None
+    response = _cache.get(_cache_key(messages, model))
+    if response is not None:
+        logger.info(f"Ответ модели {model} взят из кэша")
+    return response
+
+def put(messages: List[Dict[str, Any]], model: str, response: str) -> None:
+    """
+    Сохранить ответ модели.
+    
+    Args:
+        messages: Сообщения запроса
+        model: Название модели
+        response: Ответ модели
+    """
+    if is_enabled(model) and response:
+        _cache.set(_cache_key(messages, model), response)
+
+def stats() -> Dict[str, int]:
+    """Статистика кэша ответов."""
+    return _cache.stats()
@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Hashable, List, Optional, Tuple
+from bot.config import PROVIDER_LIMITS, MODEL_LIMITS, LIMIT_SHARES
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Корзина токенов: пополняется с постоянной скоростью и допускает всплески до своей емкости."""
+    
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        """
+        Args:
+            rate_per_minute: Скорость пополнения в единицах за минуту (0 - без ограничения)
+            capacity: Емкость корзины - допустимый всплеск (по умолчанию - запас на минуту)
+        """
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute if capacity is None else capacity)
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+    
+    def delay(self, amount: float) -> float:
+        """
+        Через сколько секунд в корзине будет достаточно токенов.
+        
+        Args:
+            amount: Требуемое количество токенов
+        
+        Returns:
+            Время ожидания в секундах (0 - токенов уже достаточно)
+        """
+        if not self.rate:
+            return 0.0
+        self._refill()
+        # Запрос больше емкости корзины иначе никогда бы не прошел
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.rate
+    
+    def consume(self, amount: float) -> None:
+        """
+        Списать токены из корзины.
+        
+        Args:
+            amount: Количество токенов
+        """
+        if not self.rate:
+            return
+        self._refill()
+        self.available -= min(amount, self.capacity)
+    
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+class _Waiter:
+    """Запрос, ожидающий разрешения на обращение к провайдеру."""
+    
+    def __init__(self, model: str, tokens: int):
+        self.model = model
+        self.tokens = tokens
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+class ProviderScheduler:
+    """
+    Планировщик запросов к одному провайдеру.
+    
+    Ограничивает число запросов и токенов в минуту для провайдера и отдельных
+    моделей, а также число одновременных запросов. Ожидающие запросы
+    обслуживаются по кругу между пользователями, поэтому один активный
+    пользователь не может занять всю очередь.
+    """
+    
+    def __init__(
+        self,
+        name: str,
+        rpm: int,
+        tpm: int,
+        max_concurrency: int,
+        model_limits: Optional[Dict[str, Dict[str, int]]] = None
+    ):
+        """
+        Args:
+            name: Название провайдера
+            rpm: Запросов в минуту (0 - без ограничения)
+            tpm: Токенов в минуту (0 - без ограничения)
+            max_concurrency: Максимум одновременных запросов
+            model_limits: Лимиты rpm/tpm отдельных моделей
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.request_bucket = TokenBucket(rpm)
+        self.token_bucket = TokenBucket(tpm)
+        self.model_buckets = {
+            model: (TokenBucket(limits.get("rpm", 0)), TokenBucket(limits.get("tpm", 0)))
+            for model, limits in (model_limits or {}).items()
+        }
+        
+        self.in_flight = 0
+        # Очереди ожидающих запросов по пользователям в порядке обхода
+        self._queues: "OrderedDict[Hashable, Deque[_Waiter]]" = OrderedDict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        
+        # Статистика ожидания
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    @asynccontextmanager
+    async def slot(self, model: str, user_id: Optional[Hashable], tokens: int) -> AsyncIterator[float]:
+        """
+        Занять слот для запроса к провайдеру на время выполнения блока.
+        
+        Args:
+            model: Название модели
+            user_id: ID пользователя для справедливой очереди
+            tokens: Оценка количества токенов запроса и ответа
+        
+        Yields:
+            Время ожидания слота в секундах
+        """
+        wait = await self.acquire(model, user_id, tokens)
+        try:
+            yield wait
+        finally:
+            self.release()
+    
+    async def acquire(self, model: str, user_id: Optional[Hashable], tokens: int) -> float:
+        """
+        Дождаться разрешения на запрос.
+        
+        Args:
+            model: Название модели
+            user_id: ID пользователя для справедливой очереди
+            tokens: Оценка количества токенов запроса и ответа
+        
+        Returns:
+            Время ожидания в секундах
+        """
+        waiter = _Waiter(model, tokens)
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self._dispatch()
+        
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот уже выдан, но запрос отменили - возвращаем его
+                self.release()
+            else:
+                self._discard(user_id, waiter)
+            raise
+    
+    def release(self) -> None:
+        """Освободить слот после завершения запроса."""
+        self.in_flight -= 1
+        self._dispatch()
+    
+    def queue_depth(self) -> int:
+        """Количество запросов, ожидающих в очереди."""
+        return sum(len(queue) for queue in self._queues.values())
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Получить статистику планировщика.
+        
+        Returns:
+            Глубина очереди, число выполняемых запросов и время ожидания
+        """
+        return {
+            "queue_depth": self.queue_depth(),
+            "queued_users": len(self._queues),
+            "in_flight": self.in_flight,
+            "granted": self.granted,
+            "avg_wait": self.total_wait / self.granted if self.granted else 0.0,
+            "max_wait": self.max_wait,
+        }
+    
+    def _costs(self, waiter: _Waiter) -> List[Tuple[TokenBucket, int]]:
+        """Корзины, из которых списывается запрос, и списываемые количества."""
+        costs = [(self.request_bucket, 1), (self.token_bucket, waiter.tokens)]
+        if waiter.model in self.model_buckets:
+            model_requests, model_tokens = self.model_buckets[waiter.model]
+            costs += [(model_requests, 1), (model_tokens, waiter.tokens)]
+        return costs
+    
+    def _delay(self, waiter: _Waiter) -> float:
+        """Сколько ждать, пока лимиты пропустят запрос."""
+        return max(bucket.delay(amount) for bucket, amount in self._costs(waiter))
+    
+    def _grant(self, waiter: _Waiter) -> None:
+        for bucket, amount in self._costs(waiter):
+            bucket.consume(amount)
+        
+        wait = time.monotonic() - waiter.enqueued_at
+        self.in_flight += 1
+        self.granted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if wait > 1:
+            logger.info(f"Запрос к {self.name} ({waiter.model}) ждал в очереди {wait:.2f} секунд")
+        waiter.future.set_result(wait)
+    
+    def _dispatch(self) -> None:
+        """Выдать слоты ожидающим запросам, обходя пользователей по кругу."""
+        min_delay = None
+        
+        while self.in_flight < self.max_concurrency and self._queues:
+            granted = False
+            # Один проход по кругу: каждый пользователь получает не больше одного слота
+            for user_id in list(self._queues):
+                if self.in_flight >= self.max_concurrency:
+                    break
+                queue = self._queues[user_id]
+                # Пропускаем запросы, отмененные во время ожидания
+                while queue and queue[0].future.done():
+                    queue.popleft()
+                if not queue:
+                    del self._queues[user_id]
+                    continue
+                waiter = queue[0]
+                delay = self._delay(waiter)
+                if delay > 0:
+                    min_delay = delay if min_delay is None else min(min_delay, delay)
+                    continue
+                
+                queue.popleft()
+                # Пользователь уходит в конец круга
+                del self._queues[user_id]
+                if queue:
+                    self._queues[user_id] = queue
+                self._grant(waiter)
+                granted = True
+            
+            if not granted:
+                break
+        
+        # Если лимиты не позволили выдать слот, повторяем попытку, когда токены накопятся
+        if min_delay is not None and self._queues and self.in_flight < self.max_concurrency:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = asyncio.get_running_loop().call_later(min_delay, self._on_timer)
+    
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+    
+    def _discard(self, user_id: Hashable, waiter: _Waiter) -> None:
+        """Убрать отмененный запрос из очереди."""
+        queue = self._queues.get(user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[user_id]
+
+# Планировщики создаются при первом обращении к провайдеру
+schedulers: Dict[str, ProviderScheduler] = {}
+
+def get_scheduler(provider: str) -> ProviderScheduler:
+    """
+    Получить планировщик провайдера.
+    
+    Args:
+        provider: Название провайдера
+    
+    Returns:
+        Планировщик запросов к провайдеру
+    """
+    if provider not in schedulers:
+        # Лимиты провайдера общие для бота, поэтому делятся между рабочими процессами
+        limits = PROVIDER_LIMITS[provider]
+        model_limits = {
+            model: {name: value / LIMIT_SHARES for name, value in model_limit.items()}
+            for model, model_limit in MODEL_LIMITS.items()
+        }
+        schedulers[provider] = ProviderScheduler(
+            provider,
+            limits["rpm"] / LIMIT_SHARES,
+            limits["tpm"] / LIMIT_SHARES,
+            max(1, limits["max_concurrency"] // LIMIT_SHARES),
+            model_limits
+        )
+    return schedulers[provider]
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    """Статистика очередей всех провайдеров."""
+    return {name: scheduler.stats() for name, scheduler in schedulers.items()}
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+from bot.config import MAX_TOKENS, MODEL_CONTEXT_BUDGETS
+
+# tiktoken необязателен: без него количество токенов оценивается по длине текста
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Служебные токены, которые API добавляет к каждому сообщению
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Кодировки токенизатора для моделей OpenAI. Для Claude точного
+# публичного токенизатора нет, поэтому используем близкую кодировку
+MODEL_ENCODINGS = {
+    "gpt-4o": "o200k_base",
+    "gpt-3.5-turbo": "cl100k_base",
+}
+DEFAULT_ENCODING = "cl100k_base"
+
+class TokenUsage:
+    """Токены одного запроса, которые вернул провайдер; None - провайдер их не сообщил."""
+    
+    __slots__ = ("prompt_tokens", "completion_tokens")
+    
+    def __init__(self):
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+
+@lru_cache(maxsize=None)
+def _get_encoding(name: str) -> Optional[Any]:
+    """Загрузить кодировку tiktoken один раз; None, если она недоступна."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить кодировку {name}, токены будут оцениваться приблизительно: {str(e)}")
+        return None
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Подсчитать количество токенов в тексте.
+    
+    Args:
+        text: Текст
+        model: Название модели
+    
+    Returns:
+        Количество токенов
+    """
+    encoding = _get_encoding(MODEL_ENCODINGS.get(model, DEFAULT_ENCODING))
+    if encoding is not None:
+        # Служебные токены вроде <|endoftext|> в тексте пользователя считаются обычным текстом
+        return len(encoding.encode_ordinary(text))
+    # В среднем токен занимает около 4 байт UTF-8 (для кириллицы это 2 символа)
+    return len(text.encode("utf-8")) // 4 + 1
+
+async def warm_up() -> None:
+    """Заранее загрузить кодировки токенизатора в отдельном потоке (при первом запуске они скачиваются)."""
+    if tiktoken is None:
+        return
+    for name in set(MODEL_ENCODINGS.values()) | {DEFAULT_ENCODING}:
+        await asyncio.to_thread(_get_encoding, name)
+
+def message_tokens(message: Dict[str, Any], model: str) -> int:
+    """
+    Количество токенов сообщения вместе со служебными.
+    
+    Для сохраненных сообщений используется записанное значение, поэтому
+    каждое сообщение подсчитывается только один раз.
+    
+    Args:
+        message: Сообщение истории
+        model: Название модели
+    
+    Returns:
+        Количество токенов
+    """
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(message["content"], model)
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+def build_context(messages: List[Dict[str, Any]], model: str) -> List[Dict[str, str]]:
+    """
+    Собрать контекст запроса, укладывающийся в бюджет токенов модели.
+    
+    Системные сообщения сохраняются всегда. Остальные добавляются от новых
+    к старым, пока запрос вместе с MAX_TOKENS ответа помещается в бюджет.
+    Контекст всегда начинается с сообщения пользователя.
+    
+    Args:
+        messages: История сообщений, последним идет новое сообщение пользователя
+        model: Название модели
+    
+    Returns:
+        Сообщения в формате API (только role и content)
+    """
+    budget = MODEL_CONTEXT_BUDGETS.get(model, MODEL_CONTEXT_BUDGETS["default"]) - MAX_TOKENS
+    
+    system_messages = [msg for msg in messages if msg["role"] == "system"]
+    budget -= sum(message_tokens(msg, model) for msg in system_messages)
+    
+    # Отбираем сообщения с конца; последнее сообщение пользователя берем всегда
+    selected = []
+    for msg in reversed([msg for msg in messages if msg["role"] != "system"]):
+        cost = message_tokens(msg, model)
+        if selected and cost > budget:
+            break
+        selected.append(msg)
+        budget -= cost
+    selected.reverse()
+    
+    # Ответ модели без вопроса в начале контекста бесполезен, а Anthropic его не примет
+    while len(selected) > 1 and selected[0]["role"] == "assistant":
+        selected.pop(0)
+    
+    return [{"role": msg["role"], "content": msg["content"]} for msg in system_messages + selected]
+
+def prompt_tokens(messages: List[Dict[str, Any]], model: str) -> int:
+    """
+    Количество токенов запроса.
+    
+    Args:
+        messages: Сообщения запроса
+        model: Название модели
+    
+    Returns:
+        Количество токенов
+    """
+    return sum(message_tokens(msg, model) for msg in messages)
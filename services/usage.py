@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from bot.config import MODEL_PRICES, USAGE_FLUSH_INTERVAL
+from bot.metrics import COST, ERRORS
+from bot.storage import storage
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Ключ агрегата: пользователь (0 - фоновые запросы), модель и час (Unix-время начала часа)
+UsageKey = Tuple[int, str, int]
+
+def request_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    Стоимость запроса в долларах по ценам MODEL_PRICES.
+    
+    Args:
+        model: Название модели
+        prompt_tokens: Токены запроса
+        completion_tokens: Токены ответа
+    
+    Returns:
+        Стоимость (0 для моделей без цены)
+    """
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return 0.0
+    return (prompt_tokens * prices["prompt"] + completion_tokens * prices["completion"]) / 1_000_000
+
+class UsageTracker:
+    """
+    Учет использования моделей: токены, время и стоимость запросов.
+    
+    Каждый запрос только прибавляется к агрегату в памяти по ключу
+    (пользователь, модель, час). Фоновая задача раз в interval секунд
+    сохраняет накопленные агрегаты одной пакетной записью, прибавляя их
+    к сохраненным, поэтому число записей в базу не зависит от числа
+    запросов. При ошибке записи агрегаты возвращаются и сохраняются
+    следующим пакетом.
+    """
+    
+    def __init__(self, interval: float = USAGE_FLUSH_INTERVAL):
+        """
+        Args:
+            interval: Период сохранения в секундах
+        """
+        self.interval = interval
+        self.pending: Dict[UsageKey, Dict[str, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+    
+    def record(
+        self,
+        user_id: Optional[int],
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        seconds: float
+    ) -> None:
+        """
+        Учесть выполненный запрос.
+        
+        Args:
+            user_id: ID пользователя (None - фоновый запрос)
+            model: Модель, которая ответила
+            prompt_tokens: Токены запроса
+            completion_tokens: Токены ответа
+            seconds: Время запроса без ожидания в очереди
+        """
+        hour = int(time.time() // 3600 * 3600)
+        key = (user_id or 0, model, hour)
+        totals = self.pending.get(key)
+        if totals is None:
+            totals = self.pending[key] = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0, "cost": 0.0}
+        totals["requests"] += 1
+        totals["prompt_tokens"] += prompt_tokens
+        totals["completion_tokens"] += completion_tokens
+        totals["seconds"] += seconds
+        cost = request_cost(model, prompt_tokens, completion_tokens)
+        totals["cost"] += cost
+        COST.inc(cost, model=model)
+        self._ensure_task()
+    
+    async def flush(self) -> None:
+        """Сохранить накопленные агрегаты одной пакетной записью."""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        try:
+            await storage.save_usage(batch)
+        except Exception:
+            # Возвращаем агрегаты, к ним прибавятся запросы, учтенные во время записи
+            for key, totals in batch.items():
+                current = self.pending.setdefault(key, dict.fromkeys(totals, 0))
+                for field, value in totals.items():
+                    current[field] += value
+            raise
+    
+    async def report(self, hours: int) -> Dict[str, Any]:
+        """
+        Отчет об использовании за последние часы.
+        
+        Args:
+            hours: Сколько последних часов учитывать, включая текущий
+        
+        Returns:
+            Итоги по моделям (с токенами ответа в секунду) и по пользователям,
+            отсортированные по стоимости
+        """
+        # Отчет читает базу, поэтому сначала сохраняем накопленное
+        await self.flush()
+        since = int(time.time() // 3600 * 3600) - (hours - 1) * 3600
+        rows = await storage.load_usage(since)
+        
+        models: Dict[str, Dict[str, float]] = {}
+        users: Dict[int, Dict[str, float]] = {}
+        for row in rows:
+            for group, key in ((models, row["model"]), (users, row["user_id"])):
+                totals = group.setdefault(key, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0, "cost": 0.0})
+                for field in totals:
+                    totals[field] += row[field]
+        for totals in models.values():
+            totals["tokens_per_second"] = totals["completion_tokens"] / totals["seconds"] if totals["seconds"] else 0.0
+            totals["avg_seconds"] = totals["seconds"] / totals["requests"] if totals["requests"] else 0.0
+        
+        def by_cost(group: Dict[Any, Dict[str, float]]) -> List[Tuple[Any, Dict[str, float]]]:
+            return sorted(group.items(), key=lambda item: item[1]["cost"], reverse=True)
+        
+        return {"hours": hours, "models": by_cost(models), "users": by_cost(users)}
+    
+    def _ensure_task(self) -> None:
+        """Запустить периодическое сохранение при первом обращении из цикла событий."""
+        if self._task is None and not self._closed:
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                ERRORS.inc(type="usage_flush")
+                logger.error(f"Ошибка сохранения статистики использования ({len(self.pending)} записей): {e}")
+    
+    async def close(self) -> None:
+        """Остановить периодическое сохранение и сохранить накопленное."""
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить статистику использования при остановке: {e}")
+
+def format_report(report: Dict[str, Any], top_users: int = 10) -> str:
+    """
+    Текст отчета об использовании для команды /usage.
+    
+    Args:
+        report: Результат UsageTracker.report
+        top_users: Сколько пользователей с наибольшей стоимостью показать
+    
+    Returns:
+        Текст отчета
+    """
+    if not report["models"]:
+        return f"За последние {report['hours']} ч запросов к моделям не было."
+    
+    lines = [f"Использование за последние {report['hours']} ч", "", "Модели:"]
+    for model, totals in report["models"]:
+        lines.append(
+            f"{model}: {totals['requests']:.0f} запросов, "
+            f"токены {totals['prompt_tokens']:.0f} + {totals['completion_tokens']:.0f}, "
+            f"{totals['tokens_per_second']:.1f} ток/с, {totals['avg_seconds']:.1f} с на запрос, "
+            f"${totals['cost']:.2f}"
+        )
+    lines.append(f"Всего: ${sum(totals['cost'] for _, totals in report['models']):.2f}")
+    
+    lines += ["", "Пользователи:"]
+    for user_id, totals in report["users"][:top_users]:
+        name = "фоновые запросы" if user_id == 0 else str(user_id)
+        lines.append(
+            f"{name}: {totals['requests']:.0f} запросов, "
+            f"{totals['prompt_tokens'] + totals['completion_tokens']:.0f} токенов, ${totals['cost']:.2f}"
+        )
+    return "\n".join(lines)
+
+# Создаем единый экземпляр учета использования
+tracker = UsageTracker()